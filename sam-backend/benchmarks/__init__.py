@@ -0,0 +1,6 @@
+"""
+are_doko バックエンドのベンチマークスイート
+
+Supabase・SAMチェックポイントなしでオフライン実行できる。
+詳細は sam-backend/README.md の「ベンチマーク」を参照。
+"""
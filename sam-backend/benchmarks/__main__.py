@@ -0,0 +1,40 @@
+"""
+ベンチマークスイートの一括実行
+
+使い方:
+    cd sam-backend
+    python -m benchmarks [--suite sam --suite api] [--output bench.json]
+"""
+
+import argparse
+
+from benchmarks import bench_api, bench_lasso, bench_sam, bench_serialization
+from benchmarks.common import build_report, quiet, write_report
+
+SUITES = {
+    "sam": bench_sam,
+    "lasso": bench_lasso,
+    "api": bench_api,
+    "serialization": bench_serialization,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="are_doko バックエンドのベンチマークスイート")
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES), help="実行するスイート（複数指定可、省略時は全て）")
+    parser.add_argument("--iterations", type=int, default=200, help="1ケースあたりの基本実行回数")
+    parser.add_argument("--output", default=None, help="JSONレポートの出力先（省略時は標準出力）")
+    for module in SUITES.values():
+        module.add_arguments(parser)
+    args = parser.parse_args()
+
+    results = []
+    with quiet():
+        for name in args.suite or SUITES:
+            results += SUITES[name].run(args)
+
+    write_report(build_report(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
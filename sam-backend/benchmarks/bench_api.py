@@ -0,0 +1,165 @@
+"""
+APIルーターのエンドツーエンド負荷テスト
+
+benchmarks.fake_supabase のインメモリSupabaseに差し替えたうえで、
+FastAPIアプリにASGI経由で直接リクエストを送る（ネットワーク・Supabase不要）。
+
+使い方:
+    cd sam-backend
+    python -m benchmarks.bench_api [--concurrency 8] [--objects-per-photo 50]
+
+httpx が必要です（pip install httpx）。
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import math
+
+import httpx
+from PIL import Image
+
+from benchmarks import fake_supabase
+from benchmarks.common import build_report, measure_concurrent, quiet, write_report
+
+SUITE = "api"
+
+
+def _data_url(width: int, height: int, fmt: str = "PNG") -> str:
+    """単色画像のdata URL"""
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (120, 160, 200)).save(buf, fmt)
+    mime = "jpeg" if fmt == "JPEG" else fmt.lower()
+    return f"data:image/{mime};base64,{base64.b64encode(buf.getvalue()).decode()}"
+
+
+def _polygon(n_vertices: int, cx: float, cy: float, r: float) -> list[dict]:
+    return [
+        {"x": cx + r * math.cos(2 * math.pi * i / n_vertices), "y": cy + r * math.sin(2 * math.pi * i / n_vertices)}
+        for i in range(n_vertices)
+    ]
+
+
+async def _seed(
+    client: httpx.AsyncClient,
+    photos: int,
+    objects_per_photo: int,
+    vertices: int,
+) -> dict:
+    """倉庫1件・写真・オブジェクトをAPI経由で作成"""
+    warehouse = (await client.post("/api/warehouses", json={"name": "bench", "memo": ""})).json()
+    photo_url = _data_url(64, 48, "JPEG")
+    clip_url = _data_url(16, 16)
+
+    photo_ids = []
+    object_ids = []
+    for p in range(photos):
+        photo = (await client.post(
+            f"/api/warehouses/{warehouse['id']}/photos",
+            json={"name": f"photo-{p}", "width": 4000, "height": 3000, "image_data_url": photo_url},
+        )).json()
+        photo_ids.append(photo["id"])
+        for o in range(objects_per_photo):
+            obj = (await client.post(
+                f"/api/photos/{photo['id']}/objects",
+                json={
+                    "name": f"object-{o}",
+                    "memo": "",
+                    "clipped_image_data_url": clip_url,
+                    "mask_type": "polygon",
+                    "mask_data": {"points": _polygon(vertices, 2000, 1500, 300)},
+                    "click_point": {"x": 2000, "y": 1500},
+                },
+            )).json()
+            object_ids.append(obj["id"])
+
+    return {
+        "warehouse_id": warehouse["id"],
+        "photo_ids": photo_ids,
+        "object_ids": object_ids,
+        "clip_url": clip_url,
+    }
+
+
+async def _run(args: argparse.Namespace) -> list[dict]:
+    fake_supabase.install()
+
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        seed = await _seed(client, args.photos, args.objects_per_photo, args.vertices)
+        warehouse_id = seed["warehouse_id"]
+        photo_id = seed["photo_ids"][0]
+        object_id = seed["object_ids"][0]
+
+        async def get(url: str) -> None:
+            response = await client.get(url)
+            response.raise_for_status()
+
+        async def create_object() -> None:
+            response = await client.post(f"/api/photos/{photo_id}/objects", json={
+                "name": "new",
+                "memo": "",
+                "clipped_image_data_url": seed["clip_url"],
+                "mask_type": "polygon",
+                "mask_data": {"points": _polygon(args.vertices, 100, 100, 50)},
+                "click_point": {"x": 100, "y": 100},
+            })
+            response.raise_for_status()
+
+        segment_image = _data_url(1024, 768, "JPEG").split(",", 1)[1]
+
+        async def segment() -> None:
+            response = await client.post("/api/segment", json={
+                "image_base64": segment_image, "click_x": 512, "click_y": 384,
+            })
+            response.raise_for_status()
+
+        params = {
+            "photos": args.photos,
+            "objects_per_photo": args.objects_per_photo,
+            "vertices": args.vertices,
+        }
+        n, conc = args.iterations, args.concurrency
+        return [
+            await measure_concurrent(SUITE, "GET /api/warehouses",
+                                     lambda: get("/api/warehouses"), n, conc, **params),
+            await measure_concurrent(SUITE, "GET /api/warehouses/{id}/photos",
+                                     lambda: get(f"/api/warehouses/{warehouse_id}/photos"), n, conc, **params),
+            await measure_concurrent(SUITE, "GET /api/photos/{id}/objects",
+                                     lambda: get(f"/api/photos/{photo_id}/objects"), n, conc, **params),
+            await measure_concurrent(SUITE, "GET /api/objects/{id}",
+                                     lambda: get(f"/api/objects/{object_id}"), n, conc, **params),
+            await measure_concurrent(SUITE, "POST /api/photos/{id}/objects",
+                                     create_object, n, conc, **params),
+            await measure_concurrent(SUITE, "POST /api/segment (dummy)",
+                                     segment, max(n // 4, 10), conc, image_size="1024x768"),
+        ]
+
+
+def run(args: argparse.Namespace) -> list[dict]:
+    return asyncio.run(_run(args))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--concurrency", type=int, default=8, help="同時リクエスト数")
+    parser.add_argument("--photos", type=int, default=5, help="作成する写真数")
+    parser.add_argument("--objects-per-photo", type=int, default=50, help="写真1枚あたりのオブジェクト数")
+    parser.add_argument("--vertices", type=int, default=200, help="オブジェクトのポリゴン頂点数")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", default=None, help="JSONレポートの出力先（省略時は標準出力）")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with quiet():
+        results = run(args)
+    write_report(build_report(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
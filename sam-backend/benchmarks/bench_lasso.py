@@ -0,0 +1,146 @@
+"""
+投げ縄セグメンテーションの前後処理マイクロベンチマーク
+
+SAMの推論そのものは含めず、segment_with_lasso が推論の前後で行う
+投げ縄マスク生成・mask_input生成・マスク選択の処理時間とピークメモリを
+旧実装（全画面マスク + Pythonループ）と比較する。
+
+使い方:
+    cd sam-backend
+    python -m benchmarks.bench_lasso [--repeat 20]
+"""
+
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from benchmarks.common import measure
+
+SUITE = "lasso"
+
+# (画像サイズ, 投げ縄の半径) の組み合わせ
+CASES = [
+    ((1024, 1024), 120),
+    ((2048, 2048), 200),
+    ((4096, 4096), 300),
+    ((4096, 4096), 1500),
+]
+
+
+def _make_lasso(w: int, h: int, radius: int, n_points: int = 64) -> np.ndarray:
+    """画像中央付近に円形に近い投げ縄ポリゴンを生成"""
+    rng = np.random.default_rng(0)
+    angles = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+    radii = radius * (0.85 + 0.3 * rng.random(n_points))
+    cx, cy = w // 2, h // 2
+    xs = np.clip(cx + radii * np.cos(angles), 0, w - 1)
+    ys = np.clip(cy + radii * np.sin(angles), 0, h - 1)
+    return np.stack([xs, ys], axis=1).astype(np.int32)
+
+
+def _make_masks(w: int, h: int, radius: int) -> np.ndarray:
+    """SAMのpredict出力を模した (3, H, W) のboolマスク"""
+    masks = np.zeros((3, h, w), dtype=bool)
+    cx, cy = w // 2, h // 2
+    for i, scale in enumerate((0.5, 1.0, 1.5)):
+        r = int(radius * scale)
+        masks[i, max(0, cy - r):cy + r, max(0, cx - r):cx + r] = True
+    return masks
+
+
+def legacy_lasso(masks: np.ndarray, lasso_points: np.ndarray, h: int, w: int) -> int:
+    """旧実装: 全画面の投げ縄マスク + Pythonループでのスコアリング"""
+    lasso_mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.fillPoly(lasso_mask, [lasso_points], 1)
+
+    lasso_mask_resized = cv2.resize(lasso_mask, (256, 256), interpolation=cv2.INTER_NEAREST)
+    mask_logits = (lasso_mask_resized.astype(np.float32) * 2 - 1) * 10
+    _ = mask_logits[None, :, :]
+
+    lasso_bool = lasso_mask.astype(bool)
+    lasso_area = lasso_bool.sum()
+
+    best_idx = 0
+    best_coverage = 0
+    for i, mask in enumerate(masks):
+        overlap = (mask & lasso_bool).sum()
+        coverage = overlap / lasso_area if lasso_area > 0 else 0
+        if coverage > best_coverage:
+            best_coverage = coverage
+            best_idx = i
+    return best_idx
+
+
+def current_lasso(masks: np.ndarray, lasso_points: np.ndarray, h: int, w: int) -> int:
+    """現行実装: 外接矩形内のみラスタライズ + 一括リダクション"""
+    from sam_service import SAMService
+
+    lasso_crop, origin = SAMService._rasterize_lasso_crop(lasso_points, h, w)
+    _ = SAMService._lasso_mask_input(lasso_points, h, w)
+    return SAMService._select_lasso_mask(masks, lasso_crop, origin)
+
+
+def _peak_mb(fn, masks, lasso_points, h, w) -> tuple[float, int]:
+    """1回実行したときのピーク追加メモリ(MB)と選択されたマスク"""
+    tracemalloc.start()
+    result = fn(masks, lasso_points, h, w)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, result
+
+
+def run(args: argparse.Namespace) -> list[dict]:
+    """各ケースを旧実装・現行実装で計測（JSONレポート用）"""
+    results = []
+    for (w, h), radius in CASES:
+        lasso_points = _make_lasso(w, h, radius)
+        masks = _make_masks(w, h, radius)
+        for name, fn in (("legacy", legacy_lasso), ("current", current_lasso)):
+            result = measure(
+                SUITE, f"lasso_prepare/{name}",
+                lambda: fn(masks, lasso_points, h, w),
+                iterations=args.repeat, warmup=1, image_size=f"{w}x{h}", lasso_radius=radius,
+            )
+            result["peak_mb"], _ = _peak_mb(fn, masks, lasso_points, h, w)
+            results.append(result)
+    return results
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--repeat", type=int, default=20, help="各ケースの繰り返し回数")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    header = f"{'image':>11} {'lasso r':>8} | {'legacy ms':>10} {'MB':>8} | {'current ms':>10} {'MB':>8} | {'speedup':>7}"
+    print(header)
+    print("-" * len(header))
+
+    for (w, h), radius in CASES:
+        lasso_points = _make_lasso(w, h, radius)
+        masks = _make_masks(w, h, radius)
+
+        legacy_mb, legacy_idx = _peak_mb(legacy_lasso, masks, lasso_points, h, w)
+        current_mb, current_idx = _peak_mb(current_lasso, masks, lasso_points, h, w)
+        assert legacy_idx == current_idx, "選択されたマスクが旧実装と異なります"
+
+        legacy_ms = measure(SUITE, "legacy", lambda: legacy_lasso(masks, lasso_points, h, w),
+                            iterations=args.repeat, warmup=1)["mean_ms"]
+        current_ms = measure(SUITE, "current", lambda: current_lasso(masks, lasso_points, h, w),
+                             iterations=args.repeat, warmup=1)["mean_ms"]
+
+        print(
+            f"{w:>5}x{h:<5} {radius:>8} | "
+            f"{legacy_ms:>10.2f} {legacy_mb:>8.2f} | "
+            f"{current_ms:>10.2f} {current_mb:>8.2f} | "
+            f"{legacy_ms / current_ms:>6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
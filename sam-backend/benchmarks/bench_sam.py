@@ -0,0 +1,175 @@
+"""
+SAMService と _mask_to_result のベンチマーク
+
+- SAMService: ダミーモード（常に実行）と、チェックポイント指定時の実モデル
+- _mask_to_result: 複雑さの異なる合成マスク
+
+使い方:
+    cd sam-backend
+    python -m benchmarks.bench_sam [--checkpoint checkpoints/sam_vit_b_01ec64.pth]
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+
+from benchmarks.common import build_report, measure, quiet, skipped, write_report
+
+SUITE = "sam"
+
+
+def make_image(size: int, seed: int = 0) -> np.ndarray:
+    """図形を散らした合成RGB画像"""
+    rng = np.random.default_rng(seed)
+    image = np.full((size, size, 3), 200, dtype=np.uint8)
+    for _ in range(20):
+        x, y = rng.integers(0, size, 2)
+        r = int(rng.integers(size // 40, size // 8))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.circle(image, (int(x), int(y)), r, color, -1)
+    return image
+
+
+def make_masks(size: int, seed: int = 0) -> dict[str, np.ndarray]:
+    """複雑さの異なる合成マスク（名前 -> boolマスク）"""
+    rng = np.random.default_rng(seed)
+    c = size // 2
+    masks = {}
+
+    circle = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(circle, (c, c), size // 3, 1, -1)
+    masks["circle"] = circle.astype(bool)
+
+    # 多数のトゲを持つ星形（頂点数の多い輪郭）
+    n = 256
+    angles = np.linspace(0, 2 * np.pi, 2 * n, endpoint=False)
+    radii = np.where(np.arange(2 * n) % 2 == 0, size * 0.4, size * 0.3)
+    star_points = np.stack([c + radii * np.cos(angles), c + radii * np.sin(angles)], axis=1)
+    star = np.zeros((size, size), dtype=np.uint8)
+    cv2.fillPoly(star, [star_points.astype(np.int32)], 1)
+    masks["star"] = star.astype(bool)
+
+    # ぼかしたノイズの閾値処理（不規則な境界）
+    noise = rng.random((size // 8, size // 8)).astype(np.float32)
+    noise = cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+    noise = cv2.GaussianBlur(noise, (0, 0), size / 256)
+    masks["noisy_blob"] = (noise > 0.5) & circle.astype(bool)
+
+    # 多数の小さな連結成分
+    fragmented = np.zeros((size, size), dtype=np.uint8)
+    step = max(size // 32, 4)
+    for y in range(step, size - step, step):
+        for x in range(step, size - step, step):
+            cv2.circle(fragmented, (x, y), step // 3, 1, -1)
+    masks["fragmented"] = fragmented.astype(bool)
+
+    return masks
+
+
+def bench_dummy(iterations: int) -> list[dict]:
+    """ダミーモードのSAMService"""
+    import sam_service
+    from sam_service import SAMService
+
+    available = sam_service.SAM_AVAILABLE
+    sam_service.SAM_AVAILABLE = False
+    try:
+        service = SAMService()
+    finally:
+        sam_service.SAM_AVAILABLE = available
+
+    results = []
+    for size in (1024, 4096):
+        image = make_image(size)
+        c = size // 2
+        lasso = [(c - 100, c - 100), (c + 100, c - 100), (c + 100, c + 100), (c - 100, c + 100)]
+        results.append(measure(
+            SUITE, "segment/dummy", lambda: service.segment(image, (c, c)),
+            iterations=iterations, image_size=size,
+        ))
+        results.append(measure(
+            SUITE, "segment_with_lasso/dummy", lambda: service.segment_with_lasso(image, lasso),
+            iterations=iterations, image_size=size,
+        ))
+    return results
+
+
+def bench_model(checkpoint: str, model_type: str, iterations: int) -> list[dict]:
+    """チェックポイントを読み込んだ実モデルのSAMService"""
+    import sam_service
+    from sam_service import SAMService
+
+    if not sam_service.SAM_AVAILABLE:
+        return [skipped(SUITE, "segment/model", "segment_anything is not installed")]
+
+    service = SAMService(model_type=model_type, checkpoint_path=checkpoint)
+    if not service.is_loaded():
+        return [skipped(SUITE, "segment/model", f"checkpoint not loaded: {checkpoint}")]
+
+    size = 1024
+    images = [make_image(size, seed=0), make_image(size, seed=1)]
+    c = size // 2
+    lasso = [(c - 150, c - 150), (c + 150, c - 150), (c + 150, c + 150), (c - 150, c + 150)]
+    counter = {"i": 0}
+
+    def alternate() -> None:
+        # 毎回別の画像 = 埋め込みキャッシュミス（set_image込み）
+        counter["i"] += 1
+        service.segment(images[counter["i"] % 2], (c, c))
+
+    params = {"model_type": model_type, "image_size": size}
+    return [
+        measure(SUITE, "segment/model/cache_hit", lambda: service.segment(images[0], (c, c)),
+                iterations=iterations, **params),
+        measure(SUITE, "segment/model/cache_miss", alternate,
+                iterations=max(iterations // 10, 3), warmup=1, **params),
+        measure(SUITE, "segment_with_lasso/model/cache_hit",
+                lambda: service.segment_with_lasso(images[0], lasso),
+                iterations=iterations, **params),
+    ]
+
+
+def bench_mask_to_result(iterations: int) -> list[dict]:
+    """合成マスクからのポリゴン抽出"""
+    from sam_service import SAMService
+
+    service = SAMService.__new__(SAMService)
+    results = []
+    for size in (1024, 4096):
+        for name, mask in make_masks(size).items():
+            results.append(measure(
+                SUITE, f"mask_to_result/{name}", lambda m=mask: service._mask_to_result(m),
+                iterations=iterations, mask_size=size,
+            ))
+    return results
+
+
+def run(args: argparse.Namespace) -> list[dict]:
+    results = bench_dummy(args.iterations)
+    results += bench_mask_to_result(max(args.iterations // 10, 10))
+    if args.checkpoint:
+        results += bench_model(args.checkpoint, args.model_type, max(args.iterations // 10, 5))
+    else:
+        results.append(skipped(SUITE, "segment/model", "no --checkpoint given"))
+    return results
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--checkpoint", default=None, help="SAMチェックポイントのパス（省略時は実モデルをスキップ）")
+    parser.add_argument("--model-type", default="vit_b", help="チェックポイントのモデルタイプ")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", default=None, help="JSONレポートの出力先（省略時は標準出力）")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with quiet():
+        results = run(args)
+    write_report(build_report(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
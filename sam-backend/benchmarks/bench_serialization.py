@@ -0,0 +1,161 @@
+"""
+レスポンスのシリアライズ時間とペイロードサイズのベンチマーク
+
+- segment: Pydanticの頂点モデル（Position）経由 vs dict + orjson
+- list_objects: response_model（list[StorageObject]）の検証経由 vs dict + orjson
+- 圧縮: 生JSON / gzip / brotli のサイズと圧縮時間
+
+使い方:
+    cd sam-backend
+    python -m benchmarks.bench_serialization
+"""
+
+import argparse
+import gzip
+import json
+import math
+import sys
+import uuid
+from datetime import datetime, timezone
+
+from pydantic import TypeAdapter
+
+from benchmarks.common import build_report, measure, quiet, write_report
+
+SUITE = "serialization"
+
+
+def _legacy_json(adapter: TypeAdapter, content) -> bytes:
+    """FastAPI既定の経路: response_modelで検証 -> JSON互換dict -> json.dumps"""
+    validated = adapter.validate_python(content)
+    data = adapter.dump_python(validated, mode="json")
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def _polygon(n_vertices: int, cx: float, cy: float, r: float) -> list[tuple[int, int]]:
+    return [
+        (int(cx + r * math.cos(2 * math.pi * i / n_vertices)), int(cy + r * math.sin(2 * math.pi * i / n_vertices)))
+        for i in range(n_vertices)
+    ]
+
+
+def _object_rows(n_objects: int, n_vertices: int) -> list[dict]:
+    """_to_object_response 後の形をしたオブジェクト一覧"""
+    now = datetime.now(timezone.utc).isoformat()
+    photo_id = str(uuid.uuid4())
+    rows = []
+    for i in range(n_objects):
+        points = [{"x": x + 0.5, "y": y + 0.25} for x, y in _polygon(n_vertices, 2000, 1500, 300 + i)]
+        rows.append({
+            "id": str(uuid.uuid4()),
+            "photo_id": photo_id,
+            "name": f"工具{i}",
+            "memo": "棚の上段",
+            "clipped_image_url": f"http://localhost:8000/api/storage/objects/{uuid.uuid4()}.png?expires=0&signature={'0' * 64}",
+            "mask_type": "polygon",
+            "mask_data": {"points": points},
+            "click_point": {"x": 2000.0, "y": 1500.0},
+            "display_order": i,
+            "created_at": now,
+            "updated_at": now,
+            "version": 1,
+        })
+    return rows
+
+
+def _size_results(name: str, body: bytes, iterations: int, **params) -> list[dict]:
+    """生JSON/gzip/brotliのサイズと圧縮時間"""
+    results = []
+    raw = measure(SUITE, f"{name}/compress/none", lambda: body, iterations=1, warmup=0, **params)
+    raw["bytes"] = len(body)
+    results.append(raw)
+
+    gz = measure(SUITE, f"{name}/compress/gzip", lambda: gzip.compress(body, compresslevel=6),
+                 iterations=iterations, **params)
+    gz["bytes"] = len(gzip.compress(body, compresslevel=6))
+    results.append(gz)
+
+    try:
+        import brotli
+    except ImportError:
+        return results
+    br = measure(SUITE, f"{name}/compress/brotli", lambda: brotli.compress(body, quality=4),
+                 iterations=iterations, **params)
+    br["bytes"] = len(brotli.compress(body, quality=4))
+    results.append(br)
+    return results
+
+
+def bench_segment(iterations: int) -> list[dict]:
+    """/api/segment のレスポンス生成"""
+    import main
+
+    adapter = TypeAdapter(main.SegmentResponse)
+    results = []
+    for n_vertices in (100, 2000):
+        polygon = _polygon(n_vertices, 1000, 800, 400)
+        result = {"polygon": polygon, "bounding_box": (600, 400, 800, 800)}
+
+        def legacy() -> bytes:
+            response = main.SegmentResponse(
+                polygon=[main.Position(x=p[0], y=p[1]) for p in result["polygon"]],
+                bounding_box=main.BoundingBox(
+                    x=result["bounding_box"][0],
+                    y=result["bounding_box"][1],
+                    width=result["bounding_box"][2],
+                    height=result["bounding_box"][3],
+                ),
+            )
+            return _legacy_json(adapter, response)
+
+        results.append(measure(SUITE, "segment/pydantic", legacy, iterations=iterations, vertices=n_vertices))
+        results.append(measure(SUITE, "segment/orjson", lambda: main.segment_response(result).body,
+                               iterations=iterations, vertices=n_vertices))
+    return results
+
+
+def bench_list_objects(iterations: int) -> list[dict]:
+    """/api/photos/{id}/objects のレスポンス生成"""
+    from fastapi.responses import ORJSONResponse
+    from models import StorageObject
+
+    adapter = TypeAdapter(list[StorageObject])
+    results = []
+    for n_objects, n_vertices in ((50, 200), (200, 1000)):
+        rows = _object_rows(n_objects, n_vertices)
+        params = {"objects": n_objects, "vertices": n_vertices}
+        results.append(measure(SUITE, "list_objects/pydantic", lambda: _legacy_json(adapter, rows),
+                               iterations=iterations, warmup=1, **params))
+        results.append(measure(SUITE, "list_objects/orjson", lambda: ORJSONResponse(rows).body,
+                               iterations=iterations, warmup=1, **params))
+        results += _size_results("list_objects", ORJSONResponse(rows).body, iterations, **params)
+    return results
+
+
+def run(args: argparse.Namespace) -> list[dict]:
+    iterations = max(args.iterations // 10, 5)
+    return bench_segment(args.iterations) + bench_list_objects(iterations)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """このスイート固有の引数はなし"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", default=None, help="JSONレポートの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+    with quiet():
+        results = run(args)
+
+    # 比較しやすいよう要約も標準エラーに出す
+    for r in results:
+        size = f"{r['bytes']:>10,} B" if "bytes" in r else " " * 12
+        print(f"{r['name']:<32} {str(r['params']):<36} p50 {r['p50_ms']:>9.3f} ms {size}", file=sys.stderr)
+
+    write_report(build_report(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+ベンチマーク共通処理
+
+計測結果は以下の形式のdictで表す（JSONレポートの1要素）:
+    {
+        "suite": "sam",
+        "name": "segment/dummy",
+        "params": {...},
+        "iterations": 200,
+        "throughput_per_s": 1234.5,
+        "mean_ms": 0.81, "p50_ms": 0.79, "p95_ms": 0.95, "p99_ms": 1.20, "max_ms": 2.10,
+    }
+"""
+
+import asyncio
+import contextlib
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+
+
+def _summarize(
+    suite: str,
+    name: str,
+    samples: list[float],
+    wall_seconds: float,
+    params: dict[str, Any],
+) -> dict:
+    """処理時間のサンプル（秒）から結果dictを作る"""
+    ms = np.asarray(samples) * 1000
+    return {
+        "suite": suite,
+        "name": name,
+        "params": params,
+        "iterations": len(samples),
+        "throughput_per_s": len(samples) / wall_seconds if wall_seconds > 0 else 0.0,
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+def measure(
+    suite: str,
+    name: str,
+    fn: Callable[[], Any],
+    iterations: int = 100,
+    warmup: int = 5,
+    **params: Any,
+) -> dict:
+    """同期関数を繰り返し実行してレイテンシとスループットを計測"""
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    wall_start = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+
+    return _summarize(suite, name, samples, wall, params)
+
+
+async def measure_concurrent(
+    suite: str,
+    name: str,
+    fn: Callable[[], Awaitable[Any]],
+    iterations: int = 200,
+    concurrency: int = 8,
+    warmup: int = 5,
+    **params: Any,
+) -> dict:
+    """非同期関数を指定の同時実行数で実行してレイテンシとスループットを計測"""
+    for _ in range(warmup):
+        await fn()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    samples: list[float] = []
+
+    async def one() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await fn()
+            samples.append(time.perf_counter() - start)
+
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(iterations)))
+    wall = time.perf_counter() - wall_start
+
+    return _summarize(suite, name, samples, wall, {"concurrency": concurrency, **params})
+
+
+def skipped(suite: str, name: str, reason: str, **params: Any) -> dict:
+    """実行できなかったベンチマークの結果"""
+    return {"suite": suite, "name": name, "params": params, "skipped": reason}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def build_report(results: list[dict]) -> dict:
+    """実行環境の情報を付けたJSONレポート"""
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+
+def quiet():
+    """
+    アプリ側のprint出力を標準エラーに逃がす
+
+    JSONレポートを標準出力に書くため、ベンチマーク対象のログが混ざらないようにする
+    """
+    return contextlib.redirect_stdout(sys.stderr)
+
+
+def write_report(report: dict, path: Optional[str]) -> None:
+    """レポートをファイル（Noneなら標準出力）に書き出す"""
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if path is None:
+        print(text)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
@@ -0,0 +1,58 @@
+"""
+2つのベンチマークレポートを比較
+
+基準レポートに対してレイテンシが閾値以上悪化したケースがあれば終了コード1を返す。
+
+使い方:
+    cd sam-backend
+    python -m benchmarks.compare base.json new.json [--metric p95_ms] [--threshold 0.1]
+"""
+
+import argparse
+import json
+import sys
+
+
+def _key(result: dict) -> tuple:
+    return (result["suite"], result["name"], json.dumps(result.get("params", {}), sort_keys=True))
+
+
+def _load(path: str) -> dict[tuple, dict]:
+    with open(path, encoding="utf-8") as f:
+        report = json.load(f)
+    return {_key(r): r for r in report["results"] if "skipped" not in r}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("base", help="基準レポート")
+    parser.add_argument("new", help="比較対象レポート")
+    parser.add_argument("--metric", default="p95_ms", help="比較する指標（p50_ms, p95_ms, p99_ms, mean_ms）")
+    parser.add_argument("--threshold", type=float, default=0.1, help="悪化とみなす変化率（0.1 = 10%%）")
+    args = parser.parse_args()
+
+    base = _load(args.base)
+    new = _load(args.new)
+
+    regressions = 0
+    print(f"{'suite':<6} {'name':<40} {'base':>10} {'new':>10} {'change':>8}")
+    for key in sorted(base.keys() & new.keys()):
+        before = base[key][args.metric]
+        after = new[key][args.metric]
+        change = (after - before) / before if before > 0 else 0.0
+        mark = ""
+        if change > args.threshold:
+            regressions += 1
+            mark = "  REGRESSION"
+        print(f"{key[0]:<6} {key[1]:<40} {before:>10.3f} {after:>10.3f} {change:>+7.1%}{mark}")
+
+    for key in sorted(base.keys() - new.keys()):
+        print(f"{key[0]:<6} {key[1]:<40} (missing in new report)")
+
+    if regressions:
+        print(f"\n{regressions} case(s) regressed more than {args.threshold:.0%} on {args.metric}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+インメモリのSupabaseクライアント（ベンチマーク用）
+
+routers/ と utils/storage.py が使うテーブル操作・Storage操作だけを実装した
+supabase.Client の代替。install() で get_supabase_client() が返すクライアントを
+差し替えると、Supabaseなしでルーターをエンドツーエンドで実行できる。
+
+DB側のデフォルト値・バージョン自動更新トリガー・ON DELETE CASCADE・
+ストアドファンクション（rpc）もマイグレーション（supabase/migrations）と同じ挙動を再現する。
+"""
+
+import copy
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+# テーブルごとのデフォルト値（マイグレーションのDEFAULT句に対応）
+_DEFAULTS: dict[str, dict[str, Any]] = {
+    "aredoko_warehouses": {"memo": ""},
+    "aredoko_photos": {"display_order": 0},
+    "aredoko_objects": {"memo": "", "display_order": 0},
+}
+
+# ON DELETE CASCADE: 親テーブル -> [(子テーブル, 外部キー列)]
+_CASCADES: dict[str, list[tuple[str, str]]] = {
+    "aredoko_warehouses": [("aredoko_photos", "warehouse_id")],
+    "aredoko_photos": [("aredoko_objects", "photo_id")],
+    "aredoko_objects": [("aredoko_object_features", "object_id")],
+}
+
+# 主キーが id 以外のテーブル
+_PRIMARY_KEYS: dict[str, str] = {
+    "aredoko_object_features": "object_id",
+}
+
+
+class _OneOf(tuple):
+    """in_ フィルターの値"""
+
+
+def _matches(value: Any, expected: Any) -> bool:
+    return value in expected if isinstance(expected, _OneOf) else value == expected
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+@dataclass
+class FakeResponse:
+    """postgrestのAPIResponse相当"""
+    data: Any
+    count: Optional[int] = None
+
+
+class FakeQuery:
+    """postgrestのクエリビルダー相当（select/insert/upsert/update/delete + eq/in_/order/limit/range/single）"""
+
+    def __init__(self, db: "FakeDatabase", table: str):
+        self._db = db
+        self._table = table
+        self._operation = "select"
+        self._columns = "*"
+        self._payload: Any = None
+        self._filters: list[tuple[str, Any]] = []
+        self._order: list[tuple[str, bool]] = []
+        self._limit: Optional[int] = None
+        self._offset = 0
+        self._single = False
+
+    def select(self, columns: str = "*", **_: Any) -> "FakeQuery":
+        self._operation = "select"
+        self._columns = columns
+        return self
+
+    def insert(self, payload: Any, **_: Any) -> "FakeQuery":
+        self._operation = "insert"
+        self._payload = payload
+        return self
+
+    def upsert(self, payload: Any, **_: Any) -> "FakeQuery":
+        self._operation = "upsert"
+        self._payload = payload
+        return self
+
+    def update(self, payload: dict, **_: Any) -> "FakeQuery":
+        self._operation = "update"
+        self._payload = payload
+        return self
+
+    def delete(self, **_: Any) -> "FakeQuery":
+        self._operation = "delete"
+        return self
+
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append((column, value))
+        return self
+
+    def in_(self, column: str, values: list) -> "FakeQuery":
+        self._filters.append((column, _OneOf(values)))
+        return self
+
+    def order(self, column: str, desc: bool = False, **_: Any) -> "FakeQuery":
+        self._order.append((column, desc))
+        return self
+
+    def limit(self, size: int, **_: Any) -> "FakeQuery":
+        self._limit = size
+        return self
+
+    def range(self, start: int, end: int) -> "FakeQuery":
+        self._offset = start
+        self._limit = end - start + 1
+        return self
+
+    def single(self) -> "FakeQuery":
+        self._single = True
+        return self
+
+    def execute(self) -> FakeResponse:
+        with self._db.lock:
+            if self._operation == "insert":
+                data = self._db.insert(self._table, self._payload)
+            elif self._operation == "upsert":
+                data = self._db.insert(self._table, self._payload, replace=True)
+            elif self._operation == "update":
+                data = self._db.update(self._table, self._filters, self._payload)
+            elif self._operation == "delete":
+                data = self._db.delete(self._table, self._filters)
+            else:
+                data = self._select()
+
+        if self._single:
+            return FakeResponse(data=data[0] if data else None)
+        return FakeResponse(data=data)
+
+    def _select(self) -> list[dict]:
+        rows = self._db.match(self._table, self._filters)
+        for column, desc in reversed(self._order):
+            rows.sort(key=lambda r: r[column], reverse=desc)
+        rows = rows[self._offset:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        if self._columns.strip() != "*":
+            columns = [c.strip() for c in self._columns.split(",")]
+            rows = [{c: r[c] for c in columns} for r in rows]
+        return copy.deepcopy(rows)
+
+
+class FakeDatabase:
+    """テーブルごとに id -> 行 を保持するインメモリDB"""
+
+    def __init__(self):
+        self.tables: dict[str, dict[str, dict]] = {}
+        self.lock = threading.RLock()
+
+    def match(self, table: str, filters: list[tuple[str, Any]]) -> list[dict]:
+        rows = self.tables.setdefault(table, {}).values()
+        return [r for r in rows if all(_matches(r.get(c), v) for c, v in filters)]
+
+    def insert(self, table: str, payload: Any, replace: bool = False) -> list[dict]:
+        items = payload if isinstance(payload, list) else [payload]
+        key = _PRIMARY_KEYS.get(table, "id")
+        inserted = []
+        for item in items:
+            now = _now()
+            row = {
+                **_DEFAULTS.get(table, {}),
+                "id": str(uuid.uuid4()),
+                "created_at": now,
+                "updated_at": now,
+                "version": 1,
+                **copy.deepcopy(item),
+            }
+            rows = self.tables.setdefault(table, {})
+            if row[key] in rows and not replace:
+                raise ValueError(f"duplicate key value violates unique constraint on {table}.{key}")
+            rows[row[key]] = row
+            inserted.append(copy.deepcopy(row))
+        return inserted
+
+    def update(self, table: str, filters: list[tuple[str, Any]], values: dict) -> list[dict]:
+        updated = []
+        for row in self.match(table, filters):
+            # バージョン自動更新トリガー（aredoko_update_version）相当
+            row.update(copy.deepcopy(values))
+            row["updated_at"] = _now()
+            row["version"] += 1
+            updated.append(copy.deepcopy(row))
+        return updated
+
+    def delete(self, table: str, filters: list[tuple[str, Any]]) -> list[dict]:
+        deleted = []
+        for row in self.match(table, filters):
+            del self.tables[table][row[_PRIMARY_KEYS.get(table, "id")]]
+            deleted.append(row)
+            for child_table, foreign_key in _CASCADES.get(table, []):
+                self.delete(child_table, [(foreign_key, row["id"])])
+        return deleted
+
+
+@dataclass
+class FakeBucket:
+    """storage3のBucket相当"""
+    name: str
+    public: bool = False
+
+
+class FakeBucketApi:
+    """client.storage.from_(bucket) 相当"""
+
+    def __init__(self, storage: "FakeStorage", bucket: str):
+        self._storage = storage
+        self._bucket = bucket
+
+    def upload(self, path: str, file: bytes, file_options: Optional[dict] = None) -> dict:
+        self._storage.objects[(self._bucket, path)] = (bytes(file), dict(file_options or {}))
+        return {"Key": f"{self._bucket}/{path}"}
+
+    def remove(self, paths: list[str]) -> list[dict]:
+        for path in paths:
+            self._storage.objects.pop((self._bucket, path), None)
+        return [{"name": p} for p in paths]
+
+    def download(self, path: str) -> bytes:
+        return self._storage.objects[(self._bucket, path)][0]
+
+    def create_signed_url(self, path: str, expires_in: int, options: Optional[dict] = None) -> dict:
+        url = f"http://fake-storage.local/object/sign/{self._bucket}/{path}?token=fake&expires_in={expires_in}"
+        return {"signedURL": url, "signedUrl": url}
+
+
+class FakeStorage:
+    """client.storage 相当"""
+
+    def __init__(self):
+        self.buckets: dict[str, FakeBucket] = {}
+        # (bucket, path) -> (バイト列, ファイルオプション)
+        self.objects: dict[tuple[str, str], tuple[bytes, dict]] = {}
+
+    def list_buckets(self) -> list[FakeBucket]:
+        return list(self.buckets.values())
+
+    def create_bucket(self, id: str, name: Optional[str] = None, options: Optional[dict] = None) -> None:
+        self.buckets[id] = FakeBucket(name=id, public=bool((options or {}).get("public", False)))
+
+    def update_bucket(self, id: str, options: dict) -> None:
+        self.buckets[id].public = bool(options.get("public", False))
+
+    def from_(self, bucket: str) -> FakeBucketApi:
+        return FakeBucketApi(self, bucket)
+
+
+class FakeRpc:
+    """client.rpc(...) 相当（execute() でストアドファンクションを実行）"""
+
+    def __init__(self, db: FakeDatabase, name: str, params: dict):
+        self._db = db
+        self._name = name
+        self._params = params
+
+    def execute(self) -> FakeResponse:
+        with self._db.lock:
+            return FakeResponse(data=getattr(self, f"_{self._name}")(**self._params))
+
+    def _aredoko_claim_blob(self, p_hash: str, p_lease_seconds: int) -> Optional[str]:
+        blob = self._db.tables.setdefault("aredoko_blobs", {}).get(p_hash)
+        if blob is None:
+            return None
+        started = blob["upload_started_at"]
+        expired = started is not None and (
+            (datetime.now(timezone.utc) - datetime.fromisoformat(started)).total_seconds() > p_lease_seconds
+        )
+        if (blob["status"] == "pending" and started is None) or (blob["status"] in ("pending", "deleting") and expired):
+            if blob["status"] == "deleting":
+                blob["generation"] += 1
+            blob["status"] = "pending"
+            blob["upload_started_at"] = _now()
+            return "upload"
+        return "pending" if blob["status"] == "deleting" else blob["status"]
+
+    def _aredoko_acquire_blob(
+        self, p_hash: str, p_path: str, p_content_type: str, p_size: int, p_lease_seconds: int
+    ) -> str:
+        blobs = self._db.tables.setdefault("aredoko_blobs", {})
+        if p_hash in blobs:
+            blobs[p_hash]["ref_count"] += 1
+            if blobs[p_hash]["status"] in ("pending", "deleting"):
+                return self._aredoko_claim_blob(p_hash, p_lease_seconds)
+            return blobs[p_hash]["status"]
+        blobs[p_hash] = {
+            "hash": p_hash,
+            "path": p_path,
+            "content_type": p_content_type,
+            "size": p_size,
+            "ref_count": 1,
+            "status": "pending",
+            "upload_started_at": _now(),
+            "generation": 0,
+            "created_at": _now(),
+        }
+        return "upload"
+
+    def _aredoko_finish_blob(self, p_hash: str, p_stored: bool) -> None:
+        blob = self._db.tables.setdefault("aredoko_blobs", {}).get(p_hash)
+        if blob is None:
+            return
+        if p_stored:
+            blob["status"] = "ready"
+            blob["upload_started_at"] = None
+        elif blob["status"] == "pending":
+            blob["upload_started_at"] = None
+
+    def _aredoko_release_blob(self, p_hash: str) -> Optional[int]:
+        blob = self._db.tables.setdefault("aredoko_blobs", {}).get(p_hash)
+        if blob is None:
+            return None
+        blob["ref_count"] -= 1
+        if blob["ref_count"] > 0:
+            return None
+        blob["status"] = "deleting"
+        blob["upload_started_at"] = _now()
+        blob["generation"] += 1
+        return blob["generation"]
+
+    def _aredoko_purge_blob(self, p_hash: str, p_generation: int) -> None:
+        blobs = self._db.tables.setdefault("aredoko_blobs", {})
+        blob = blobs.get(p_hash)
+        if blob is None or blob["generation"] != p_generation or blob["status"] != "deleting":
+            return
+        if blob["ref_count"] <= 0:
+            del blobs[p_hash]
+        else:
+            blob["status"] = "pending"
+            blob["upload_started_at"] = None
+
+
+class FakeSupabaseClient:
+    """supabase.Client の代替"""
+
+    def __init__(self):
+        self.db = FakeDatabase()
+        self.storage = FakeStorage()
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self.db, name)
+
+    def rpc(self, name: str, params: Optional[dict] = None) -> FakeRpc:
+        return FakeRpc(self.db, name, params or {})
+
+
+def install(client: Optional[FakeSupabaseClient] = None) -> FakeSupabaseClient:
+    """get_supabase_client() がフェイクを返すように差し替える"""
+    from database import supabase_client
+
+    client = client or FakeSupabaseClient()
+    supabase_client._client = client
+    return client
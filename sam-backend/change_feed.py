@@ -0,0 +1,232 @@
+"""
+倉庫ごとの変更フィード（Server-Sent Events）
+
+他のユーザーの編集に気付くには、これまで一覧の再取得か保存時の 409 VERSION_CONFLICT しかなかった。
+routers/ の作成・更新・削除ハンドラーが小さな差分イベントを発行し、
+GET /api/warehouses/{warehouse_id}/changes を購読しているクライアントに配信する。
+
+イベント（data）:
+    {"entity": "photo", "op": "updated", "id": "...", "version": 3, "changes": {"name": "..."}}
+    - entity: warehouse / photo / object（objectには photo_id も付く）
+    - op: created（changes はレスポンスと同じ全項目）/ updated（変更した項目のみ）/ deleted
+    - resync イベントは取りこぼしがあったことを示す（クライアントは一覧を取り直す）
+
+- 配信はプロセス内のハブ（memory）か、Redisのpub/sub経由（redis、複数ワーカーで共有）
+- イベントIDは「プロセスID-連番」。再接続時の Last-Event-ID が同じプロセスの直近の履歴にあれば
+  続きから再送し、なければ resync を送る
+- 送信が追いつかない購読者は、未送信イベントを捨てて resync を送る
+"""
+
+import asyncio
+import itertools
+import uuid
+from collections import deque
+from typing import Optional
+
+import orjson
+
+from config import (
+    CHANGE_FEED_BACKEND,
+    CHANGE_FEED_HISTORY,
+    CHANGE_FEED_QUEUE_SIZE,
+    CHANGE_FEED_REDIS_URL,
+)
+from metrics import CHANGE_EVENTS_TOTAL
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Redisのチャンネル名の接頭辞（後ろに倉庫IDが付く）
+_CHANNEL_PREFIX = "aredoko:changes:"
+
+# 取りこぼしの印
+RESYNC = {"entity": None, "op": "resync"}
+
+
+class Subscription:
+    """1つのSSE接続の購読（未送信イベントのキュー）"""
+
+    def __init__(self, hub: "ChangeHub", warehouse_id: str, max_queue: int):
+        self.hub = hub
+        self.warehouse_id = warehouse_id
+        self._queue: asyncio.Queue[tuple[Optional[str], dict]] = asyncio.Queue(max_queue)
+
+    def offer(self, event_id: Optional[str], event: dict) -> None:
+        """イベントを追加（キューが満杯なら未送信イベントを捨てて resync にする）"""
+        try:
+            self._queue.put_nowait((event_id, event))
+        except asyncio.QueueFull:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait((None, RESYNC))
+
+    async def get(self) -> tuple[Optional[str], dict]:
+        """次のイベント (イベントID, イベント) を待つ"""
+        return await self._queue.get()
+
+    def close(self) -> None:
+        self.hub.unsubscribe(self)
+
+
+class ChangeHub:
+    """プロセス内のpub/subハブ（倉庫ごとに購読者と直近の履歴を持つ）"""
+
+    def __init__(self, history: int = 256, max_queue: int = 256):
+        """
+        Args:
+            history: 再接続時に再送できる倉庫ごとのイベント数
+            max_queue: 購読者ごとの未送信イベントの上限
+        """
+        self.history = history
+        self.max_queue = max_queue
+        # イベントIDの接頭辞（別プロセス・再起動後のIDと区別する）
+        self._process_id = uuid.uuid4().hex[:8]
+        self._sequence = itertools.count(1)
+        self._subscribers: dict[str, set[Subscription]] = {}
+        self._histories: dict[str, deque[tuple[int, dict]]] = {}
+
+    def publish(self, warehouse_id: str, event: dict) -> None:
+        """イベントを配信（イベントループ上から呼ぶ）"""
+        self._deliver(warehouse_id, event)
+
+    def subscribe(self, warehouse_id: str, last_event_id: Optional[str] = None) -> Subscription:
+        """
+        倉庫の変更を購読
+
+        Args:
+            warehouse_id: 倉庫ID
+            last_event_id: 再接続時の Last-Event-ID（続きから再送する）
+        """
+        subscription = Subscription(self, warehouse_id, self.max_queue)
+        self._subscribers.setdefault(warehouse_id, set()).add(subscription)
+        if last_event_id:
+            self._replay(subscription, last_event_id)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.warehouse_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.warehouse_id]
+
+    def subscriber_count(self) -> int:
+        return sum(len(s) for s in self._subscribers.values())
+
+    def _deliver(self, warehouse_id: str, event: dict) -> None:
+        """このプロセスの購読者に配信し、履歴に残す"""
+        sequence = next(self._sequence)
+        history = self._histories.setdefault(warehouse_id, deque(maxlen=self.history))
+        history.append((sequence, event))
+        event_id = f"{self._process_id}-{sequence}"
+        for subscription in tuple(self._subscribers.get(warehouse_id, ())):
+            subscription.offer(event_id, event)
+
+    def _replay(self, subscription: Subscription, last_event_id: str) -> None:
+        """Last-Event-ID より後のイベントを再送（続きが分からない場合は resync）"""
+        process_id, _, sequence = last_event_id.partition("-")
+        history = self._histories.get(subscription.warehouse_id, ())
+        if process_id != self._process_id or not sequence.isdigit():
+            subscription.offer(None, RESYNC)
+            return
+        last = int(sequence)
+        if history and history[0][0] > last + 1:
+            # 履歴より前のイベントを取りこぼしている
+            subscription.offer(None, RESYNC)
+            return
+        for seq, event in history:
+            if seq > last:
+                subscription.offer(f"{self._process_id}-{seq}", event)
+
+
+class RedisChangeHub(ChangeHub):
+    """Redisのpub/sub経由で全ワーカーの購読者に配信するハブ"""
+
+    def __init__(self, url: str, history: int = 256, max_queue: int = 256):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("CHANGE_FEED_BACKEND=redis requires the redis package")
+        super().__init__(history, max_queue)
+        self._redis = aioredis.Redis.from_url(url)
+        self._listener: Optional[asyncio.Task] = None
+        self._pending: set[asyncio.Task] = set()
+
+    def publish(self, warehouse_id: str, event: dict) -> None:
+        # 自プロセスの購読者にもRedis経由で届く（全ワーカーで同じ順序になる）
+        self._ensure_listener()
+        task = asyncio.get_running_loop().create_task(
+            self._redis.publish(_CHANNEL_PREFIX + warehouse_id, orjson.dumps(event))
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def subscribe(self, warehouse_id: str, last_event_id: Optional[str] = None) -> Subscription:
+        self._ensure_listener()
+        return super().subscribe(warehouse_id, last_event_id)
+
+    def _ensure_listener(self) -> None:
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self) -> None:
+        pubsub = self._redis.pubsub()
+        await pubsub.psubscribe(_CHANNEL_PREFIX + "*")
+        async for message in pubsub.listen():
+            if message["type"] != "pmessage":
+                continue
+            warehouse_id = message["channel"].decode()[len(_CHANNEL_PREFIX):]
+            self._deliver(warehouse_id, orjson.loads(message["data"]))
+
+
+_hub: Optional[ChangeHub] = None
+
+
+def get_change_hub() -> ChangeHub:
+    """設定に応じた変更フィードのハブを取得（シングルトン）"""
+    global _hub
+    if _hub is None:
+        if CHANGE_FEED_BACKEND == "memory":
+            _hub = ChangeHub(CHANGE_FEED_HISTORY, CHANGE_FEED_QUEUE_SIZE)
+        elif CHANGE_FEED_BACKEND == "redis":
+            _hub = RedisChangeHub(CHANGE_FEED_REDIS_URL, CHANGE_FEED_HISTORY, CHANGE_FEED_QUEUE_SIZE)
+        else:
+            raise ValueError(f"Unknown change feed backend: {CHANGE_FEED_BACKEND}")
+    return _hub
+
+
+def publish_change(
+    warehouse_id: str,
+    entity: str,
+    op: str,
+    entity_id: str,
+    version: Optional[int] = None,
+    changes: Optional[dict] = None,
+    **parents: str,
+) -> None:
+    """
+    変更イベントを発行
+
+    Args:
+        warehouse_id: 配信先の倉庫ID
+        entity: "warehouse" / "photo" / "object"
+        op: "created" / "updated" / "deleted"
+        entity_id: 変更した行のID
+        version: 変更後のversion（deleted では省略）
+        changes: created では全項目、updated では変更した項目
+        parents: 親のID（例: photo_id）
+    """
+    event = {"entity": entity, "op": op, "id": entity_id, **parents}
+    if version is not None:
+        event["version"] = version
+    if changes is not None:
+        event["changes"] = changes
+    CHANGE_EVENTS_TOTAL.labels(entity=entity, op=op).inc()
+    get_change_hub().publish(warehouse_id, event)
+
+
+def format_sse(event_id: Optional[str], event: dict) -> bytes:
+    """Server-Sent Eventsの1イベント（イベント名は op）"""
+    head = b"id: " + event_id.encode() + b"\n" if event_id else b""
+    return head + b"event: " + event["op"].encode() + b"\ndata: " + orjson.dumps(event) + b"\n\n"
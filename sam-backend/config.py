@@ -9,3 +9,94 @@ load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "http://127.0.0.1:54521")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+
+# 画像ストレージ: "supabase"（Supabase Storage）または "local"（ローカルディスク）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+# ローカルストレージの保存先
+LOCAL_STORAGE_DIR = os.getenv(
+    "LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(__file__), "storage")
+)
+# ローカルストレージの画像URLのベース（このバックエンドの公開URL）
+STORAGE_PUBLIC_BASE_URL = os.getenv("STORAGE_PUBLIC_BASE_URL", "http://localhost:8000")
+# ローカルストレージの署名付きURL用の秘密鍵（複数ワーカーでは必ず共通の値を設定する）
+STORAGE_SIGNING_SECRET = os.getenv("STORAGE_SIGNING_SECRET", "")
+
+# SAM推論キューの上限（待機中のリクエスト数。超えた場合は429を返す）
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "32"))
+# 推論の期限（秒）。キューで期限を過ぎたリクエストは推論せずに破棄する
+INFERENCE_DEADLINE_SECONDS = float(os.getenv("INFERENCE_DEADLINE_SECONDS", "30"))
+BACKGROUND_DEADLINE_SECONDS = float(os.getenv("BACKGROUND_DEADLINE_SECONDS", "300"))
+
+# プレビュー（通常のセグメンテーション）に使うモデル（vit_b / vit_l / vit_h）
+SAM_MODEL_TYPE = os.getenv("SAM_MODEL_TYPE", "vit_b")
+
+# 段階的セグメンテーションで再推論に使う高精度モデル（例: vit_h）。空の場合は無効
+SAM_REFINE_MODEL_TYPE = os.getenv("SAM_REFINE_MODEL_TYPE", "")
+
+# WebSocketセグメンテーションセッションの無操作タイムアウト（秒）
+WS_SESSION_IDLE_SECONDS = float(os.getenv("WS_SESSION_IDLE_SECONDS", "300"))
+
+# 推論ワーカープロセス数（0の場合はAPIと同じプロセスで推論する）
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))
+# ワーカーごとのPyTorchのスレッド数（0の場合はCPUコア数 / INFERENCE_WORKERS）
+INFERENCE_THREADS_PER_WORKER = int(os.getenv("INFERENCE_THREADS_PER_WORKER", "0"))
+
+# サーバー側で生成するオブジェクトのクリップ画像の形式（"webp" または "png"）と最大辺の長さ
+CLIP_IMAGE_FORMAT = os.getenv("CLIP_IMAGE_FORMAT", "webp")
+CLIP_MAX_SIZE = int(os.getenv("CLIP_MAX_SIZE", "512"))
+# WebPの画質（1〜100）
+CLIP_WEBP_QUALITY = int(os.getenv("CLIP_WEBP_QUALITY", "85"))
+
+# エンティティ（倉庫・写真・オブジェクト）の読み込みキャッシュ: "memory"（プロセス内）, "redis"（ワーカー間で共有）, "none"（無効）
+ENTITY_CACHE_BACKEND = os.getenv("ENTITY_CACHE_BACKEND", "memory")
+ENTITY_CACHE_REDIS_URL = os.getenv("ENTITY_CACHE_REDIS_URL", "redis://localhost:6379/0")
+# プロセス内キャッシュの最大件数
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "10000"))
+# エンティティごとの有効期限（秒）。0の場合はキャッシュしない
+ENTITY_CACHE_TTLS = {
+    "warehouse": float(os.getenv("ENTITY_CACHE_TTL_WAREHOUSE", "300")),
+    "photo": float(os.getenv("ENTITY_CACHE_TTL_PHOTO", "120")),
+    "object": float(os.getenv("ENTITY_CACHE_TTL_OBJECT", "60")),
+}
+
+# 変更フィード（SSE）の配信: "memory"（プロセス内）または "redis"（複数ワーカーで共有）
+CHANGE_FEED_BACKEND = os.getenv("CHANGE_FEED_BACKEND", "memory")
+CHANGE_FEED_REDIS_URL = os.getenv("CHANGE_FEED_REDIS_URL", ENTITY_CACHE_REDIS_URL)
+# 再接続時に再送できる倉庫ごとのイベント数
+CHANGE_FEED_HISTORY = int(os.getenv("CHANGE_FEED_HISTORY", "256"))
+# 購読者ごとの未送信イベントの上限（超えた場合は resync を送って再取得させる）
+CHANGE_FEED_QUEUE_SIZE = int(os.getenv("CHANGE_FEED_QUEUE_SIZE", "256"))
+
+# 写真の一括登録: 並列処理数・DBへの一括挿入の件数
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "20"))
+# 保存する写真の最大辺の長さ（超える場合は縮小）とJPEGの画質
+INGEST_MAX_DIMENSION = int(os.getenv("INGEST_MAX_DIMENSION", "4096"))
+INGEST_JPEG_QUALITY = int(os.getenv("INGEST_JPEG_QUALITY", "90"))
+# 1ファイルあたりの最大サイズ（バイト、ZIP内のファイルは展開後のサイズ）
+INGEST_MAX_FILE_BYTES = int(os.getenv("INGEST_MAX_FILE_BYTES", str(50 * 1024 * 1024)))
+
+# 類似検索: IVF（分割）モードに切り替える件数（倉庫・特徴の種類ごと）と、検索する分割の数
+SIMILARITY_IVF_THRESHOLD = int(os.getenv("SIMILARITY_IVF_THRESHOLD", "8192"))
+SIMILARITY_IVF_PROBES = int(os.getenv("SIMILARITY_IVF_PROBES", "8"))
+# プロセス内の索引をDBから読み直す間隔（秒、他のワーカーで登録したオブジェクトを反映する）
+SIMILARITY_INDEX_TTL = float(os.getenv("SIMILARITY_INDEX_TTL", "300"))
+# 1回の検索で返す最大件数
+SIMILARITY_MAX_RESULTS = int(os.getenv("SIMILARITY_MAX_RESULTS", "50"))
+
+# 管理用API（/api/admin/*）のトークン。未設定の場合は管理用APIを無効にする（404）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# 遅いリクエストの記録: この秒数を超えたリクエストの段階ごとの時間を残す（0の場合は記録しない）と、残す件数
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2.0"))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", "50"))
+# cProfileで計測するリクエストの割合（0〜1、同時に1リクエストまで）。遅かった場合だけ記録に添付する
+SLOW_REQUEST_PROFILE_RATE = float(os.getenv("SLOW_REQUEST_PROFILE_RATE", "0"))
+# サンプリングプロファイラの最長の計測時間（秒）
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# メモリ予算: プロセスごとに画像・埋め込み・マスクに使う上限（MB）。0の場合は
+# コンテナのメモリ上限（なければ物理メモリ）の MEMORY_BUDGET_RATIO を、推論ワーカーを含むプロセス数で割った値
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_BUDGET_RATIO = float(os.getenv("MEMORY_BUDGET_RATIO", "0.6"))
+# 予算が足りない場合に縮小してデコードする画像の最大辺（JPEGのみ）
+MEMORY_DOWNSCALE_MAX_SIDE = int(os.getenv("MEMORY_DOWNSCALE_MAX_SIDE", "2048"))
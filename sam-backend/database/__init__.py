@@ -1,3 +1,4 @@
 from .supabase_client import get_supabase_client
+from .entity_cache import get_entity_cache
 
-__all__ = ["get_supabase_client"]
+__all__ = ["get_supabase_client", "get_entity_cache"]
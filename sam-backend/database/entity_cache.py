@@ -0,0 +1,212 @@
+"""
+倉庫・写真・オブジェクトの読み込みキャッシュ（リードスルー）
+
+get_* や更新・削除前の読み込みは id による1行の取得なので、ここでキャッシュして
+Supabaseへの往復を減らす。
+
+- エンティティごとに有効期限を設定（config.ENTITY_CACHE_TTLS）
+- 行は version 付きで保持し、古い version で新しい行を上書きしない
+  （更新前に読み込んだ遅いリクエストが、更新後の行を古い行で戻さないように）
+- 作成・更新したハンドラーは新しい行を書き込み、削除したハンドラーは削除済みの印を書き込む
+- バックエンドはプロセス内（memory）またはRedis（redis、複数ワーカーで共有）
+  プロセス内の場合、他のワーカーの更新は有効期限まで反映されない。
+  楽観的ロックの確認は、キャッシュのversionが一致しなければDBから読み直して行う
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+import orjson
+
+from config import (
+    ENTITY_CACHE_BACKEND,
+    ENTITY_CACHE_MAX_ENTRIES,
+    ENTITY_CACHE_REDIS_URL,
+    ENTITY_CACHE_TTLS,
+)
+from metrics import ENTITY_CACHE_TOTAL, track_supabase
+from .supabase_client import get_supabase_client
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# エンティティ -> テーブル
+ENTITY_TABLES = {
+    "warehouse": "aredoko_warehouses",
+    "photo": "aredoko_photos",
+    "object": "aredoko_objects",
+}
+
+# 削除済みの印のversion（どの行のversionよりも大きい）
+_DELETED_VERSION = 2 ** 62
+_DELETED = b"null"
+
+
+class EntityCacheBackend(ABC):
+    """キャッシュの保存先の共通インターフェース（値はシリアライズ済みのバイト列）"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """値を取得（存在しない・期限切れの場合は None）"""
+
+    @abstractmethod
+    def put_if_newer(self, key: str, version: int, value: bytes, ttl: float) -> None:
+        """保持している値より version が古くなければ保存"""
+
+
+class MemoryEntityCacheBackend(EntityCacheBackend):
+    """プロセス内のLRUキャッシュ"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # キー -> (期限, version, 値)
+        self._entries: OrderedDict[str, tuple[float, int, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put_if_newer(self, key: str, version: int, value: bytes, ttl: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= now and entry[1] > version:
+                return
+            self._entries[key] = (now + ttl, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RedisEntityCacheBackend(EntityCacheBackend):
+    """Redis（複数ワーカーで共有）。値は "version:JSON" 形式で保存"""
+
+    # version の比較と保存を1回の往復・原子的に行う
+    _PUT_IF_NEWER = """
+local current = redis.call('GET', KEYS[1])
+if current then
+  local version = tonumber(string.match(current, '^(%d+):'))
+  if version and version > tonumber(ARGV[1]) then
+    return 0
+  end
+end
+redis.call('SET', KEYS[1], ARGV[1] .. ':' .. ARGV[2], 'PX', ARGV[3])
+return 1
+"""
+
+    def __init__(self, url: str):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("ENTITY_CACHE_BACKEND=redis requires the redis package")
+        self._redis = redis.Redis.from_url(url)
+        self._put_if_newer = self._redis.register_script(self._PUT_IF_NEWER)
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._redis.get(key)
+        if value is None:
+            return None
+        return value.partition(b":")[2]
+
+    def put_if_newer(self, key: str, version: int, value: bytes, ttl: float) -> None:
+        self._put_if_newer(keys=[key], args=[version, value, int(ttl * 1000)])
+
+
+class EntityCache:
+    """エンティティの読み込みキャッシュ"""
+
+    def __init__(self, backend: Optional[EntityCacheBackend], ttls: dict[str, float]):
+        """
+        Args:
+            backend: 保存先（None の場合はキャッシュせず常にDBから読み込む）
+            ttls: エンティティごとの有効期限（秒）
+        """
+        self.backend = backend
+        self.ttls = ttls
+
+    def _enabled(self, entity: str) -> bool:
+        return self.backend is not None and self.ttls.get(entity, 0) > 0
+
+    @staticmethod
+    def _key(entity: str, entity_id: str) -> str:
+        return f"aredoko:entity:{entity}:{entity_id}"
+
+    def get(self, entity: str, entity_id: str, fresh: bool = False) -> Optional[dict]:
+        """
+        id で1行を取得（キャッシュになければDBから読み込んで保存）
+
+        Args:
+            entity: "warehouse" / "photo" / "object"
+            entity_id: id
+            fresh: True の場合はキャッシュを使わずDBから読み込む（結果はキャッシュに保存）
+
+        Returns:
+            行（存在しない場合は None）
+        """
+        if not self._enabled(entity):
+            return self._load(entity, entity_id)
+
+        if not fresh:
+            cached = self.backend.get(self._key(entity, entity_id))
+            ENTITY_CACHE_TOTAL.labels(entity=entity, result="hit" if cached is not None else "miss").inc()
+            if cached is not None:
+                return orjson.loads(cached)
+
+        row = self._load(entity, entity_id)
+        if row is not None:
+            self.put(entity, row)
+        return row
+
+    def put(self, entity: str, row: dict) -> None:
+        """作成・更新・読み込みした行を保存（保持している行より古い version は無視）"""
+        if self._enabled(entity):
+            self.backend.put_if_newer(
+                self._key(entity, row["id"]), row["version"], orjson.dumps(row), self.ttls[entity]
+            )
+
+    def invalidate(self, entity: str, *entity_ids: str) -> None:
+        """削除した行に削除済みの印を付ける（削除前に読み込んだ行で復活させない）"""
+        if self._enabled(entity):
+            for entity_id in entity_ids:
+                self.backend.put_if_newer(
+                    self._key(entity, entity_id), _DELETED_VERSION, _DELETED, self.ttls[entity]
+                )
+
+    @staticmethod
+    def _load(entity: str, entity_id: str) -> Optional[dict]:
+        table = ENTITY_TABLES[entity]
+        client = get_supabase_client()
+        with track_supabase(table, "select"):
+            response = client.table(table).select("*").eq("id", entity_id).single().execute()
+        return response.data or None
+
+
+_cache: Optional[EntityCache] = None
+
+
+def get_entity_cache() -> EntityCache:
+    """設定に応じたエンティティキャッシュを取得（シングルトン）"""
+    global _cache
+    if _cache is None:
+        if ENTITY_CACHE_BACKEND == "memory":
+            backend = MemoryEntityCacheBackend(ENTITY_CACHE_MAX_ENTRIES)
+        elif ENTITY_CACHE_BACKEND == "redis":
+            backend = RedisEntityCacheBackend(ENTITY_CACHE_REDIS_URL)
+        elif ENTITY_CACHE_BACKEND == "none":
+            backend = None
+        else:
+            raise ValueError(f"Unknown entity cache backend: {ENTITY_CACHE_BACKEND}")
+        _cache = EntityCache(backend, ENTITY_CACHE_TTLS)
+    return _cache
@@ -0,0 +1,272 @@
+"""
+SAM推論ワーカープロセスのプール
+
+uvicornプロセス内のSAMServiceは1件ずつしか推論できない。INFERENCE_WORKERS を指定すると、
+N個の推論専用プロセスを起動してマルチコアで並列に推論する。
+
+- モデルの重みは親プロセスで1回だけロードしてからforkする（コピーオンライトで共有）
+  CUDA使用時はforkできないため、各ワーカーが個別にロードする（spawn）
+- 画像ダイジェストのコンシステントハッシュでワーカーを選ぶ
+  同じ画像は常に同じワーカーに送られるので、ワーカーごとの埋め込みキャッシュが効く
+  （mask_idも画像ダイジェストの先頭を引き継ぐので、再調整も同じワーカーに届く）
+- 画像全体のメソッド（prepare_image, segment など）は、まず画像の大きさだけを送る。
+  ワーカーに埋め込みがなかった場合だけ画素を送り直す（4096x4096のRGBで48MBをクリックごとにpickleしない）
+- ワーカー内で計測した処理段階の時間は親プロセスのメトリクスに反映する
+"""
+
+import bisect
+import functools
+import hashlib
+import inspect
+import multiprocessing
+import os
+import sys
+import threading
+from typing import Any, Optional
+
+import numpy as np
+
+from metrics import record_stage, start_request_timing
+from sam_service import SAM_AVAILABLE, SAMService
+
+# ルーティングに使うキーの長さ（画像ダイジェストとmask_idの共通の先頭）
+ROUTING_KEY_LENGTH = 16
+
+# 画像全体の埋め込みがあれば画像の大きさしか使わないメソッド（引数 image, image_key を持つ）
+# タイルモードは切り出した画像のタイルごとに埋め込みを持つため、常に画素を送る
+_KEYED_IMAGE_METHODS = {"prepare_image", "segment", "segment_with_prompts", "segment_with_lasso", "refine_mask"}
+
+
+class _ImageShape:
+    """画素の代わりに送る画像の大きさ（ワーカーに image_key の埋め込みがある場合だけ使える）"""
+
+    __slots__ = ("image_key", "shape", "dtype")
+
+    def __init__(self, image_key: str, image: np.ndarray):
+        self.image_key = image_key
+        self.shape = image.shape
+        self.dtype = image.dtype
+
+    def placeholder(self) -> np.ndarray:
+        # 画素を確保しないビュー（大きさだけを参照するメソッドに渡す）
+        return np.broadcast_to(np.zeros((), dtype=self.dtype), self.shape)
+
+
+@functools.lru_cache(maxsize=None)
+def _signature(method: str) -> inspect.Signature:
+    return inspect.signature(getattr(SAMService, method))
+
+
+def _without_pixels(method: str, args: tuple, kwargs: dict) -> Optional[tuple]:
+    """画素を画像の大きさに置き換えた呼び出し（置き換えられない場合は None）"""
+    if method not in _KEYED_IMAGE_METHODS:
+        return None
+    bound = _signature(method).bind(None, *args, **kwargs)
+    image = bound.arguments.get("image")
+    image_key = bound.arguments.get("image_key")
+    if image is None or image_key is None:
+        return None
+    bound.arguments["image"] = _ImageShape(image_key, image)
+    return method, bound.args[1:], bound.kwargs
+
+
+def _resolve_pixels(service: SAMService, args: tuple, kwargs: dict) -> Optional[tuple[tuple, dict]]:
+    """画像の大きさを画素なしのビューに戻す（埋め込みがなく画素が必要な場合は None）"""
+    resolved = []
+    for value in (*args, *kwargs.values()):
+        if isinstance(value, _ImageShape):
+            if not service.has_image(value.image_key):
+                return None
+            value = value.placeholder()
+        resolved.append(value)
+    return tuple(resolved[:len(args)]), dict(zip(kwargs, resolved[len(args):]))
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """コンシステントハッシュ（仮想ノード付き）"""
+
+    def __init__(self, nodes: int, replicas: int = 64):
+        points = sorted((_hash(f"{node}:{r}"), node) for node in range(nodes) for r in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str) -> int:
+        """キーを担当するノードの番号"""
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+def _worker_main(conn, model_type: str, threads: int, service: Optional[SAMService]) -> None:
+    """ワーカープロセス: (メソッド名, args, kwargs) を受け取ってSAMServiceで実行する"""
+    if SAM_AVAILABLE and threads > 0:
+        import torch
+        torch.set_num_threads(threads)
+    if service is None:
+        service = SAMService(model_type=model_type)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        method, args, kwargs = message
+        timings = start_request_timing()
+        try:
+            resolved = _resolve_pixels(service, args, kwargs)
+            if resolved is None:
+                # 埋め込みがない: 呼び出し元に画素を付けて送り直してもらう
+                conn.send((None, None, timings))
+                continue
+            result = getattr(service, method)(*resolved[0], **resolved[1])
+        except Exception as e:
+            conn.send((False, e, timings))
+        else:
+            conn.send((True, result, timings))
+
+
+class _Worker:
+    """ワーカープロセス1つへの接続（同時に1件ずつ呼び出す）"""
+
+    def __init__(self, pool: "InferencePool", index: int):
+        self.pool = pool
+        self.index = index
+        self._lock = threading.Lock()
+        self._conn = None
+        self._process = None
+        self._stopped = False
+
+    def start(self, service: Optional[SAMService]) -> None:
+        parent_conn, child_conn = self.pool.context.Pipe()
+        self._process = self.pool.context.Process(
+            target=_worker_main,
+            args=(child_conn, self.pool.model_type, self.pool.threads, service),
+            name=f"sam-worker-{self.index}",
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        """ワーカーでSAMServiceのメソッドを実行（呼び出し元のスレッドをブロック）"""
+        message = (method, args, kwargs)
+        light = _without_pixels(method, args, kwargs)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError(f"Inference worker {self.index} is stopped")
+            try:
+                self._conn.send(light or message)
+                ok, payload, timings = self._conn.recv()
+                if ok is None:
+                    # ワーカーに埋め込みがなかった（同じロックの中で送り直すので、間に他の呼び出しは入らない）
+                    self._conn.send(message)
+                    ok, payload, more_timings = self._conn.recv()
+                    timings = timings + more_timings
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                # ワーカーが異常終了した: 作り直して（埋め込みキャッシュは空になる）エラーを返す
+                print(f"Inference worker {self.index} died. Restarting...")
+                self.start(None)
+                raise RuntimeError(f"Inference worker {self.index} died")
+
+        for stage, elapsed in timings:
+            record_stage(stage, elapsed)
+        if not ok:
+            raise payload
+        return payload
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped = True
+            try:
+                self._conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+
+
+class RemoteSAMService:
+    """ワーカープロセス上のSAMServiceを、同じメソッド名で呼び出すためのプロキシ"""
+
+    def __init__(self, worker: _Worker, model_type: str, loaded: bool):
+        self._worker = worker
+        self.model_type = model_type
+        self._loaded = loaded
+
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def __getattr__(self, method: str):
+        def call(*args, **kwargs):
+            return self._worker.call(method, *args, **kwargs)
+        return call
+
+
+class InferencePool:
+    """推論ワーカープロセスのプール"""
+
+    def __init__(self, workers: int, model_type: str = "vit_b", threads: Optional[int] = None):
+        """
+        Args:
+            workers: ワーカープロセス数
+            model_type: モデルタイプ
+            threads: ワーカーごとのPyTorchのスレッド数（省略時はCPUコア数 / workers）
+        """
+        self.model_type = model_type
+        self.threads = threads if threads is not None else max(1, (os.cpu_count() or 1) // workers)
+        self.context = multiprocessing.get_context("fork" if self._can_fork() else "spawn")
+        self._workers = [_Worker(self, i) for i in range(workers)]
+        self._services: list[RemoteSAMService] = []
+        self._ring = HashRing(workers)
+
+    @staticmethod
+    def _can_fork() -> bool:
+        """モデルをロードしてからforkできるか（CUDA初期化後のforkは不可）"""
+        if sys.platform == "win32":
+            return False
+        if SAM_AVAILABLE:
+            import torch
+            return not torch.cuda.is_available()
+        return True
+
+    def start(self) -> None:
+        """ワーカーを起動（forkできる場合はモデルを1回だけロードしてから共有）"""
+        template = SAMService(model_type=self.model_type) if self.context.get_start_method() == "fork" else None
+        for worker in self._workers:
+            worker.start(template)
+        # 親プロセスは重みを参照しない（ワーカー側のページはそのまま共有される）
+        del template
+
+        loaded = self._workers[0].call("is_loaded")
+        self._services = [RemoteSAMService(w, self.model_type, loaded) for w in self._workers]
+        print(f"Started {len(self._workers)} inference workers ({self.context.get_start_method()}, "
+              f"{self.threads} threads each)")
+
+    def stop(self) -> None:
+        for worker in self._workers:
+            worker.stop()
+
+    def index(self, key: Optional[str]) -> int:
+        """キー（画像ダイジェストまたはmask_id）を担当するワーカーの番号"""
+        if not key:
+            return 0
+        return self._ring.node_for(key[:ROUTING_KEY_LENGTH])
+
+    def route(self, key: Optional[str]) -> RemoteSAMService:
+        """キー（画像ダイジェストまたはmask_id）を担当するワーカー"""
+        return self._services[self.index(key)]
+
+    def size(self) -> int:
+        return len(self._workers)
+
+    def memory_usage(self) -> list[dict]:
+        """ワーカーごとのメモリ予算の使用量"""
+        return [service.memory_usage() for service in self._services]
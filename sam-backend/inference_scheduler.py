@@ -0,0 +1,193 @@
+"""
+推論スケジューラ（アドミッション制御と優先度キュー）
+
+SAMServiceは1件ずつしか推論できないため、推論リクエストをここで順番待ちさせる。
+
+- 優先度: 対話的な操作（クリック・投げ縄）を、バックグラウンド処理（埋め込みの事前計算など）より先に処理
+- キューの上限を超えたリクエストは待たせずに QueueFullError（APIでは 429 + Retry-After）
+- バックグラウンド処理はキューの一部しか使えない（対話的な操作の枠を残す）
+- 期限を過ぎたリクエストは推論せずに DeadlineExceededError で破棄
+- 推論ワーカープロセス（INFERENCE_WORKERS）ごとにレーンを分ける。各ワーカーは1件ずつしか
+  推論できないので、レーンごとに1件ずつ取り出す（同じワーカー宛ての推論が複数の枠を塞いで、
+  他のワーカーを遊ばせないように）。キューの上限はレーン全体で共有する
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import time
+from typing import Callable, Optional, TypeVar
+
+from fastapi.concurrency import run_in_threadpool
+
+from metrics import INFERENCE_QUEUE_WAIT_SECONDS, INFERENCE_REJECTED_TOTAL
+
+T = TypeVar("T")
+
+# 優先度（小さいほど先に処理）
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# 推論1件の完了後にイベントループへ制御を返す回数
+# （エンコード完了を待っていた呼び出し元が、次のジョブを取り出す前にデコードを投入できるように）
+_HANDOFF_YIELDS = 3
+
+
+class QueueFullError(Exception):
+    """推論キューが満杯"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """推論を開始する前に期限を過ぎた"""
+
+
+class _Job:
+    """キュー内の推論1件"""
+
+    __slots__ = ("fn", "deadline", "future", "context", "enqueued_at")
+
+    def __init__(self, fn: Callable, deadline: float, future: asyncio.Future):
+        self.fn = fn
+        self.deadline = deadline
+        self.future = future
+        # Server-Timingなどのリクエスト単位のコンテキストを推論スレッドに引き継ぐ
+        self.context = contextvars.copy_context()
+        self.enqueued_at = time.monotonic()
+
+
+class InferenceScheduler:
+    """上限付きの優先度キューで推論を順番に実行する"""
+
+    def __init__(self, max_queue: int = 32, background_share: float = 0.5, workers: int = 1):
+        """
+        Args:
+            max_queue: 待機できるリクエスト数の上限（実行中を除く、全レーンの合計）
+            background_share: バックグラウンド処理が使えるキューの割合
+            workers: レーンの数（推論ワーカーの数。レーンごとに1件ずつ実行する）
+        """
+        self.max_queue = max_queue
+        self.max_background = max(1, int(max_queue * background_share))
+        self.workers = workers
+        self._heaps: list[list[tuple[int, int, _Job]]] = [[] for _ in range(workers)]
+        self._counter = itertools.count()
+        self._queued = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._running = [0] * workers
+        # 推論1件あたりの処理時間の指数移動平均（Retry-Afterの見積もり用）
+        self._service_time = 0.5
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeups: list[asyncio.Event] = []
+        self._worker_tasks: list[asyncio.Task] = []
+
+    async def submit(
+        self,
+        fn: Callable[[], T],
+        priority: int = INTERACTIVE,
+        deadline: Optional[float] = None,
+        lane: int = 0,
+    ) -> T:
+        """
+        推論をキューに入れ、実行結果を待つ
+
+        Args:
+            fn: スレッドプールで実行する推論処理
+            priority: INTERACTIVE または BACKGROUND
+            deadline: 期限（time.monotonic() 基準）。None の場合は期限なし
+            lane: 推論を実行するワーカーの番号（レーン数で割った余りを使う）
+
+        Raises:
+            QueueFullError: キューが満杯
+            DeadlineExceededError: 推論を開始する前に期限を過ぎた
+        """
+        self._ensure_workers()
+        lane %= self.workers
+
+        queued = sum(self._queued.values())
+        if queued >= self.max_queue or (
+            priority == BACKGROUND and self._queued[BACKGROUND] >= self.max_background
+        ):
+            INFERENCE_REJECTED_TOTAL.labels(priority=PRIORITY_NAMES[priority], reason="queue_full").inc()
+            raise QueueFullError(self.retry_after(lane))
+
+        job = _Job(fn, deadline if deadline is not None else math.inf, self._loop.create_future())
+        heapq.heappush(self._heaps[lane], (priority, next(self._counter), job))
+        self._queued[priority] += 1
+        self._wakeups[lane].set()
+        return await job.future
+
+    def retry_after(self, lane: Optional[int] = None) -> int:
+        """キュー（lane を指定した場合はそのレーン）が空くまでの見積もり秒数（1〜60秒）"""
+        if lane is None:
+            pending = sum(len(heap) for heap in self._heaps) + sum(self._running)
+            estimate = pending * self._service_time / self.workers
+        else:
+            lane %= self.workers
+            estimate = (len(self._heaps[lane]) + self._running[lane]) * self._service_time
+        return min(60, max(1, math.ceil(estimate)))
+
+    def stats(self) -> dict:
+        """キューの状態"""
+        return {
+            "queued": {PRIORITY_NAMES[p]: n for p, n in self._queued.items()},
+            "running": sum(self._running),
+            "lanes": [{"queued": len(heap), "running": running} for heap, running in zip(self._heaps, self._running)],
+            "max_queue": self.max_queue,
+            "service_time_seconds": round(self._service_time, 4),
+        }
+
+    def _ensure_workers(self) -> None:
+        """実行中のイベントループ上でワーカーを起動（ループが変わった場合は作り直す）"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._heaps = [[] for _ in range(self.workers)]
+        self._queued = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._running = [0] * self.workers
+        self._wakeups = [asyncio.Event() for _ in range(self.workers)]
+        self._worker_tasks = [loop.create_task(self._worker(lane)) for lane in range(self.workers)]
+
+    async def _worker(self, lane: int) -> None:
+        heap = self._heaps[lane]
+        wakeup = self._wakeups[lane]
+        while True:
+            if not heap:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+
+            priority, _, job = heapq.heappop(heap)
+            self._queued[priority] -= 1
+            name = PRIORITY_NAMES[priority]
+
+            if job.future.done():
+                # 呼び出し元がキャンセル済み
+                continue
+            now = time.monotonic()
+            INFERENCE_QUEUE_WAIT_SECONDS.labels(priority=name).observe(now - job.enqueued_at)
+            if now > job.deadline:
+                INFERENCE_REJECTED_TOTAL.labels(priority=name, reason="deadline").inc()
+                job.future.set_exception(DeadlineExceededError("Inference deadline exceeded while queued"))
+                continue
+
+            self._running[lane] += 1
+            try:
+                result = await run_in_threadpool(job.context.run, job.fn)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._running[lane] -= 1
+                elapsed = time.monotonic() - now
+                self._service_time = 0.8 * self._service_time + 0.2 * elapsed
+            for _ in range(_HANDOFF_YIELDS):
+                await asyncio.sleep(0)
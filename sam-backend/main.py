@@ -3,19 +3,65 @@ are_doko Backend Server
 Supabase連携 + SAMセグメンテーションAPI
 """
 
+import asyncio
 import base64
-import io
-from typing import Optional
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Callable, Literal, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 import numpy as np
-from PIL import Image
+import orjson
 
-from sam_service import SAMService
-from routers import warehouses_router, photos_router, objects_router
-from utils import ensure_bucket_exists
+from sam_service import ImageMismatchError, SAMService
+from memory_budget import Allocation, MemoryBudgetExceeded, get_memory_budget, register_worker_usage
+from singleflight import SingleFlight
+from progressive import RefinementRegistry
+from profiling import slow_requests, start_request_profile, stop_request_profile
+from photo_ingest import register_embedding_preparer
+from similarity import register_feature_extractor
+from inference_pool import InferencePool, RemoteSAMService
+from segment_session import PromptError, encode_result, error_frame, parse_prompt
+from inference_scheduler import (
+    BACKGROUND,
+    INTERACTIVE,
+    DeadlineExceededError,
+    InferenceScheduler,
+    QueueFullError,
+)
+from config import (
+    BACKGROUND_DEADLINE_SECONDS,
+    INFERENCE_DEADLINE_SECONDS,
+    INFERENCE_MAX_QUEUE,
+    INFERENCE_THREADS_PER_WORKER,
+    INFERENCE_WORKERS,
+    MEMORY_DOWNSCALE_MAX_SIDE,
+    SAM_MODEL_TYPE,
+    SAM_REFINE_MODEL_TYPE,
+    SLOW_REQUEST_SECONDS,
+    WS_SESSION_IDLE_SECONDS,
+)
+from metrics import (
+    HTTP_REQUEST_SECONDS,
+    INFERENCE_QUEUE_DEPTH,
+    MEMORY_BUDGET_EVENTS_TOTAL,
+    SEGMENT_SESSIONS,
+    format_server_timing,
+    render_metrics,
+    start_request_timing,
+    track_stage,
+)
+from routers import warehouses_router, photos_router, objects_router, storage_router, admin_router
+from database import get_entity_cache
+from utils import ensure_bucket_exists, read_image
+from utils.clipping import mask_polygon
+from utils.images import LARGE_IMAGE_PIXELS, open_image
+from utils.compression import CompressionMiddleware
 
 app = FastAPI(
     title="are_doko API",
@@ -27,6 +73,8 @@ app = FastAPI(
 app.include_router(warehouses_router)
 app.include_router(photos_router)
 app.include_router(objects_router)
+app.include_router(storage_router)
+app.include_router(admin_router)
 
 # CORS設定（フロントエンドからのアクセスを許可）
 app.add_middleware(
@@ -35,14 +83,77 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "ETag"],
 )
 
+# レスポンス圧縮（1KB以上のJSON/テキスト、brotli優先）
+app.add_middleware(CompressionMiddleware, minimum_size=1024)
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """
+    リクエストの処理時間を記録
+
+    X-Server-Timing: 1 ヘッダー付きのリクエストには、段階ごとの処理時間を
+    Server-Timing レスポンスヘッダーで返す。
+    SLOW_REQUEST_SECONDS を超えたリクエストは段階ごとの時間を記録する（profiling.py）
+    """
+    server_timing = request.headers.get("x-server-timing") == "1"
+    # 管理用API（プロファイラの計測など）は遅いリクエストとして記録しない
+    capture = SLOW_REQUEST_SECONDS > 0 and not request.url.path.startswith("/api/admin/")
+    timings = start_request_timing() if server_timing or capture else None
+    profile = start_request_profile() if capture else None
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - start
+        slow = capture and elapsed >= SLOW_REQUEST_SECONDS
+        dump = stop_request_profile(profile, slow) if profile is not None else None
+
+    # パスパラメータでラベルが増えないよう、ルートのテンプレートで集計
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    HTTP_REQUEST_SECONDS.labels(
+        method=request.method,
+        route=route_path,
+        status=str(response.status_code),
+    ).observe(elapsed)
+
+    if slow:
+        slow_requests.add(
+            request.method, request.url.path, route_path, response.status_code, elapsed, timings, dump
+        )
+    if server_timing:
+        response.headers["Server-Timing"] = format_server_timing(timings, elapsed)
+    return response
+
 
 @app.on_event("startup")
 async def startup_event():
-    """起動時にStorageバケットを確認・作成"""
+    """起動時にStorageバケットを確認・作成し、推論ワーカーを起動"""
     ensure_bucket_exists()
 
+    global inference_pool
+    if INFERENCE_WORKERS > 0 and inference_pool is None:
+        inference_pool = InferencePool(
+            INFERENCE_WORKERS, model_type=SAM_MODEL_TYPE, threads=INFERENCE_THREADS_PER_WORKER or None
+        )
+        inference_pool.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """推論ワーカーを停止"""
+    if inference_pool is not None:
+        inference_pool.stop()
+
+# 画像サイズの上限
+# MAX_IMAGE_SIZEを超える画像はタイルモードで処理する
+MAX_IMAGE_SIZE = 4096
+MAX_TILED_IMAGE_SIZE = 16384
+
 # SAMサービスのインスタンス（遅延初期化）
 sam_service: Optional[SAMService] = None
 
@@ -51,21 +162,398 @@ def get_sam_service() -> SAMService:
     """SAMサービスのシングルトンを取得"""
     global sam_service
     if sam_service is None:
-        sam_service = SAMService()
+        sam_service = SAMService(model_type=SAM_MODEL_TYPE)
     return sam_service
 
 
-class SegmentRequest(BaseModel):
+# 推論ワーカープロセスのプール（INFERENCE_WORKERS > 0 の場合のみ）
+inference_pool: Optional[InferencePool] = None
+
+
+def get_inference_service(key: Optional[str] = None) -> "SAMService | RemoteSAMService":
+    """
+    推論に使うSAMサービスを取得
+
+    ワーカープールがある場合は、key（画像ダイジェストまたはmask_id）を担当するワーカー
+    """
+    if inference_pool is not None:
+        return inference_pool.route(key)
+    return get_sam_service()
+
+
+def get_inference_lane(key: Optional[str] = None) -> int:
+    """key を担当する推論ワーカーの番号（推論スケジューラのレーン。ワーカープールがなければ0）"""
+    if inference_pool is not None:
+        return inference_pool.index(key)
+    return 0
+
+
+# 段階的セグメンテーションの再推論用サービス（SAM_REFINE_MODEL_TYPE 指定時のみ）
+refine_service: Optional[SAMService] = None
+
+
+def get_refine_service() -> Optional[SAMService]:
+    """
+    再推論用（高精度モデル）のSAMサービスを取得
+
+    未設定の場合や、プレビュー用モデルはロードできたのに高精度モデルがロードできない
+    （チェックポイントがない）場合は None
+    """
+    global refine_service
+    if not SAM_REFINE_MODEL_TYPE or SAM_REFINE_MODEL_TYPE == get_inference_service().model_type:
+        return None
+    if refine_service is None:
+        refine_service = SAMService(model_type=SAM_REFINE_MODEL_TYPE)
+    if not refine_service.is_loaded() and get_inference_service().is_loaded():
+        return None
+    return refine_service
+
+
+def inference_worker_memory_usage() -> list[dict]:
+    """推論ワーカーごとのメモリ予算の使用量（/api/admin/memory 用）"""
+    return inference_pool.memory_usage() if inference_pool is not None else []
+
+
+register_worker_usage(inference_worker_memory_usage)
+
+
+# 同じ画像のエンコード、同じ画像・同じプロンプトの推論を1回にまとめる
+encode_flight = SingleFlight("encode")
+decode_flight = SingleFlight("decode")
+
+# 推論の順番待ち（対話的な操作を優先、上限を超えたら429）
+# ワーカープールがある場合はワーカーごとのレーンで1件ずつ（ワーカー数だけ並列に）実行する
+inference_scheduler = InferenceScheduler(max_queue=INFERENCE_MAX_QUEUE, workers=max(1, INFERENCE_WORKERS))
+
+# 高精度モデルでの再推論は別のキューで1件ずつ実行する
+# （再推論用サービスは別のモデル・ロックを持つため、実行中の再推論がクリックの推論の枠を塞がないように）
+refine_scheduler = InferenceScheduler(max_queue=INFERENCE_MAX_QUEUE, workers=1)
+
+
+async def run_inference(
+    image_key: str,
+    prompt: tuple,
+    fn: Callable[[SAMService], Optional[dict]],
+    encode_image: Optional[np.ndarray] = None,
+    priority: int = INTERACTIVE,
+    service: Optional[SAMService] = None,
+    scheduler: Optional[InferenceScheduler] = None,
+) -> Optional[dict]:
+    """
+    セグメンテーションを推論スケジューラ経由でスレッドプールで実行
+
+    (image_key, prompt) が同じ処理が実行中なら、その結果を共有する。
+    encode_image を指定した場合は、先に画像全体のエンコードを image_key 単位で
+    まとめて実行し、fn はキャッシュされた埋め込みを使う。
+
+    Args:
+        image_key: 画像のダイジェスト
+        prompt: プロンプトを表すキー（モードと座標）
+        fn: セグメンテーション本体（SAMServiceを受け取る）
+        encode_image: 事前にエンコードする画像（画像全体モードのみ）
+        priority: INTERACTIVE または BACKGROUND
+        service: 使用するSAMサービス（省略時は image_key を担当する既定のサービス）
+        scheduler: 使用する推論スケジューラ（省略時は inference_scheduler）
+
+    Raises:
+        HTTPException: キューが満杯（429）、期限切れ（503）
+    """
+    service = service or get_inference_service(image_key)
+    # 推論ワーカーごとのレーンに入れる（他のワーカー宛ての推論を待たせない）
+    lane = get_inference_lane(image_key) if scheduler is None else 0
+    scheduler = scheduler or inference_scheduler
+    timeout = INFERENCE_DEADLINE_SECONDS if priority == INTERACTIVE else BACKGROUND_DEADLINE_SECONDS
+    deadline = time.monotonic() + timeout
+
+    async def work() -> Optional[dict]:
+        if encode_image is not None:
+            # 優先度ごとに合流させる（対話的な操作がバックグラウンドの処理待ちにならないように）
+            await encode_flight.do(
+                (service.model_type, image_key, priority),
+                lambda: scheduler.submit(
+                    lambda: service.prepare_image(encode_image, image_key), priority, deadline, lane
+                ),
+            )
+        return await scheduler.submit(lambda: fn(service), priority, deadline, lane)
+
+    try:
+        with INFERENCE_QUEUE_DEPTH.track_inprogress():
+            return await decode_flight.do((service.model_type, image_key, prompt, priority), work)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "混雑しています。しばらくしてから再度お試しください", "code": "QUEUE_FULL"},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except DeadlineExceededError:
+        raise HTTPException(
+            status_code=503,
+            detail={"error": "処理がタイムアウトしました", "code": "DEADLINE_EXCEEDED"},
+            headers={"Retry-After": str(scheduler.retry_after(lane))},
+        )
+
+
+# 段階的セグメンテーションの再推論
+refinements = RefinementRegistry()
+
+
+def start_refinement(
+    session_id: Optional[str],
+    image_key: str,
+    prompt: tuple,
+    fn: Callable[[SAMService], Optional[dict]],
+    encode_image: Optional[np.ndarray] = None,
+    options: Optional["PolygonOptions"] = None,
+    allocation: Optional[Allocation] = None,
+) -> Optional[str]:
+    """
+    高精度モデルでの再推論をバックグラウンド優先度で開始
+
+    結果は options に従ってSegmentResponse形式のdictに変換しておく。
+    mask_id は返さない（再推論用サービスのマスクの状態は /api/segment/refine から参照できないため。
+    再調整はプレビューの結果の mask_id で行う）。
+    allocation（画像のメモリ予算の予約）は再推論の終了時に返却する。
+
+    Returns:
+        refinement_id（再推論用モデルが無効な場合は None。allocation は返却しない）
+    """
+    service = get_refine_service()
+    if service is None:
+        return None
+
+    async def refine() -> Optional[dict]:
+        result = await run_inference(
+            image_key, prompt, fn, encode_image=encode_image, priority=BACKGROUND, service=service,
+            scheduler=refine_scheduler,
+        )
+        if result is None:
+            return None
+        result.pop("mask_id", None)
+        return segment_payload(result, options)
+
+    refinement_id = refinements.start(session_id, refine)
+    if allocation is not None:
+        refinements.get(refinement_id).add_done_callback(lambda _: allocation.release())
+    return refinement_id
+
+
+def decode_base64(image_base64: str) -> bytes:
+    """Base64画像を画像ファイルのバイト列にデコード"""
+    try:
+        with track_stage("base64_decode"):
+            # data:image/...;base64, プレフィックスがある場合は除去
+            image_data = image_base64
+            if "," in image_data:
+                image_data = image_data.split(",")[1]
+
+            image_bytes = base64.b64decode(image_data)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "画像のデコードに失敗しました", "code": "INVALID_FORMAT"},
+        )
+
+    return image_bytes
+
+
+def decode_image_bytes(
+    image_bytes: bytes,
+    downscale: int = 1,
+    box: Optional[tuple[int, int, int, int]] = None,
+    max_pixels: Optional[int] = None,
+) -> np.ndarray:
+    """
+    画像ファイルのバイト列をRGB配列（H, W, 3）にデコード
+
+    downscale（2のべき乗）を指定した場合は縦横を 1/downscale（切り上げ）に縮小する。
+    box（x0, y0, x1, y1）を指定した場合はその範囲だけをRGB配列にする
+    （PILは画像全体を展開するが、RGBへの変換と配列へのコピーは切り出した分だけで済む）。
+    max_pixels は展開後の画素数の上限（省略時はPILの既定）
+    """
+    try:
+        with track_stage("image_decode"):
+            image = open_image(image_bytes, max_pixels)
+            if downscale > 1:
+                width, height = image.size
+                target = (-(-width // downscale), -(-height // downscale))
+                # JPEGは縮小しながらデコード（1/8まで。元の解像度のまま展開しない）
+                image.draft("RGB", target)
+                drafted = next(d for d in (8, 4, 2, 1) if image.width == -(-width // d))
+                if drafted < downscale:
+                    image = image.reduce(downscale // drafted)
+            image.load()
+            if box is not None:
+                image = image.crop(box)
+
+            # RGBに変換（PNGのアルファチャンネル対応）
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+
+            image_array = np.array(image)
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "画像のデコードに失敗しました", "code": "INVALID_FORMAT"},
+        )
+
+    return image_array
+
+
+@dataclass
+class DecodedImage:
+    """メモリ予算を予約してデコードした画像"""
+    array: np.ndarray  # RGB画像（縮小した場合は縮小後）
+    width: int  # 元画像の幅
+    height: int  # 元画像の高さ
+    downscale: int  # 縮小率（1 = 元の解像度）
+    allocation: Allocation  # 画像を使い終わったら返却する
+    origin: tuple[int, int] = (0, 0)  # 範囲を切り出した場合は、その左上の元画像座標
+
+
+def read_image_header(image_bytes: bytes, max_pixels: Optional[int] = None) -> tuple[int, int, Optional[str]]:
+    """
+    画像をデコードせずに (幅, 高さ, 形式) を読む
+
+    Raises:
+        HTTPException: 画像として読み込めない、または画素数が max_pixels を超える（400）
+    """
+    try:
+        with open_image(image_bytes, max_pixels) as header:
+            return header.width, header.height, header.format
+    except Exception:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "画像のデコードに失敗しました", "code": "INVALID_FORMAT"},
+        )
+
+
+def _downscale_factor(width: int, height: int) -> int:
+    """長辺が MEMORY_DOWNSCALE_MAX_SIDE 以下になる最小の縮小率（2のべき乗）"""
+    factor = 1
+    while -(-max(width, height) // factor) > MEMORY_DOWNSCALE_MAX_SIDE:
+        factor *= 2
+    return factor
+
+
+def decode_image_in_budget(
+    image_bytes: bytes,
+    category: str,
+    allow_downscale: bool = False,
+    box: Optional[tuple[int, int, int, int]] = None,
+    max_pixels: Optional[int] = None,
+) -> DecodedImage:
+    """
+    メモリ予算を予約して画像をデコード
+
+    予算が足りない場合（キャッシュを追い出しても足りない場合）、allow_downscale なら
+    長辺が MEMORY_DOWNSCALE_MAX_SIDE 以下になるよう縮小してデコードする。
+    縮小しながらデコードできるのはJPEGだけなので、他の形式は縮小せずに拒否する。
+
+    box を指定した場合（タイルモード）はその範囲だけを残す。PILが展開する画像全体
+    （1画素4バイト）を切り出すまで予約し、デコード後は切り出した分だけを予約に残す。
+    縮小してデコードした場合は画像全体を返す（origin は (0, 0)）。
+
+    Args:
+        image_bytes: 画像ファイルのバイト列
+        category: メモリ予算のカテゴリ（request_image / session_image）
+        allow_downscale: 予算が足りない場合に縮小してよいか
+        box: 残す範囲（x0, y0, x1, y1、元画像座標）
+        max_pixels: 展開後の画素数の上限（省略時はPILの既定）
+
+    Raises:
+        HTTPException: デコードできない（400）、予算が足りない（503）
+    """
+    width, height, image_format = read_image_header(image_bytes, max_pixels)
+    drafts = image_format == "JPEG"
+
+    budget = get_memory_budget()
+    downscale = 1
+    try:
+        allocation = budget.reserve(category, width * height * (3 if box is None else 4))
+    except MemoryBudgetExceeded:
+        box = None
+        downscale = _downscale_factor(width, height)
+        allocation = None
+        if allow_downscale and drafts and downscale > 1:
+            try:
+                allocation = budget.reserve(category, -(-width // downscale) * -(-height // downscale) * 3)
+                MEMORY_BUDGET_EVENTS_TOTAL.labels(category=category, event="downscaled").inc()
+            except MemoryBudgetExceeded:
+                pass
+        if allocation is None:
+            raise HTTPException(
+                status_code=503,
+                detail={"error": "サーバーのメモリが不足しています。しばらくしてから再度お試しください", "code": "MEMORY_EXHAUSTED"},
+                headers={"Retry-After": str(inference_scheduler.retry_after())},
+            )
+
+    try:
+        array = decode_image_bytes(image_bytes, downscale, box, max_pixels)
+    except BaseException:
+        allocation.release()
+        raise
+    if box is None:
+        return DecodedImage(array, width, height, downscale, allocation)
+    cropped = budget.track(category, array.nbytes)
+    allocation.release()
+    return DecodedImage(array, width, height, downscale, cropped, origin=(box[0], box[1]))
+
+
+PolygonLod = Literal["coarse", "medium", "fine"]
+
+
+class PolygonOptions(BaseModel):
+    """
+    返すポリゴンの詳細度と形状（既定では polygon に最大の部分の外周を medium で返す）
+
+    coarse はオーバーレイ表示や当たり判定、fine は切り抜き用。
+    既定以外を指定した場合は lods に詳細度ごとの形状を返し、polygon は lods の先頭の詳細度になる。
+    """
+    lods: list[PolygonLod] = ["medium"]  # 返す詳細度（polygon は先頭の詳細度）
+    holes: bool = False  # 穴を含める
+    multipart: bool = False  # 最大の部分以外も含める
+
+    def is_default(self) -> bool:
+        return self.lods == ["medium"] and not self.holes and not self.multipart
+
+
+class SegmentRequest(PolygonOptions):
     """セグメンテーションリクエスト"""
     image_base64: str  # Base64エンコードされた画像（data:prefix除く）
     click_x: int  # クリックX座標（元画像ピクセル座標）
     click_y: int  # クリックY座標（元画像ピクセル座標）
+    tiled: bool = False  # タイルモード（クリック周辺のみを元解像度で推論）
+    progressive: bool = False  # 段階的セグメンテーション（高精度モデルの結果をSSEで受け取る）
+    session_id: Optional[str] = None  # 同じセッションの古い再推論を取り消すための識別子
+
+
+class PrepareImageRequest(BaseModel):
+    """埋め込み事前計算リクエスト"""
+    image_base64: str  # Base64エンコードされた画像（data:prefix除く）
 
 
-class LassoSegmentRequest(BaseModel):
+class LassoSegmentRequest(PolygonOptions):
     """投げ縄セグメンテーションリクエスト"""
     image_base64: str  # Base64エンコードされた画像（data:prefix除く）
     lasso_polygon: list[dict]  # 投げ縄ポリゴン [{"x": 100, "y": 100}, ...]
+    tiled: bool = False  # タイルモード（投げ縄周辺のみを元解像度で推論）
+    progressive: bool = False  # 段階的セグメンテーション（高精度モデルの結果をSSEで受け取る）
+    session_id: Optional[str] = None  # 同じセッションの古い再推論を取り消すための識別子
+
+
+class RefinePoint(BaseModel):
+    """再調整で追加する点"""
+    x: int
+    y: int
+    label: int = 1  # 1 = 前景, 0 = 背景
+
+
+class RefineSegmentRequest(PolygonOptions):
+    """再調整リクエスト"""
+    mask_id: str  # /api/segment などが返した mask_id
+    points: list[RefinePoint]  # 追加する点
+    image_base64: Optional[str] = None  # 画像の埋め込みがキャッシュから追い出されていた場合に使う画像
 
 
 class Position(BaseModel):
@@ -82,10 +570,66 @@ class BoundingBox(BaseModel):
     height: float
 
 
+class PolygonShape(BaseModel):
+    """1つの部分の外周と穴"""
+    exterior: list[Position]
+    holes: list[list[Position]] = []
+
+
 class SegmentResponse(BaseModel):
     """セグメンテーションレスポンス"""
     polygon: list[Position]  # ポリゴン頂点リスト
     bounding_box: BoundingBox  # バウンディングボックス
+    lods: Optional[dict[str, list[PolygonShape]]] = None  # 詳細度ごとの形状（既定以外のPolygonOptionsを指定した場合のみ）
+    mask_id: Optional[str] = None  # 再調整（/api/segment/refine）用のID（タイルモード・縮小時は返さない）
+    refinement_id: Optional[str] = None  # 段階的セグメンテーションの再推論ID（progressive時のみ）
+    downscale: Optional[int] = None  # メモリ不足のため縮小して推論した場合の縮小率
+
+
+def _positions(points: list[tuple[int, int]]) -> list[dict]:
+    return [{"x": float(px), "y": float(py)} for px, py in points]
+
+
+def segment_payload(result: dict, options: Optional[PolygonOptions] = None) -> dict:
+    """
+    セグメンテーション結果をSegmentResponse形式のdictに変換
+
+    頂点ごとのPositionモデルを作らず、orjsonで直接シリアライズできる形にする
+    """
+    x, y, width, height = result["bounding_box"]
+    payload = {
+        "polygon": _positions(result["polygon"]),
+        "bounding_box": {"x": float(x), "y": float(y), "width": float(width), "height": float(height)},
+    }
+    if options is not None and not options.is_default():
+        with track_stage("polygon_lods"):
+            shapes = SAMService.polygon_shapes(result, options.lods, options.holes, options.multipart)
+        payload["polygon"] = _positions(shapes[options.lods[0]][0]["exterior"])
+        payload["lods"] = {
+            lod: [
+                {"exterior": _positions(part["exterior"]), "holes": [_positions(h) for h in part["holes"]]}
+                for part in parts
+            ]
+            for lod, parts in shapes.items()
+        }
+    if result.get("mask_id") is not None:
+        payload["mask_id"] = result["mask_id"]
+    return payload
+
+
+def segment_response(
+    result: dict,
+    refinement_id: Optional[str] = None,
+    options: Optional[PolygonOptions] = None,
+    downscale: int = 1,
+) -> ORJSONResponse:
+    """セグメンテーション結果をSegmentResponse形式のJSONで返す"""
+    payload = segment_payload(result, options)
+    if refinement_id is not None:
+        payload["refinement_id"] = refinement_id
+    if downscale > 1:
+        payload["downscale"] = downscale
+    return ORJSONResponse(payload)
 
 
 class ErrorResponse(BaseModel):
@@ -103,14 +647,99 @@ async def root():
 @app.get("/health")
 async def health_check():
     """詳細ヘルスチェック"""
-    service = get_sam_service()
+    service = get_inference_service()
     return {
         "status": "ok",
         "model_loaded": service.is_loaded(),
         "model_type": service.model_type,
+        "inference_workers": inference_pool.size() if inference_pool is not None else 0,
+        "refine_model_type": SAM_REFINE_MODEL_TYPE or None,
+        "inference_queue": inference_scheduler.stats(),
+        "refine_queue": refine_scheduler.stats() if SAM_REFINE_MODEL_TYPE else None,
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクス"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.post("/api/segment-prepare")
+async def segment_prepare(request: PrepareImageRequest):
+    """
+    画像の埋め込みを事前に計算（バックグラウンド優先度）
+
+    写真を開いた時点で呼んでおくと、最初のクリックでエンコードを待たずに済む。
+    対話的なセグメンテーションが優先され、キューが混んでいる場合は429、
+    メモリが不足している場合は503を返す。
+
+    - image_base64: Base64エンコードされた画像（data:prefix除く）
+    """
+    image_bytes = decode_base64(request.image_base64)
+    width, height, _ = read_image_header(image_bytes, LARGE_IMAGE_PIXELS)
+    if width > MAX_IMAGE_SIZE or height > MAX_IMAGE_SIZE:
+        # タイルモードの画像はクリック位置が決まるまでエンコードできない
+        return {"image_key": None, "prepared": False}
+
+    decoded = await run_in_threadpool(decode_image_in_budget, image_bytes, "request_image")
+    with decoded.allocation:
+        image = decoded.array
+        image_key = hashlib.sha256(image_bytes).hexdigest()
+        await run_inference(
+            image_key,
+            ("prepare",),
+            lambda svc: svc.prepare_image(image, image_key),
+            priority=BACKGROUND,
+        )
+    return {"image_key": image_key, "prepared": True}
+
+
+async def prepare_ingested_embedding(image_bytes: bytes) -> None:
+    """一括登録した写真の埋め込みを事前に計算（混雑・メモリ不足の場合は省略）"""
+    try:
+        width, height, _ = read_image_header(image_bytes, LARGE_IMAGE_PIXELS)
+        if width > MAX_IMAGE_SIZE or height > MAX_IMAGE_SIZE:
+            return
+        decoded = await run_in_threadpool(decode_image_in_budget, image_bytes, "request_image")
+        with decoded.allocation:
+            image = decoded.array
+            image_key = hashlib.sha256(image_bytes).hexdigest()
+            await run_inference(
+                image_key,
+                ("prepare",),
+                lambda svc: svc.prepare_image(image, image_key),
+                priority=BACKGROUND,
+            )
+    except Exception as e:
+        print(f"Skipped preparing embedding for ingested photo: {e}")
+
+
+register_embedding_preparer(prepare_ingested_embedding)
+
+
+async def extract_object_feature(object_id: str, photo_bytes: bytes, mask_type: str, mask_data: dict) -> Optional[dict]:
+    """登録したオブジェクトの特徴ベクトルを計算（類似検索用、バックグラウンド優先度）"""
+    polygon = np.asarray(mask_polygon(mask_type, mask_data), dtype=np.float32)
+    # 保存済みの写真はタイルモードの画像（最大16384x16384）もありうる
+    decoded = await run_in_threadpool(
+        decode_image_in_budget, photo_bytes, "request_image", max_pixels=LARGE_IMAGE_PIXELS
+    )
+    with decoded.allocation:
+        image = decoded.array
+        image_key = hashlib.sha256(photo_bytes).hexdigest()
+        return await run_inference(
+            image_key,
+            ("feature", object_id),
+            lambda svc: svc.object_feature(image, image_key, polygon),
+            priority=BACKGROUND,
+        )
+
+
+register_feature_extractor(extract_object_feature)
+
+
 @app.post("/api/segment", response_model=SegmentResponse)
 async def segment(request: SegmentRequest):
     """
@@ -119,35 +748,23 @@ async def segment(request: SegmentRequest):
     - image_base64: Base64エンコードされた画像（data:prefix除く）
     - click_x: クリックX座標（元画像ピクセル座標）
     - click_y: クリックY座標（元画像ピクセル座標）
+    - tiled: タイルモード（4096pxを超える画像は自動的にタイルモード）
+
+    メモリ予算が足りない場合、JPEGは縮小して推論する（downscale に縮小率を返し、mask_id・再推論はなし）
     """
+    decoded = None
     try:
         # Base64デコード
-        try:
-            # data:image/...;base64, プレフィックスがある場合は除去
-            image_data = request.image_base64
-            if "," in image_data:
-                image_data = image_data.split(",")[1]
+        image_bytes = decode_base64(request.image_base64)
 
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-
-            # RGBに変換（PNGのアルファチャンネル対応）
-            if image.mode != "RGB":
-                image = image.convert("RGB")
-
-        except Exception as e:
+        # 画像サイズチェック（MAX_IMAGE_SIZEを超える場合はタイルモード）
+        width, height, _ = read_image_header(image_bytes, LARGE_IMAGE_PIXELS)
+        if width > MAX_TILED_IMAGE_SIZE or height > MAX_TILED_IMAGE_SIZE:
             raise HTTPException(
                 status_code=400,
-                detail={"error": "画像のデコードに失敗しました", "code": "INVALID_FORMAT"},
-            )
-
-        # 画像サイズチェック
-        width, height = image.size
-        if width > 4096 or height > 4096:
-            raise HTTPException(
-                status_code=400,
-                detail={"error": "画像サイズが大きすぎます（最大4096x4096）", "code": "IMAGE_TOO_LARGE"},
+                detail={"error": "画像サイズが大きすぎます（最大16384x16384）", "code": "IMAGE_TOO_LARGE"},
             )
+        tiled = request.tiled or width > MAX_IMAGE_SIZE or height > MAX_IMAGE_SIZE
 
         # クリック座標の検証
         if request.click_x < 0 or request.click_x >= width:
@@ -161,12 +778,31 @@ async def segment(request: SegmentRequest):
                 detail={"error": "クリックY座標が画像範囲外です", "code": "INVALID_COORDINATES"},
             )
 
-        # SAMでセグメンテーション
-        service = get_sam_service()
-        result = service.segment(
-            image=np.array(image),
-            click_point=(request.click_x, request.click_y),
+        # タイルモードではクリック点から推論しうる範囲だけをRGB配列にする
+        box = SAMService.tile_window(width, height, (request.click_x, request.click_y)) if tiled else None
+        decoded = await run_in_threadpool(
+            decode_image_in_budget,
+            image_bytes, "request_image", allow_downscale=True, box=box, max_pixels=LARGE_IMAGE_PIXELS,
         )
+        image, downscale, origin = decoded.array, decoded.downscale, decoded.origin
+        tiled = tiled and downscale == 1
+
+        # SAMでセグメンテーション（縮小した画像は別の画像として埋め込みをキャッシュする）
+        image_key = hashlib.sha256(image_bytes).hexdigest()
+        if downscale > 1:
+            image_key += f"/{downscale}"
+        click_point = (request.click_x // downscale, request.click_y // downscale)
+
+        def infer(service: SAMService) -> Optional[dict]:
+            if tiled:
+                return service.segment_tiled(
+                    image=image, click_point=click_point, image_key=image_key, origin=origin, size=(width, height)
+                )
+            return service.segment(image=image, click_point=click_point, image_key=image_key)
+
+        prompt = ("tiled" if tiled else "point", click_point)
+        encode_image = None if tiled else image
+        result = await run_inference(image_key, prompt, infer, encode_image=encode_image)
 
         if result is None:
             raise HTTPException(
@@ -176,16 +812,19 @@ async def segment(request: SegmentRequest):
                     "code": "NO_OBJECT_FOUND",
                 },
             )
+        if downscale > 1:
+            result = SAMService.scale_result(result, downscale)
 
-        return SegmentResponse(
-            polygon=[Position(x=p[0], y=p[1]) for p in result["polygon"]],
-            bounding_box=BoundingBox(
-                x=result["bounding_box"][0],
-                y=result["bounding_box"][1],
-                width=result["bounding_box"][2],
-                height=result["bounding_box"][3],
-            ),
-        )
+        refinement_id = None
+        if request.progressive and downscale == 1:
+            refinement_id = start_refinement(
+                request.session_id, image_key, prompt, infer, encode_image, request, decoded.allocation
+            )
+            if refinement_id is not None:
+                # 画像の予約は再推論の終了時に返却する
+                decoded = None
+
+        return segment_response(result, refinement_id, request, downscale)
 
     except HTTPException:
         raise
@@ -195,6 +834,9 @@ async def segment(request: SegmentRequest):
             status_code=500,
             detail={"error": "サーバーエラーが発生しました", "code": "SERVER_ERROR"},
         )
+    finally:
+        if decoded is not None:
+            decoded.allocation.release()
 
 
 @app.post("/api/segment-lasso", response_model=SegmentResponse)
@@ -204,33 +846,23 @@ async def segment_lasso(request: LassoSegmentRequest):
 
     - image_base64: Base64エンコードされた画像（data:prefix除く）
     - lasso_polygon: 投げ縄ポリゴン [{"x": 100, "y": 100}, ...]
+    - tiled: タイルモード（4096pxを超える画像は自動的にタイルモード）
+
+    メモリ予算が足りない場合、JPEGは縮小して推論する（downscale に縮小率を返し、mask_id・再推論はなし）
     """
+    decoded = None
     try:
         # Base64デコード
-        try:
-            image_data = request.image_base64
-            if "," in image_data:
-                image_data = image_data.split(",")[1]
-
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
+        image_bytes = decode_base64(request.image_base64)
 
-            if image.mode != "RGB":
-                image = image.convert("RGB")
-
-        except Exception as e:
+        # 画像サイズチェック（MAX_IMAGE_SIZEを超える場合はタイルモード）
+        width, height, _ = read_image_header(image_bytes, LARGE_IMAGE_PIXELS)
+        if width > MAX_TILED_IMAGE_SIZE or height > MAX_TILED_IMAGE_SIZE:
             raise HTTPException(
                 status_code=400,
-                detail={"error": "画像のデコードに失敗しました", "code": "INVALID_FORMAT"},
-            )
-
-        # 画像サイズチェック
-        width, height = image.size
-        if width > 4096 or height > 4096:
-            raise HTTPException(
-                status_code=400,
-                detail={"error": "画像サイズが大きすぎます（最大4096x4096）", "code": "IMAGE_TOO_LARGE"},
+                detail={"error": "画像サイズが大きすぎます（最大16384x16384）", "code": "IMAGE_TOO_LARGE"},
             )
+        tiled = request.tiled or width > MAX_IMAGE_SIZE or height > MAX_IMAGE_SIZE
 
         # ポリゴンの検証
         if len(request.lasso_polygon) < 3:
@@ -250,12 +882,31 @@ async def segment_lasso(request: LassoSegmentRequest):
                     detail={"error": "投げ縄座標が画像範囲外です", "code": "INVALID_COORDINATES"},
                 )
 
-        # SAMでセグメンテーション
-        service = get_sam_service()
-        result = service.segment_with_lasso(
-            image=np.array(image),
-            lasso_polygon=lasso_polygon,
+        # タイルモードでは投げ縄の周辺（推論に使う範囲）だけをRGB配列にする
+        box = SAMService.lasso_roi(lasso_polygon, width, height) if tiled else None
+        decoded = await run_in_threadpool(
+            decode_image_in_budget,
+            image_bytes, "request_image", allow_downscale=True, box=box, max_pixels=LARGE_IMAGE_PIXELS,
         )
+        image, downscale, origin = decoded.array, decoded.downscale, decoded.origin
+        tiled = tiled and downscale == 1
+
+        # SAMでセグメンテーション（縮小した画像は別の画像として埋め込みをキャッシュする）
+        image_key = hashlib.sha256(image_bytes).hexdigest()
+        if downscale > 1:
+            image_key += f"/{downscale}"
+            lasso_polygon = [(x // downscale, y // downscale) for x, y in lasso_polygon]
+
+        def infer(service: SAMService) -> Optional[dict]:
+            if tiled:
+                return service.segment_with_lasso_tiled(
+                    image=image, lasso_polygon=lasso_polygon, image_key=image_key, origin=origin, size=(width, height)
+                )
+            return service.segment_with_lasso(image=image, lasso_polygon=lasso_polygon, image_key=image_key)
+
+        prompt = ("lasso_tiled" if tiled else "lasso", tuple(lasso_polygon))
+        encode_image = None if tiled else image
+        result = await run_inference(image_key, prompt, infer, encode_image=encode_image)
 
         if result is None:
             raise HTTPException(
@@ -265,16 +916,19 @@ async def segment_lasso(request: LassoSegmentRequest):
                     "code": "NO_OBJECT_FOUND",
                 },
             )
+        if downscale > 1:
+            result = SAMService.scale_result(result, downscale)
 
-        return SegmentResponse(
-            polygon=[Position(x=p[0], y=p[1]) for p in result["polygon"]],
-            bounding_box=BoundingBox(
-                x=result["bounding_box"][0],
-                y=result["bounding_box"][1],
-                width=result["bounding_box"][2],
-                height=result["bounding_box"][3],
-            ),
-        )
+        refinement_id = None
+        if request.progressive and downscale == 1:
+            refinement_id = start_refinement(
+                request.session_id, image_key, prompt, infer, encode_image, request, decoded.allocation
+            )
+            if refinement_id is not None:
+                # 画像の予約は再推論の終了時に返却する
+                decoded = None
+
+        return segment_response(result, refinement_id, request, downscale)
 
     except HTTPException:
         raise
@@ -284,6 +938,323 @@ async def segment_lasso(request: LassoSegmentRequest):
             status_code=500,
             detail={"error": "サーバーエラーが発生しました", "code": "SERVER_ERROR"},
         )
+    finally:
+        if decoded is not None:
+            decoded.allocation.release()
+
+
+@app.post("/api/segment/refine", response_model=SegmentResponse)
+async def segment_refine(request: RefineSegmentRequest):
+    """
+    以前のセグメンテーション結果に点を追加して再調整
+
+    前回のプロンプトと低解像度マスクを再利用し、デコーダーを1回だけ実行する。
+    画像を送り直す必要はない（埋め込みがキャッシュから追い出されていた場合のみ image_base64 を使う）。
+
+    - mask_id: /api/segment, /api/segment-lasso が返した mask_id
+    - points: 追加する点 [{"x": 100, "y": 100, "label": 0}, ...]（label: 1 = 前景, 0 = 背景）
+    """
+    decoded = None
+    try:
+        if not request.points:
+            raise HTTPException(
+                status_code=400,
+                detail={"error": "追加する点が必要です", "code": "INVALID_POINTS"},
+            )
+        if any(p.label not in (0, 1) for p in request.points):
+            raise HTTPException(
+                status_code=400,
+                detail={"error": "点のラベルは0または1です", "code": "INVALID_POINTS"},
+            )
+
+        image = image_key = None
+        if request.image_base64:
+            image_bytes = decode_base64(request.image_base64)
+            # mask_id の画像と同じかは refine_mask がダイジェストで確認する
+            image_key = hashlib.sha256(image_bytes).hexdigest()
+            decoded = await run_in_threadpool(decode_image_in_budget, image_bytes, "request_image")
+            image = decoded.array
+
+        point_coords = [(p.x, p.y) for p in request.points]
+        point_labels = [p.label for p in request.points]
+        try:
+            result = await run_inference(
+                request.mask_id,
+                ("refine", tuple(point_coords), tuple(point_labels)),
+                lambda svc: svc.refine_mask(
+                    request.mask_id, point_coords, point_labels, image=image, image_key=image_key
+                ),
+            )
+        except KeyError:
+            raise HTTPException(
+                status_code=404,
+                detail={
+                    "error": "再調整の状態が見つかりません。画像を添えて再度お試しください",
+                    "code": "MASK_NOT_FOUND",
+                },
+            )
+        except ImageMismatchError:
+            raise HTTPException(
+                status_code=409,
+                detail={"error": "画像が再調整するマスクの画像と異なります", "code": "IMAGE_MISMATCH"},
+            )
+
+        if result is None:
+            raise HTTPException(
+                status_code=400,
+                detail={"error": "オブジェクトが検出できませんでした", "code": "NO_OBJECT_FOUND"},
+            )
+
+        return segment_response(result, options=request)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Refine segmentation error: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail={"error": "サーバーエラーが発生しました", "code": "SERVER_ERROR"},
+        )
+    finally:
+        if decoded is not None:
+            decoded.allocation.release()
+
+
+def _sse_event(event: str, data: dict) -> bytes:
+    """Server-Sent Eventsの1イベント"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.get("/api/segment/refinements/{refinement_id}")
+async def refinement_events(refinement_id: str):
+    """
+    段階的セグメンテーションの再推論結果をServer-Sent Eventsで返す
+
+    イベントは1つだけ送られる:
+    - refined: 高精度モデルの結果（SegmentResponseと同じ形式、mask_id なし）
+    - dropped: 新しいクリックで取り消された
+    - failed: 再推論に失敗（混雑・タイムアウト・検出失敗など）
+
+    接続を切ると再推論を取り消す。
+    """
+    task = refinements.get(refinement_id)
+    if task is None:
+        raise HTTPException(
+            status_code=404,
+            detail={"error": "再推論が見つかりません", "code": "REFINEMENT_NOT_FOUND"},
+        )
+
+    async def events():
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # クライアントが切断した
+                raise
+            yield _sse_event("dropped", {"refinement_id": refinement_id})
+            return
+        except HTTPException as e:
+            yield _sse_event("failed", {"refinement_id": refinement_id, **e.detail})
+            return
+        except Exception as e:
+            print(f"Refinement error: {e}")
+            yield _sse_event("failed", {"refinement_id": refinement_id, "code": "SERVER_ERROR"})
+            return
+        finally:
+            if not task.done():
+                refinements.cancel(refinement_id)
+
+        if result is None:
+            yield _sse_event("failed", {"refinement_id": refinement_id, "code": "NO_OBJECT_FOUND"})
+        else:
+            yield _sse_event("refined", {"refinement_id": refinement_id, **result})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _receive_frame(websocket: WebSocket) -> "str | bytes":
+    """テキストまたはバイナリのフレームを1つ受信（無操作タイムアウト付き）"""
+    message = await asyncio.wait_for(websocket.receive(), WS_SESSION_IDLE_SECONDS)
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("text") is not None:
+        return message["text"]
+    return message.get("bytes") or b""
+
+
+def _load_photo_bytes(photo_id: str) -> bytes:
+    """登録済みの写真の画像バイト列をStorageから読み込む"""
+    try:
+        photo = get_entity_cache().get("photo", photo_id)
+        if photo is None:
+            raise LookupError(photo_id)
+    except Exception:
+        raise HTTPException(
+            status_code=404,
+            detail={"error": "写真が見つかりません", "code": "PHOTO_NOT_FOUND"},
+        )
+    return read_image(photo["image_path"])
+
+
+async def _open_session_image(websocket: WebSocket) -> bytes:
+    """
+    セッションの最初のフレームから画像ファイルのバイト列を取得
+
+    Raises:
+        HTTPException: 画像を取得できない
+    """
+    frame = await _receive_frame(websocket)
+    if isinstance(frame, bytes):
+        return frame
+
+    try:
+        message = orjson.loads(frame)
+    except orjson.JSONDecodeError:
+        message = None
+    if not isinstance(message, dict) or message.get("type") != "open":
+        raise HTTPException(
+            status_code=400,
+            detail={"error": "最初のメッセージはopenである必要があります", "code": "INVALID_MESSAGE"},
+        )
+
+    if message.get("photo_id"):
+        return await run_in_threadpool(_load_photo_bytes, str(message["photo_id"]))
+    if message.get("image_base64"):
+        return await run_in_threadpool(decode_base64, message["image_base64"])
+    raise HTTPException(
+        status_code=400,
+        detail={"error": "image_base64 または photo_id が必要です", "code": "INVALID_MESSAGE"},
+    )
+
+
+@app.websocket("/ws/segment")
+async def segment_session(websocket: WebSocket):
+    """
+    対話セグメンテーションセッション
+
+    最初に画像（またはphoto_id）を送ると、埋め込みをセッションの間キャッシュに固定し、
+    以降はクリック・背景点・ボックス・投げ縄の小さなメッセージだけで推論する。
+    メッセージ形式は segment_session.py を参照。?format=binary で結果をバイナリで返す。
+    ?lod=coarse / fine で結果のポリゴンの詳細度を変える（既定は medium）。
+
+    デコードした画像はセッションの間メモリ予算に予約する（足りない場合は MEMORY_EXHAUSTED で閉じる）。
+    切断または無操作タイムアウト（WS_SESSION_IDLE_SECONDS）で固定と予約を解除する。
+    """
+    await websocket.accept()
+    binary = websocket.query_params.get("format") == "binary"
+    lod = websocket.query_params.get("lod", "medium")
+    if lod not in SAMService.POLYGON_LODS:
+        lod = "medium"
+    decoded: Optional[DecodedImage] = None
+    # 埋め込みを固定したサービス（pin_image が成功した場合だけ、終了時に固定を解除する）
+    pinned: "Optional[SAMService | RemoteSAMService]" = None
+    SEGMENT_SESSIONS.inc()
+
+    try:
+        try:
+            image_bytes = await _open_session_image(websocket)
+            width, height, _ = read_image_header(image_bytes, LARGE_IMAGE_PIXELS)
+            if width > MAX_IMAGE_SIZE or height > MAX_IMAGE_SIZE:
+                await websocket.send_json(error_frame(
+                    None, "IMAGE_TOO_LARGE", "セッションで使える画像は4096x4096までです（タイルモードはHTTPを使用）"
+                ))
+                await websocket.close(code=1008)
+                return
+            decoded = await run_in_threadpool(decode_image_in_budget, image_bytes, "session_image")
+        except HTTPException as e:
+            await websocket.send_json(error_frame(None, e.detail["code"], e.detail["error"]))
+            # メモリ不足は時間をおいて再接続すれば開ける
+            await websocket.close(code=1013 if e.status_code == 503 else 1008)
+            return
+
+        image = decoded.array
+
+        # 埋め込みを計算してセッションの間固定
+        image_key = hashlib.sha256(image_bytes).hexdigest()
+        # ワーカープールがある場合は、この画像を担当するワーカーのキャッシュに固定する
+        service = get_inference_service(image_key)
+        await run_in_threadpool(service.pin_image, image_key)
+        pinned = service
+        try:
+            await run_inference(image_key, ("prepare",), lambda svc: svc.prepare_image(image, image_key))
+        except HTTPException as e:
+            await websocket.send_json(error_frame(None, e.detail["code"], e.detail["error"]))
+            await websocket.close(code=1013)
+            return
+        await websocket.send_json({"type": "ready", "image_key": image_key, "width": width, "height": height})
+
+        while True:
+            frame = await _receive_frame(websocket)
+            try:
+                message = orjson.loads(frame)
+            except orjson.JSONDecodeError:
+                await websocket.send_json(error_frame(None, "INVALID_MESSAGE", "JSONとして解釈できません"))
+                continue
+            if not isinstance(message, dict):
+                await websocket.send_json(error_frame(None, "INVALID_MESSAGE", "JSONオブジェクトが必要です"))
+                continue
+            message_id = message.get("id")
+
+            try:
+                mode, prompt, args = parse_prompt(message, width, height)
+            except PromptError as e:
+                await websocket.send_json(error_frame(message_id, e.code, e.error))
+                continue
+
+            if mode == "lasso":
+                fn = lambda svc: svc.segment_with_lasso(image=image, image_key=image_key, **args)
+            elif mode == "refine":
+                fn = lambda svc: svc.refine_mask(image=image, image_key=image_key, **args)
+            else:
+                fn = lambda svc: svc.segment_with_prompts(image=image, image_key=image_key, **args)
+
+            try:
+                result = await run_inference(image_key, prompt, fn)
+            except KeyError:
+                await websocket.send_json(error_frame(message_id, "MASK_NOT_FOUND", "再調整の状態が見つかりません"))
+                continue
+            except ImageMismatchError:
+                # 他の画像（別のセッション）の mask_id
+                await websocket.send_json(error_frame(message_id, "MASK_NOT_FOUND", "再調整の状態が見つかりません"))
+                continue
+            except HTTPException as e:
+                retry_after = (e.headers or {}).get("Retry-After")
+                extra = {"retry_after": int(retry_after)} if retry_after else {}
+                await websocket.send_json(error_frame(message_id, e.detail["code"], e.detail["error"], **extra))
+                continue
+            except Exception as e:
+                print(f"Session segmentation error: {e}")
+                await websocket.send_json(error_frame(message_id, "SERVER_ERROR", "サーバーエラーが発生しました"))
+                continue
+
+            if result is None:
+                await websocket.send_json(error_frame(message_id, "NO_OBJECT_FOUND", "オブジェクトが検出できませんでした"))
+                continue
+
+            if lod != "medium":
+                result = {**result, "polygon": SAMService.polygon_at(result, lod)}
+            frame_out = encode_result(message_id if isinstance(message_id, int) else 0, result, binary)
+            if binary:
+                await websocket.send_bytes(frame_out)
+            else:
+                await websocket.send_text(orjson.dumps(frame_out).decode())
+
+    except asyncio.TimeoutError:
+        await websocket.close(code=1000, reason="idle timeout")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        try:
+            if pinned is not None:
+                await run_in_threadpool(pinned.unpin_image, image_key)
+        finally:
+            if decoded is not None:
+                decoded.allocation.release()
+            SEGMENT_SESSIONS.dec()
 
 
 if __name__ == "__main__":
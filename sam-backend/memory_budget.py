@@ -0,0 +1,251 @@
+"""
+プロセス全体のメモリ予算
+
+デコードした画像（4096x4096のRGBで48MB）、キーなしでセットした画像のコピー、埋め込み、
+再調整用のマスク、推論中のマスクはそれぞれ個別に上限があるだけで、合計には上限がなかった。
+大きな画像のリクエストが重なるとプロセスがOOMで落ちるため、大きな確保をカテゴリごとに登録し、
+合計が予算を超えないようにする。
+
+- reserve(): リクエストがデコードする前に予約する。足りなければキャッシュを追い出し、
+  それでも足りなければ MemoryBudgetExceeded（呼び出し元は縮小してデコードするか503を返す）
+- track(): 確保済み・処理に必須の分（キャッシュの項目、推論中のマスク）を登録する。
+  予算を超えた分はキャッシュの追い出しで解消を試みるが、失敗はしない
+- キャッシュは register_evictor() で追い出し関数を登録する。不足時は使用量の大きいカテゴリから順に呼ぶ
+
+推論ワーカープロセス（INFERENCE_WORKERS）はそれぞれ独自の予算を持つ
+（親プロセスはリクエストの画像、ワーカーは埋め込みやマスクを主に使う）。
+"""
+
+import os
+import threading
+import weakref
+from typing import Callable, Optional
+
+from config import INFERENCE_WORKERS, MEMORY_BUDGET_MB, MEMORY_BUDGET_RATIO
+from metrics import MEMORY_BUDGET_BYTES, MEMORY_BUDGET_EVENTS_TOTAL
+
+# cgroupのメモリ上限（v2, v1）
+_CGROUP_LIMIT_PATHS = ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes")
+
+
+class MemoryBudgetExceeded(Exception):
+    """予算が足りず、キャッシュを追い出しても予約できない"""
+
+    def __init__(self, category: str, requested: int, available: int):
+        super().__init__(f"Memory budget exceeded: {category} needs {requested} bytes, {available} available")
+        self.category = category
+        self.requested = requested
+        self.available = available
+
+
+class Allocation:
+    """予算に登録した確保（release() で返却する。with文でも使える）"""
+
+    __slots__ = ("_budget", "category", "nbytes")
+
+    def __init__(self, budget: "MemoryBudget", category: str, nbytes: int):
+        self._budget = budget
+        self.category = category
+        self.nbytes = nbytes
+
+    def release(self) -> None:
+        """返却（2回目以降は何もしない）"""
+        self._budget._release(self)
+
+    def __enter__(self) -> "Allocation":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class MemoryBudget:
+    """カテゴリごとの使用量と、キャッシュの追い出し関数を管理する"""
+
+    def __init__(self, limit: int):
+        """
+        Args:
+            limit: 予算（バイト）。0の場合は上限なし（使用量の記録のみ）
+        """
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._used: dict[str, int] = {}
+        self._total = 0
+        self._peak = 0
+        # カテゴリ -> 追い出し関数（要求バイト数を受け取り、解放したバイト数を返す）
+        # キャッシュの持ち主を予算が生かし続けないよう、メソッドは弱参照で持つ
+        self._evictors: dict[str, list[Callable[[], Optional[Callable[[int], int]]]]] = {}
+        self._evicted: dict[str, int] = {}
+        self._rejected: dict[str, int] = {}
+
+    @property
+    def used(self) -> int:
+        return self._total
+
+    @property
+    def available(self) -> Optional[int]:
+        """予算の残り（上限なしの場合は None）"""
+        return max(0, self.limit - self._total) if self.limit > 0 else None
+
+    def register_evictor(self, category: str, evict: Callable[[int], int]) -> None:
+        """
+        キャッシュの追い出し関数を登録
+
+        evict(nbytes) は少なくとも nbytes を目安に古い項目を追い出し（Allocation.release()）、
+        解放したバイト数を返す。予算のロックを持たずに呼ぶので、他のスレッドが処理中で
+        すぐに追い出せない場合は 0 を返してよい（待つとデッドロックする可能性がある）。
+        """
+        ref = weakref.WeakMethod(evict) if hasattr(evict, "__self__") else (lambda: evict)
+        with self._lock:
+            self._evictors.setdefault(category, []).append(ref)
+
+    def reserve(self, category: str, nbytes: int) -> Allocation:
+        """
+        予約（足りなければキャッシュを追い出す）
+
+        Raises:
+            MemoryBudgetExceeded: 追い出しても足りない
+        """
+        allocation = self._add(category, nbytes, force=False)
+        if allocation is None and self._reclaimable() >= self._total + nbytes - self.limit:
+            # 追い出しても足りない場合はキャッシュを無駄に捨てない
+            self._evict(self._total + nbytes - self.limit)
+            allocation = self._add(category, nbytes, force=False)
+        if allocation is None:
+            with self._lock:
+                self._rejected[category] = self._rejected.get(category, 0) + 1
+            MEMORY_BUDGET_EVENTS_TOTAL.labels(category=category, event="rejected").inc()
+            raise MemoryBudgetExceeded(category, nbytes, self.available)
+        return allocation
+
+    def track(self, category: str, nbytes: int) -> Allocation:
+        """登録（予算を超えた分はキャッシュの追い出しで解消を試みるが、失敗しない）"""
+        allocation = self._add(category, nbytes, force=True)
+        if self.limit > 0 and self._total > self.limit:
+            self._evict(self._total - self.limit)
+        return allocation
+
+    def usage(self) -> dict:
+        """現在の使用量（/api/admin/memory 用）"""
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "limit": self.limit,
+                "used": self._total,
+                "available": self.available,
+                "peak": self._peak,
+                "rss": _rss_bytes(),
+                "categories": dict(self._used),
+                "evicted": dict(self._evicted),
+                "rejected": dict(self._rejected),
+            }
+
+    def _add(self, category: str, nbytes: int, force: bool) -> Optional[Allocation]:
+        with self._lock:
+            if not force and self.limit > 0 and self._total + nbytes > self.limit:
+                return None
+            self._used[category] = self._used.get(category, 0) + nbytes
+            self._total += nbytes
+            self._peak = max(self._peak, self._total)
+            MEMORY_BUDGET_BYTES.labels(category=category).set(self._used[category])
+        return Allocation(self, category, nbytes)
+
+    def _release(self, allocation: Allocation) -> None:
+        with self._lock:
+            nbytes, allocation.nbytes = allocation.nbytes, 0
+            if not nbytes:
+                return
+            self._used[allocation.category] -= nbytes
+            self._total -= nbytes
+            MEMORY_BUDGET_BYTES.labels(category=allocation.category).set(self._used[allocation.category])
+
+    def _reclaimable(self) -> int:
+        """追い出せる可能性がある使用量（追い出し関数があるカテゴリの合計）"""
+        with self._lock:
+            return sum(self._used.get(category, 0) for category in self._evictors)
+
+    def _evict(self, needed: int) -> int:
+        """使用量の大きいカテゴリから順に追い出し、解放したバイト数を返す"""
+        with self._lock:
+            order = sorted(self._evictors, key=lambda c: self._used.get(c, 0), reverse=True)
+            evictors = {category: list(self._evictors[category]) for category in order}
+
+        freed = 0
+        for category, refs in evictors.items():
+            for ref in refs:
+                if freed >= needed:
+                    return freed
+                evict = ref()
+                if evict is None:
+                    continue
+                released = evict(needed - freed)
+                if released > 0:
+                    freed += released
+                    with self._lock:
+                        self._evicted[category] = self._evicted.get(category, 0) + released
+                    MEMORY_BUDGET_EVENTS_TOTAL.labels(category=category, event="evicted").inc()
+        return freed
+
+
+def _rss_bytes() -> Optional[int]:
+    """プロセスの常駐メモリ（Linuxのみ）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _memory_limit() -> Optional[int]:
+    """コンテナのメモリ上限（なければ物理メモリ）"""
+    for path in _CGROUP_LIMIT_PATHS:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v2 の "max"、v1 の上限なし（非常に大きい値）は無視する
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_limit() -> int:
+    """設定から予算を決める（バイト、0は上限なし）"""
+    if MEMORY_BUDGET_MB > 0:
+        return MEMORY_BUDGET_MB * 1024 * 1024
+    total = _memory_limit()
+    if total is None:
+        return 0
+    return int(total * MEMORY_BUDGET_RATIO / (1 + INFERENCE_WORKERS))
+
+
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+# 推論ワーカープロセスごとの使用量を取得する関数（main.py が登録する）
+_worker_usage: Optional[Callable[[], list[dict]]] = None
+
+
+def register_worker_usage(fn: Callable[[], list[dict]]) -> None:
+    """推論ワーカーごとの使用量（MemoryBudget.usage() のリスト）を取得する関数を登録"""
+    global _worker_usage
+    _worker_usage = fn
+
+
+def worker_usage() -> list[dict]:
+    """推論ワーカーごとの使用量（ワーカーがない場合は空。推論中のワーカーは終了を待つ）"""
+    return _worker_usage() if _worker_usage is not None else []
+
+
+def get_memory_budget() -> MemoryBudget:
+    """このプロセスのメモリ予算を取得（シングルトン）"""
+    global _budget
+    if _budget is None:
+        with _budget_lock:
+            if _budget is None:
+                _budget = MemoryBudget(default_limit())
+    return _budget
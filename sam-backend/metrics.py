@@ -0,0 +1,192 @@
+"""
+メトリクス計測
+
+処理段階ごとのレイテンシをPrometheus形式のヒストグラム/カウンタで記録する。
+/metrics エンドポイントから取得できる。
+
+リクエストに X-Server-Timing: 1 ヘッダーが付いている場合は、
+そのリクエスト内で計測した段階ごとの時間を Server-Timing レスポンスヘッダーでも返す。
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# レイテンシ用のバケット（秒）: 1ms〜30s
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "aredoko_http_request_duration_seconds",
+    "HTTPリクエストの処理時間",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+STAGE_SECONDS = Histogram(
+    "aredoko_stage_duration_seconds",
+    "処理段階ごとの処理時間（base64_decode, image_decode, set_image, predict, mask_to_result など）",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+SUPABASE_QUERY_SECONDS = Histogram(
+    "aredoko_supabase_query_duration_seconds",
+    "Supabaseクエリの処理時間",
+    ["table", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+
+STORAGE_SECONDS = Histogram(
+    "aredoko_storage_duration_seconds",
+    "Supabase Storage操作の処理時間",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+
+EMBEDDING_CACHE_TOTAL = Counter(
+    "aredoko_embedding_cache_total",
+    "画像埋め込みキャッシュの参照回数（result=hit/miss）",
+    ["cache", "result"],
+)
+
+SINGLEFLIGHT_TOTAL = Counter(
+    "aredoko_singleflight_total",
+    "推論の合流（single-flight）の回数（role=leader: 実行, follower: 実行中の処理に合流）",
+    ["kind", "role"],
+)
+
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "aredoko_inference_queue_depth",
+    "SAM推論の待ち・実行中リクエスト数",
+)
+
+INFERENCE_QUEUE_WAIT_SECONDS = Histogram(
+    "aredoko_inference_queue_wait_seconds",
+    "SAM推論の開始までのキュー待ち時間（priority別）",
+    ["priority"],
+    buckets=LATENCY_BUCKETS,
+)
+
+INFERENCE_REJECTED_TOTAL = Counter(
+    "aredoko_inference_rejected_total",
+    "推論せずに拒否・破棄したリクエスト数（reason=queue_full/deadline）",
+    ["priority", "reason"],
+)
+
+REFINEMENT_TOTAL = Counter(
+    "aredoko_refinement_total",
+    "高精度モデルでの再推論の数（result=started/completed/failed/superseded/disconnected）",
+    ["result"],
+)
+
+SEGMENT_SESSIONS = Gauge(
+    "aredoko_segment_sessions",
+    "接続中のWebSocketセグメンテーションセッション数",
+)
+
+ENTITY_CACHE_TOTAL = Counter(
+    "aredoko_entity_cache_total",
+    "倉庫・写真・オブジェクトの読み込みキャッシュの参照回数（result=hit/miss）",
+    ["entity", "result"],
+)
+
+CHANGE_FEED_SUBSCRIBERS = Gauge(
+    "aredoko_change_feed_subscribers",
+    "接続中の変更フィード（SSE）の購読者数",
+)
+
+CHANGE_EVENTS_TOTAL = Counter(
+    "aredoko_change_events_total",
+    "配信した変更イベントの数（entity, op=created/updated/deleted）",
+    ["entity", "op"],
+)
+
+MEMORY_BUDGET_BYTES = Gauge(
+    "aredoko_memory_budget_bytes",
+    "メモリ予算に登録した使用量（category=request_image/session_image/ingest_image/embeddings/current_image/mask_states/inference）",
+    ["category"],
+)
+
+MEMORY_BUDGET_EVENTS_TOTAL = Counter(
+    "aredoko_memory_budget_events_total",
+    "メモリ予算による追い出し・縮小・拒否の回数（event=evicted/downscaled/rejected）",
+    ["category", "event"],
+)
+
+BLOB_UPLOADS_TOTAL = Counter(
+    "aredoko_blob_uploads_total",
+    "画像の保存回数（result=stored: 新規に保存, deduplicated: 既存の画像を参照）",
+    ["result"],
+)
+
+# Server-Timingヘッダー用: リクエスト内で計測した (名前, 秒) のリスト
+# 計測が有効なリクエストでのみ list がセットされる
+_request_timings: ContextVar[Optional[list[tuple[str, float]]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+@contextmanager
+def _observe(histogram: Histogram, timing_name: str, **labels: str) -> Iterator[None]:
+    """ブロックの処理時間をヒストグラムとリクエスト内タイミングに記録"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.labels(**labels).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((timing_name, elapsed))
+
+
+def track_stage(stage: str):
+    """処理段階の時間を計測するコンテキストマネージャ"""
+    return _observe(STAGE_SECONDS, stage, stage=stage)
+
+
+def record_stage(stage: str, elapsed: float) -> None:
+    """別の場所（推論ワーカープロセスなど）で計測した処理段階の時間を記録"""
+    STAGE_SECONDS.labels(stage=stage).observe(elapsed)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, elapsed))
+
+
+def track_supabase(table: str, operation: str):
+    """Supabaseクエリの時間を計測するコンテキストマネージャ"""
+    return _observe(SUPABASE_QUERY_SECONDS, f"db.{table}.{operation}", table=table, operation=operation)
+
+
+def track_storage(operation: str):
+    """Storage操作の時間を計測するコンテキストマネージャ"""
+    return _observe(STORAGE_SECONDS, f"storage.{operation}", operation=operation)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """埋め込みキャッシュのヒット/ミスを記録"""
+    EMBEDDING_CACHE_TOTAL.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def start_request_timing() -> list[tuple[str, float]]:
+    """現在のリクエストでServer-Timing用の記録を開始"""
+    timings: list[tuple[str, float]] = []
+    _request_timings.set(timings)
+    return timings
+
+
+def format_server_timing(timings: list[tuple[str, float]], total: float) -> str:
+    """Server-Timingヘッダーの値を生成（durはミリ秒）"""
+    entries = [f"{name};dur={elapsed * 1000:.2f}" for name, elapsed in timings]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Prometheusテキスト形式のメトリクスと Content-Type を返す"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,9 +1,9 @@
 from .warehouse import Warehouse, WarehouseCreate, WarehouseUpdate
 from .photo import Photo, PhotoCreate, PhotoUpdate
-from .storage_object import StorageObject, StorageObjectCreate, StorageObjectUpdate
+from .storage_object import SimilarObject, StorageObject, StorageObjectCreate, StorageObjectUpdate
 
 __all__ = [
     "Warehouse", "WarehouseCreate", "WarehouseUpdate",
     "Photo", "PhotoCreate", "PhotoUpdate",
-    "StorageObject", "StorageObjectCreate", "StorageObjectUpdate",
+    "StorageObject", "StorageObjectCreate", "StorageObjectUpdate", "SimilarObject",
 ]
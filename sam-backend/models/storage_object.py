@@ -4,7 +4,7 @@
 
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Any
+from typing import Any, Optional
 
 
 class Position(BaseModel):
@@ -18,7 +18,8 @@ class StorageObjectBase(BaseModel):
 
 
 class StorageObjectCreate(StorageObjectBase):
-    clipped_image_data_url: str  # base64エンコードされたクリップ画像
+    # base64エンコードされたクリップ画像（省略時はサーバーが写真とマスクから生成）
+    clipped_image_data_url: Optional[str] = None
     mask_type: str  # 'polygon' or 'rect'
     mask_data: dict[str, Any]  # マスク情報
     click_point: Position
@@ -42,3 +43,9 @@ class StorageObject(StorageObjectBase):
 
     class Config:
         from_attributes = True
+
+
+class SimilarObject(BaseModel):
+    """類似検索の結果"""
+    object: StorageObject
+    score: float  # 特徴ベクトルのコサイン類似度（-1〜1、大きいほど似ている）
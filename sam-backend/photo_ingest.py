@@ -0,0 +1,338 @@
+"""
+写真の一括登録パイプライン
+
+複数の画像ファイル（またはZIP）を次の順で処理する:
+    デコード → EXIFの向きを適用 → 最大辺を制限 → Storageに保存 → aredoko_photos に一括挿入
+    → （任意）埋め込みの事前計算をバックグラウンド優先度で投入
+
+- 画像の処理は最大 INGEST_CONCURRENCY 件まで並列に実行し、それ以上は読み込まない
+  （バッチの件数に関わらず、メモリ上の画像は並列数 + 挿入待ちの行だけ）
+- 表示順は入力の順番（処理の完了順ではない）
+- 結果は1件ごとに進捗として返す（DBへの挿入後、または失敗時）
+- 埋め込みの事前計算は同時に INGEST_CONCURRENCY 件まで。空きがなければその写真は省略する
+  （埋め込みキャッシュに入る件数は限られるため、大量の一括登録で全件を待たせない）
+- 途中で中断された場合（クライアントの切断など）、保存済みで未挿入の画像と処理中の画像の参照は
+  バックグラウンドで外す（Storageと aredoko_blobs に参照数だけが残らないように）
+"""
+
+import asyncio
+import io
+import os
+import uuid
+import zipfile
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, ImageOps
+
+from change_feed import publish_change
+from config import (
+    INGEST_BATCH_SIZE,
+    INGEST_CONCURRENCY,
+    INGEST_JPEG_QUALITY,
+    INGEST_MAX_DIMENSION,
+    INGEST_MAX_FILE_BYTES,
+)
+from database import get_entity_cache, get_supabase_client
+from memory_budget import MemoryBudgetExceeded, get_memory_budget
+from metrics import track_stage, track_supabase
+from utils import release_image, store_image_bytes
+from utils.images import open_image
+
+# そのまま保存できる形式（向き・サイズの変更がなければ再エンコードしない）
+_PASSTHROUGH_FORMATS = {"JPEG": ("jpg", "image/jpeg"), "PNG": ("png", "image/png")}
+
+# ZIP内で無視するファイル
+_IGNORED_PREFIXES = ("__MACOSX/", ".")
+
+# 中断された一括登録の後片付け（完了まで参照を保持する）
+_cleanup_tasks: set[asyncio.Future] = set()
+
+# 埋め込みの事前計算（main.py が登録する）
+_embedding_preparer: Optional[Callable[[bytes], Awaitable[None]]] = None
+
+
+def register_embedding_preparer(preparer: Callable[[bytes], Awaitable[None]]) -> None:
+    """埋め込みの事前計算を行う関数を登録（保存した画像のバイト列を受け取る）"""
+    global _embedding_preparer
+    _embedding_preparer = preparer
+
+
+@dataclass
+class IngestSource:
+    """登録する画像1件（read() はスレッドプールで呼ばれる）"""
+    name: str
+    read: Callable[[], bytes]
+
+
+@dataclass
+class _Processed:
+    """Storageに保存済みの画像（DBへの挿入待ち）"""
+    index: int
+    name: str
+    image_path: str
+    width: int
+    height: int
+    data: Optional[bytes]  # 埋め込みの事前計算用（しない場合は None）
+
+
+def iter_upload_sources(filename: str, file) -> Iterator[IngestSource]:
+    """
+    アップロードされたファイルを画像ごとのソースに展開
+
+    ZIPの場合は中の画像ファイルを1件ずつ（展開は read() の呼び出し時）
+    """
+    if zipfile.is_zipfile(file):
+        file.seek(0)
+        archive = zipfile.ZipFile(file)
+        for info in sorted(archive.infolist(), key=lambda i: i.filename):
+            base = os.path.basename(info.filename)
+            if info.is_dir() or not base or info.filename.startswith(_IGNORED_PREFIXES) or base.startswith("."):
+                continue
+            if info.file_size > INGEST_MAX_FILE_BYTES:
+                yield IngestSource(info.filename, _too_large)
+                continue
+            yield IngestSource(info.filename, lambda info=info: archive.read(info))
+        return
+
+    file.seek(0)
+
+    def read() -> bytes:
+        data = file.read(INGEST_MAX_FILE_BYTES + 1)
+        if len(data) > INGEST_MAX_FILE_BYTES:
+            _too_large()
+        return data
+
+    yield IngestSource(filename, read)
+
+
+def _too_large() -> bytes:
+    raise ValueError(f"File is larger than {INGEST_MAX_FILE_BYTES} bytes")
+
+
+def normalize_image(data: bytes) -> tuple[bytes, str, str, int, int]:
+    """
+    画像をデコードし、EXIFの向きを適用して最大辺を制限
+
+    向き・サイズを変更する必要がないJPEG/PNGは元のバイト列のまま返す。
+
+    Returns:
+        (保存するバイト列, 拡張子, Content-Type, 幅, 高さ)
+
+    Raises:
+        ValueError: 画像として読み込めない、またはメモリ予算が足りない
+    """
+    try:
+        image = open_image(data)
+        source_format = image.format
+        orientation = image.getexif().get(0x0112, 1)
+        width, height = image.size
+        if image.width > INGEST_MAX_DIMENSION * 2 or image.height > INGEST_MAX_DIMENSION * 2:
+            # JPEGは縮小しながらデコード（元の解像度のまま展開しない）
+            image.draft("RGB", (INGEST_MAX_DIMENSION, INGEST_MAX_DIMENSION))
+    except Exception:
+        raise ValueError("Invalid image file")
+
+    passthrough = (
+        source_format in _PASSTHROUGH_FORMATS
+        and orientation == 1
+        and max(width, height) <= INGEST_MAX_DIMENSION
+    )
+    # 展開した画像（1画素最大4バイト）。向き・大きさを変える場合はその複製の分も予約する
+    try:
+        allocation = get_memory_budget().reserve(
+            "ingest_image", image.width * image.height * 4 * (1 if passthrough else 2)
+        )
+    except MemoryBudgetExceeded:
+        raise ValueError("Not enough memory to decode the image, try again later")
+
+    with allocation:
+        try:
+            image.load()
+        except Exception:
+            raise ValueError("Invalid image file")
+
+        if passthrough:
+            extension, content_type = _PASSTHROUGH_FORMATS[source_format]
+            return data, extension, content_type, width, height
+
+        return _encode_normalized(image, source_format)
+
+
+def _encode_normalized(image: Image.Image, source_format: Optional[str]) -> tuple[bytes, str, str, int, int]:
+    """EXIFの向きを適用して最大辺を制限し、再エンコード（normalize_image の後半）"""
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > INGEST_MAX_DIMENSION:
+        image.thumbnail((INGEST_MAX_DIMENSION, INGEST_MAX_DIMENSION), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    if source_format == "PNG" and image.mode in ("RGBA", "LA", "P"):
+        image.save(buffer, format="PNG")
+        extension, content_type = "png", "image/png"
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=INGEST_JPEG_QUALITY)
+        extension, content_type = "jpg", "image/jpeg"
+    return buffer.getvalue(), extension, content_type, image.width, image.height
+
+
+def _process(index: int, source: IngestSource, keep_data: bool) -> _Processed:
+    """1件をデコード・正規化してStorageに保存（スレッドプールで実行）"""
+    with track_stage("ingest_decode"):
+        data, extension, content_type, width, height = normalize_image(source.read())
+    with track_stage("ingest_upload"):
+        image_path = store_image_bytes(data, extension, content_type)
+    name = os.path.splitext(os.path.basename(source.name))[0] or source.name
+    return _Processed(index, name, image_path, width, height, data if keep_data else None)
+
+
+def _insert_batch(warehouse_id: str, batch: list[_Processed], first_order: int) -> list[dict]:
+    """保存済みの画像をまとめて aredoko_photos に挿入"""
+    client = get_supabase_client()
+    with track_supabase("aredoko_photos", "insert"):
+        response = client.table("aredoko_photos").insert([
+            {
+                "id": str(uuid.uuid4()),
+                "warehouse_id": warehouse_id,
+                "name": item.name,
+                "image_path": item.image_path,
+                "width": item.width,
+                "height": item.height,
+                "display_order": first_order + item.index,
+            }
+            for item in batch
+        ]).execute()
+    return response.data
+
+
+async def _release_unflushed(image_paths: list[str], pending: list[asyncio.Future]) -> None:
+    """中断された一括登録で、保存済みの画像と処理中の画像（完了を待つ）の参照を外す"""
+    for future in asyncio.as_completed(pending):
+        try:
+            image_paths.append((await future).image_path)
+        except Exception:
+            # 保存前に失敗した画像は外す参照がない
+            continue
+    for image_path in image_paths:
+        try:
+            await run_in_threadpool(release_image, image_path)
+        except Exception as e:
+            print(f"Bulk photo cleanup error ({image_path}): {e}")
+
+
+def _discard_unflushed(batch: list[_Processed], pending: Iterable[asyncio.Future]) -> None:
+    """挿入していない画像の参照をバックグラウンドで外す（中断中の呼び出し元は待たせない）"""
+    image_paths = [item.image_path for item in batch]
+    pending = list(pending)
+    if not image_paths and not pending:
+        return
+    task = asyncio.ensure_future(_release_unflushed(image_paths, pending))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+async def ingest_photos(
+    warehouse_id: str,
+    sources: Iterable[IngestSource],
+    to_response: Callable[[dict], dict],
+    prepare_embeddings: bool = False,
+) -> AsyncIterator[dict]:
+    """
+    写真を一括登録し、1件ごとの進捗を返す
+
+    Args:
+        warehouse_id: 倉庫ID
+        sources: 登録する画像（必要になった分だけ順に読み込む）
+        to_response: DBの行を写真のレスポンスに変換する関数
+        prepare_embeddings: 埋め込みの事前計算を投入するか
+
+    進捗:
+        {"index": 0, "name": "...", "status": "created", "photo": {写真のレスポンス}, "embedding": "queued"}
+        {"index": 1, "name": "...", "status": "failed", "error": "..."}
+        最後に {"status": "done", "created": N, "failed": M}
+    """
+    client = get_supabase_client()
+    with track_supabase("aredoko_photos", "select"):
+        existing = client.table("aredoko_photos").select("display_order").eq("warehouse_id", warehouse_id).order("display_order", desc=True).limit(1).execute()
+    first_order = (existing.data[0]["display_order"] + 1) if existing.data else 0
+
+    prepare_embeddings = prepare_embeddings and _embedding_preparer is not None
+    counts = {"created": 0, "failed": 0}
+    embedding_tasks: set[asyncio.Future] = set()
+    pending: dict[asyncio.Future, tuple[int, str]] = {}
+    batch: list[_Processed] = []
+
+    def failed(index: int, name: str, error: str) -> dict:
+        counts["failed"] += 1
+        return {"index": index, "name": name, "status": "failed", "error": error}
+
+    async def flush() -> list[dict]:
+        items = batch[:]
+        batch.clear()
+        try:
+            rows = await run_in_threadpool(_insert_batch, warehouse_id, items, first_order)
+        except Exception as e:
+            print(f"Bulk photo insert error: {e}")
+            for item in items:
+                await run_in_threadpool(release_image, item.image_path)
+            return [failed(item.index, item.name, "DBへの登録に失敗しました") for item in items]
+
+        progress = []
+        cache = get_entity_cache()
+        for item, row in zip(items, rows):
+            cache.put("photo", row)
+            photo = to_response(row)
+            publish_change(warehouse_id, "photo", "created", row["id"], row["version"], photo)
+            counts["created"] += 1
+            result = {"index": item.index, "name": item.name, "status": "created", "photo": photo}
+            if prepare_embeddings:
+                result["embedding"] = queue_embedding(item.data)
+            progress.append(result)
+        return progress
+
+    def queue_embedding(data: bytes) -> str:
+        if len(embedding_tasks) >= INGEST_CONCURRENCY:
+            return "skipped"
+        task = asyncio.ensure_future(_embedding_preparer(data))
+        embedding_tasks.add(task)
+        task.add_done_callback(embedding_tasks.discard)
+        return "queued"
+
+    async def collect(done: set[asyncio.Future]) -> AsyncIterator[dict]:
+        for future in done:
+            index, name = pending.pop(future)
+            try:
+                batch.append(future.result())
+            except ValueError as e:
+                yield failed(index, name, str(e))
+                continue
+            except Exception as e:
+                print(f"Bulk photo ingest error ({name}): {e}")
+                yield failed(index, name, "画像の保存に失敗しました")
+                continue
+            if len(batch) >= INGEST_BATCH_SIZE:
+                for progress in await flush():
+                    yield progress
+
+    try:
+        for index, source in enumerate(sources):
+            if len(pending) >= INGEST_CONCURRENCY:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                async for progress in collect(done):
+                    yield progress
+            future = asyncio.ensure_future(run_in_threadpool(_process, index, source, prepare_embeddings))
+            pending[future] = (index, source.name)
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            async for progress in collect(done):
+                yield progress
+        if batch:
+            for progress in await flush():
+                yield progress
+    finally:
+        # 中断された場合（正常に終われば batch も pending も空）
+        _discard_unflushed(batch, pending)
+        batch.clear()
+
+    yield {"status": "done", **counts}
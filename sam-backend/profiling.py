@@ -0,0 +1,173 @@
+"""
+本番環境でのプロファイリング
+
+セグメンテーションのレイテンシが急に悪化したときに、時間がPILのデコード・エンコーダー・cv2・
+Supabaseのどこで使われたかを調べるための仕組み。API は routers/admin.py（管理者のみ）。
+
+- サンプリングプロファイラ: 指定した秒数の間、全スレッドのスタックを一定間隔で記録し、
+  折りたたみ形式（collapsed stacks: "スレッド;関数;関数 回数"）で返す。
+  flamegraph.pl や speedscope でそのまま開ける
+- 遅いリクエストの記録: SLOW_REQUEST_SECONDS を超えたリクエストの段階ごとの時間
+  （track_stage / track_supabase / track_storage で計測したもの）を直近 SLOW_REQUEST_BUFFER 件残す
+- cProfile: SLOW_REQUEST_PROFILE_RATE の割合のリクエストをcProfileで計測し、遅かった場合だけ
+  pstats形式のダンプを記録に添付する。計測はイベントループのスレッドのみ（同時に実行中の
+  他のリクエストの処理も含まれる。推論などスレッドプールの処理は段階ごとの時間を参照）
+
+推論ワーカープロセス（INFERENCE_WORKERS > 0）の中はサンプリングの対象外。
+ワーカーで計測した段階ごとの時間は、遅いリクエストの記録に含まれる。
+"""
+
+import cProfile
+import itertools
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional
+
+from config import SLOW_REQUEST_BUFFER, SLOW_REQUEST_PROFILE_RATE
+
+# 待機中とみなすスタックの末尾（関数名, ファイル名）。idle=False の場合は記録しない
+_IDLE_FRAMES = {
+    ("wait", "threading.py"),
+    ("select", "selectors.py"),
+    ("get", "queue.py"),
+    ("_worker", "thread.py"),
+    ("accept", "connection.py"),
+    ("poll", "connection.py"),
+}
+
+
+class ProfilerBusyError(RuntimeError):
+    """サンプリングプロファイラが他の計測で使用中"""
+
+
+_sampling_lock = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.005, idle: bool = False) -> str:
+    """
+    全スレッドのスタックをサンプリング（呼び出したスレッドは seconds 秒ブロックする）
+
+    Args:
+        seconds: 計測時間
+        interval: サンプリング間隔（秒）
+        idle: 待機中のスレッドのスタックも記録する
+
+    Returns:
+        折りたたみ形式のスタック（回数の多い順）
+
+    Raises:
+        ProfilerBusyError: 他の計測が実行中
+    """
+    if not _sampling_lock.acquire(blocking=False):
+        raise ProfilerBusyError()
+    try:
+        own = threading.get_ident()
+        counts: Counter[str] = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                code = frame.f_code
+                if not idle and (code.co_name, os.path.basename(code.co_filename)) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _sampling_lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+class SlowRequestLog:
+    """遅いリクエストの記録（直近 max_entries 件のリングバッファ）"""
+
+    def __init__(self, max_entries: int = 50):
+        self._entries: deque[dict] = deque(maxlen=max_entries)
+        # cProfileのダンプ: 記録ID -> pstats形式のバイト列（記録と一緒に古い順に捨てる）
+        self._profiles: dict[str, bytes] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        method: str,
+        path: str,
+        route: str,
+        status: int,
+        elapsed: float,
+        timings: list[tuple[str, float]],
+        profile: Optional[bytes] = None,
+    ) -> None:
+        """遅いリクエストを記録"""
+        entry = {
+            "id": f"{os.getpid()}-{next(self._ids)}",
+            "pid": os.getpid(),
+            "time": time.time() - elapsed,
+            "method": method,
+            "path": path,
+            "route": route,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 2),
+            "stages": [{"name": name, "duration_ms": round(t * 1000, 2)} for name, t in timings],
+            "has_profile": profile is not None,
+        }
+        with self._lock:
+            if len(self._entries) == self._entries.maxlen:
+                self._profiles.pop(self._entries[0]["id"], None)
+            self._entries.append(entry)
+            if profile is not None:
+                self._profiles[entry["id"]] = profile
+
+    def entries(self) -> list[dict]:
+        """記録（新しい順）"""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def profile(self, entry_id: str) -> Optional[bytes]:
+        """記録に添付したcProfileのダンプ"""
+        with self._lock:
+            return self._profiles.get(entry_id)
+
+
+slow_requests = SlowRequestLog(SLOW_REQUEST_BUFFER)
+
+# cProfileで計測中のリクエストがあるか（Pythonのプロファイラはスレッドごとに1つ）
+_request_profile_active = False
+
+
+def start_request_profile() -> Optional[cProfile.Profile]:
+    """SLOW_REQUEST_PROFILE_RATE の割合でリクエストのcProfileを開始（計測中のリクエストがあれば None）"""
+    global _request_profile_active
+    if _request_profile_active or SLOW_REQUEST_PROFILE_RATE <= 0 or random.random() >= SLOW_REQUEST_PROFILE_RATE:
+        return None
+    _request_profile_active = True
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop_request_profile(profile: cProfile.Profile, keep: bool) -> Optional[bytes]:
+    """cProfileを停止し、keep の場合は pstats.Stats で読み込める形式のダンプを返す"""
+    global _request_profile_active
+    profile.disable()
+    _request_profile_active = False
+    if not keep:
+        return None
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
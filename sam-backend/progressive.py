@@ -0,0 +1,75 @@
+"""
+段階的セグメンテーション（プレビュー → 高精度モデルでの再推論）
+
+クリック時は軽量モデル（vit_b など）の結果をすぐに返し、高精度モデル（vit_h など）の
+再推論をバックグラウンドで実行する。結果はServer-Sent Eventsで受け取る。
+
+- 再推論は refinement_id で識別する
+- 同じセッションで新しいクリックがあった場合は、古い再推論を取り消す（ユーザーが次に進んだため）
+- SSEの接続が切れた場合も取り消す
+- 完了した結果は一定時間だけ保持する（SSEの接続が完了より遅れても受け取れるように）
+"""
+
+import asyncio
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from metrics import REFINEMENT_TOTAL
+
+
+class RefinementRegistry:
+    """実行中・完了済みの再推論を管理する"""
+
+    def __init__(self, result_ttl: float = 60.0):
+        """
+        Args:
+            result_ttl: 完了した結果を保持する秒数
+        """
+        self.result_ttl = result_ttl
+        # refinement_id -> タスク
+        self._tasks: dict[str, asyncio.Task] = {}
+        # session_id -> 最新の refinement_id
+        self._latest: dict[str, str] = {}
+
+    def start(
+        self,
+        session_id: Optional[str],
+        fn: Callable[[], Awaitable[Optional[dict]]],
+    ) -> str:
+        """
+        再推論を開始して refinement_id を返す
+
+        session_id が同じ再推論が実行中であれば取り消す。
+        """
+        if session_id is not None:
+            previous = self._latest.get(session_id)
+            if previous is not None:
+                self.cancel(previous, reason="superseded")
+
+        refinement_id = uuid.uuid4().hex
+        task = asyncio.ensure_future(fn())
+        self._tasks[refinement_id] = task
+        if session_id is not None:
+            self._latest[session_id] = refinement_id
+        task.add_done_callback(lambda t: self._finish(refinement_id, session_id, t))
+        REFINEMENT_TOTAL.labels(result="started").inc()
+        return refinement_id
+
+    def get(self, refinement_id: str) -> Optional[asyncio.Task]:
+        """再推論のタスク（存在しない・期限切れの場合は None）"""
+        return self._tasks.get(refinement_id)
+
+    def cancel(self, refinement_id: str, reason: str = "disconnected") -> None:
+        """実行中の再推論を取り消す（キュー内であれば推論自体が行われない）"""
+        task = self._tasks.get(refinement_id)
+        if task is not None and not task.done():
+            task.cancel()
+            REFINEMENT_TOTAL.labels(result=reason).inc()
+
+    def _finish(self, refinement_id: str, session_id: Optional[str], task: asyncio.Task) -> None:
+        if session_id is not None and self._latest.get(session_id) == refinement_id:
+            del self._latest[session_id]
+        if not task.cancelled():
+            REFINEMENT_TOTAL.labels(result="failed" if task.exception() else "completed").inc()
+        # 結果は一定時間後に破棄
+        asyncio.get_running_loop().call_later(self.result_ttl, self._tasks.pop, refinement_id, None)
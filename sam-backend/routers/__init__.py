@@ -1,5 +1,7 @@
 from .warehouses import router as warehouses_router
 from .photos import router as photos_router
 from .objects import router as objects_router
+from .storage import router as storage_router
+from .admin import router as admin_router
 
-__all__ = ["warehouses_router", "photos_router", "objects_router"]
+__all__ = ["warehouses_router", "photos_router", "objects_router", "storage_router", "admin_router"]
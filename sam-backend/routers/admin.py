@@ -0,0 +1,95 @@
+"""
+管理用APIルーター（プロファイリング・メモリ使用量）
+
+Authorization: Bearer {ADMIN_TOKEN} が必要。ADMIN_TOKEN が未設定の場合は全て404を返す。
+複数のワーカープロセスで動かしている場合、各リクエストは受け付けたプロセスの情報だけを返す
+（記録の pid で区別できる）。
+"""
+
+import hmac
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from config import ADMIN_TOKEN, PROFILE_MAX_SECONDS
+from memory_budget import get_memory_budget, worker_usage
+from profiling import ProfilerBusyError, sample_stacks, slow_requests
+
+
+def require_admin(request: Request) -> None:
+    """管理者トークンを確認"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+
+router = APIRouter(prefix="/api/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/profile")
+async def capture_profile(seconds: float = 10, interval_ms: float = 5, idle: bool = False):
+    """
+    このワーカープロセスの全スレッドを seconds 秒間サンプリング
+
+    折りたたみ形式（flamegraph.pl / speedscope で開ける）のテキストを返す。
+    同時に実行できる計測は1つだけ（実行中は409）。
+
+    - interval_ms: サンプリング間隔（ミリ秒）
+    - idle: 待機中のスレッドも記録する
+    """
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+
+    try:
+        stacks = await run_in_threadpool(sample_stacks, seconds, interval_ms / 1000, idle)
+    except ProfilerBusyError:
+        raise HTTPException(status_code=409, detail="Another profile is running")
+
+    filename = time.strftime("profile-%Y%m%d-%H%M%S.folded")
+    return Response(
+        content=stacks,
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get("/slow-requests")
+async def list_slow_requests():
+    """遅いリクエストの記録（新しい順、段階ごとの時間を含む）"""
+    return ORJSONResponse(slow_requests.entries())
+
+
+@router.get("/slow-requests/{entry_id}/profile")
+async def download_slow_request_profile(entry_id: str):
+    """
+    遅いリクエストのcProfileのダンプ（pstats形式）
+
+    python -m pstats で読み込むか、snakeviz などで開く。
+    """
+    profile = slow_requests.profile(entry_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(
+        content=profile,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="slow-request-{entry_id}.prof"'},
+    )
+
+
+@router.get("/memory")
+async def memory_usage():
+    """
+    メモリ予算の使用量
+
+    カテゴリごとの使用量、ピーク、追い出し（バイト数）・拒否（回数）の累計、プロセスの常駐メモリを返す。
+    推論ワーカープロセスがある場合は workers にワーカーごとの使用量を返す（推論中のワーカーは終了を待つ）。
+    """
+    return ORJSONResponse({
+        "process": get_memory_budget().usage(),
+        "workers": await run_in_threadpool(worker_usage),
+    })
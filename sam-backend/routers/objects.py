@@ -3,10 +3,27 @@
 """
 
 import uuid
-from fastapi import APIRouter, HTTPException
-from database import get_supabase_client
-from models import StorageObject, StorageObjectCreate, StorageObjectUpdate
-from utils import upload_image, delete_image, get_image_url
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from change_feed import publish_change
+from config import SIMILARITY_MAX_RESULTS
+from database import get_entity_cache, get_supabase_client
+from metrics import track_supabase
+from models import SimilarObject, StorageObject, StorageObjectCreate, StorageObjectUpdate
+from similarity import find_similar, forget_objects, schedule_object_feature
+from utils import get_image_url, read_image, release_image, store_image, store_image_bytes
+from utils.clipping import render_clip
+from utils.optimistic_lock import apply_update, load_for_update
+from utils.http_cache import (
+    is_conditional,
+    is_not_modified,
+    not_modified_response,
+    set_cache_headers,
+    strong_etag,
+    weak_etag,
+)
 
 router = APIRouter(prefix="/api", tags=["objects"])
 
@@ -19,79 +36,218 @@ def _to_object_response(data: dict) -> dict:
     return result
 
 
+def _get_photo(photo_id: str) -> dict:
+    """写真を取得（存在しない場合は404）"""
+    photo = get_entity_cache().get("photo", photo_id)
+    if photo is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return photo
+
+
+def _publish_object_change(
+    photo_id: str,
+    op: str,
+    object_id: str,
+    version: Optional[int] = None,
+    changes: Optional[dict] = None,
+) -> None:
+    """オブジェクトの変更イベントを、写真が属する倉庫に発行"""
+    photo = get_entity_cache().get("photo", photo_id)
+    if photo is not None:
+        publish_change(photo["warehouse_id"], "object", op, object_id, version, changes, photo_id=photo_id)
+
+
+def _store_clip(image_bytes: bytes, mask_type: str, mask_data: dict) -> str:
+    """写真とマスクからクリップ画像を生成して保存（マスクが不正な場合は400）"""
+    try:
+        clip, extension, content_type = render_clip(image_bytes, mask_type, mask_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return store_image_bytes(clip, extension, content_type)
+
+
 @router.get("/photos/{photo_id}/objects", response_model=list[StorageObject])
-async def list_objects(photo_id: str):
-    """写真内のオブジェクト一覧を取得"""
+async def list_objects(photo_id: str, request: Request):
+    """写真内のオブジェクト一覧を取得（ETag付き）"""
     client = get_supabase_client()
-    response = client.table("aredoko_objects").select("*").eq("photo_id", photo_id).order("display_order").execute()
-    return [_to_object_response(o) for o in response.data]
+
+    # 条件付きリクエストの場合は、バージョン情報だけでETagを計算し、変更がなければ本体と画像URLを取得しない
+    if is_conditional(request):
+        with track_supabase("aredoko_objects", "select"):
+            versions = client.table("aredoko_objects").select("id, version, updated_at").eq("photo_id", photo_id).order("display_order").execute()
+        etag = weak_etag(versions.data, with_urls=True)
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+    with track_supabase("aredoko_objects", "select"):
+        response = client.table("aredoko_objects").select("*").eq("photo_id", photo_id).order("display_order").execute()
+
+    # 一覧はmask_dataなどが大きいため、モデルの検証を通さずorjsonで直接シリアライズ
+    body = ORJSONResponse([_to_object_response(o) for o in response.data])
+    set_cache_headers(body, weak_etag(response.data, with_urls=True))
+    return body
 
 
 @router.get("/objects/{object_id}", response_model=StorageObject)
-async def get_object(object_id: str):
-    """オブジェクトを取得"""
-    client = get_supabase_client()
-    response = client.table("aredoko_objects").select("*").eq("id", object_id).single().execute()
-    if not response.data:
+async def get_object(object_id: str, request: Request, http_response: Response):
+    """オブジェクトを取得（ETag付き）"""
+    obj = get_entity_cache().get("object", object_id)
+    if obj is None:
         raise HTTPException(status_code=404, detail="Object not found")
-    return _to_object_response(response.data)
+
+    etag = strong_etag(obj, with_urls=True)
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+    set_cache_headers(http_response, etag)
+    return _to_object_response(obj)
 
 
 @router.post("/photos/{photo_id}/objects", response_model=StorageObject, status_code=201)
 async def create_object(photo_id: str, data: StorageObjectCreate):
-    """オブジェクトを作成"""
+    """オブジェクトを作成（類似検索用の特徴ベクトルは作成後にバックグラウンドで計算）"""
     client = get_supabase_client()
+    photo = _get_photo(photo_id)
 
     # display_orderを取得
-    existing = client.table("aredoko_objects").select("display_order").eq("photo_id", photo_id).order("display_order", desc=True).limit(1).execute()
+    with track_supabase("aredoko_objects", "select"):
+        existing = client.table("aredoko_objects").select("display_order").eq("photo_id", photo_id).order("display_order", desc=True).limit(1).execute()
     next_order = (existing.data[0]["display_order"] + 1) if existing.data else 0
 
-    # クリップ画像をStorageにアップロード
+    # クリップ画像をStorageに保存（同じ画像が既にあればアップロードしない）
+    # 省略された場合は保存済みの写真とマスクからサーバー側で生成する
     object_id = str(uuid.uuid4())
-    image_path = f"objects/{object_id}.png"
-    upload_image(image_path, data.clipped_image_data_url)
+    if data.clipped_image_data_url is not None:
+        image_path = await run_in_threadpool(store_image, data.clipped_image_data_url)
+    else:
+        photo_bytes = await run_in_threadpool(read_image, photo["image_path"])
+        image_path = await run_in_threadpool(_store_clip, photo_bytes, data.mask_type, data.mask_data)
 
     # DBに保存
-    response = client.table("aredoko_objects").insert({
-        "id": object_id,
-        "photo_id": photo_id,
-        "name": data.name,
-        "memo": data.memo,
-        "clipped_image_path": image_path,
-        "mask_type": data.mask_type,
-        "mask_data": data.mask_data,
-        "click_point": {"x": data.click_point.x, "y": data.click_point.y},
-        "display_order": next_order,
-    }).execute()
-    return _to_object_response(response.data[0])
+    try:
+        with track_supabase("aredoko_objects", "insert"):
+            response = client.table("aredoko_objects").insert({
+                "id": object_id,
+                "photo_id": photo_id,
+                "name": data.name,
+                "memo": data.memo,
+                "clipped_image_path": image_path,
+                "mask_type": data.mask_type,
+                "mask_data": data.mask_data,
+                "click_point": {"x": data.click_point.x, "y": data.click_point.y},
+                "display_order": next_order,
+            }).execute()
+    except Exception:
+        await run_in_threadpool(release_image, image_path)
+        raise
+    get_entity_cache().put("object", response.data[0])
+    schedule_object_feature(photo["warehouse_id"], photo, response.data[0])
+    obj = _to_object_response(response.data[0])
+    _publish_object_change(photo_id, "created", object_id, obj["version"], obj)
+    return obj
 
 
-@router.put("/objects/{object_id}", response_model=StorageObject)
-async def update_object(object_id: str, data: StorageObjectUpdate):
-    """オブジェクトを更新（楽観的ロック付き）"""
-    client = get_supabase_client()
+@router.get("/objects/{object_id}/similar", response_model=list[SimilarObject])
+async def similar_objects(object_id: str, limit: int = 10):
+    """
+    同じ倉庫で見た目が似ているオブジェクトを類似度の高い順に取得
 
-    # 現在のバージョンを確認
-    current = client.table("aredoko_objects").select("*").eq("id", object_id).single().execute()
-    if not current.data:
+    登録時に計算した特徴ベクトルをプロセス内の索引で比較する（モデルは呼ばない）。
+    特徴ベクトルがまだない場合は計算を開始して409を返す。
+    """
+    obj = get_entity_cache().get("object", object_id)
+    if obj is None:
         raise HTTPException(status_code=404, detail="Object not found")
+    photo = _get_photo(obj["photo_id"])
 
-    if current.data["version"] != data.version:
+    limit = max(1, min(limit, SIMILARITY_MAX_RESULTS))
+    matches = await find_similar(photo["warehouse_id"], object_id, limit)
+    if matches is None:
+        schedule_object_feature(photo["warehouse_id"], photo, obj)
         raise HTTPException(
             status_code=409,
-            detail={
-                "code": "VERSION_CONFLICT",
-                "message": "データが他で更新されました",
-                "server_data": current.data,
-            }
+            detail="Object features are not ready",
+            headers={"Retry-After": "5"},
         )
+    if not matches:
+        return ORJSONResponse([])
+
+    client = get_supabase_client()
+    with track_supabase("aredoko_objects", "select"):
+        response = client.table("aredoko_objects").select("*").in_("id", [m[0] for m in matches]).execute()
+    rows = {row["id"]: row for row in response.data}
+
+    # 索引が古く、削除済みのオブジェクトが含まれる場合は除く
+    return ORJSONResponse([
+        {"object": _to_object_response(rows[match_id]), "score": score}
+        for match_id, score in matches
+        if match_id in rows
+    ])
+
+
+@router.post("/photos/{photo_id}/objects/reclip", response_model=list[StorageObject])
+async def reclip_objects(photo_id: str):
+    """
+    写真内の全オブジェクトのクリップ画像を写真とマスクから作り直す
+
+    マスク形式やクリップ画像の形式・サイズを変更したときの一括更新用。
+    画像が変わったオブジェクトだけを更新する（バージョンが上がる）。
+    読み込んでから更新するまでの間に他で更新・削除されたオブジェクトは上書きせずに残す
+    （更新は読み込んだ version を条件にする）。
+    """
+    client = get_supabase_client()
+    photo_bytes = await run_in_threadpool(read_image, _get_photo(photo_id)["image_path"])
+
+    with track_supabase("aredoko_objects", "select"):
+        objects = client.table("aredoko_objects").select("*").eq("photo_id", photo_id).order("display_order").execute()
+
+    results = []
+    for obj in objects.data:
+        old_path = obj["clipped_image_path"]
+        try:
+            new_path = await run_in_threadpool(_store_clip, photo_bytes, obj["mask_type"], obj["mask_data"])
+        except HTTPException as e:
+            # マスクが不正なオブジェクトは元の画像のまま残す
+            print(f"Skipped reclipping object {obj['id']}: {e.detail}")
+            results.append(obj)
+            continue
+        if new_path == old_path:
+            # 内容が同じ: 今回増やした参照を戻す
+            await run_in_threadpool(release_image, new_path)
+            results.append(obj)
+            continue
+
+        try:
+            updated = apply_update(
+                "object", obj["id"], obj["version"], {"clipped_image_path": new_path}, "Object not found"
+            )
+        except HTTPException as e:
+            # 他で更新・削除された: 新しいクリップ画像の参照を戻し、最新の行（削除された場合は除く）を返す
+            await run_in_threadpool(release_image, new_path)
+            print(f"Skipped reclipping object {obj['id']}: modified concurrently")
+            if e.status_code == 409:
+                results.append(e.detail["server_data"])
+            continue
+
+        await run_in_threadpool(release_image, old_path)
+        results.append(updated)
+        _publish_object_change(photo_id, "updated", obj["id"], updated["version"], {
+            "clipped_image_url": get_image_url(new_path),
+        })
+
+    return ORJSONResponse([_to_object_response(o) for o in results])
+
+
+@router.put("/objects/{object_id}", response_model=StorageObject)
+async def update_object(object_id: str, data: StorageObjectUpdate):
+    """オブジェクトを更新（楽観的ロック付き）"""
+    # 現在のバージョンを確認
+    current = load_for_update("object", object_id, data.version, "Object not found")
 
     # 更新
-    response = client.table("aredoko_objects").update({
-        "name": data.name,
-        "memo": data.memo,
-    }).eq("id", object_id).execute()
-    return _to_object_response(response.data[0])
+    changes = {"name": data.name, "memo": data.memo}
+    updated = apply_update("object", object_id, data.version, changes, "Object not found")
+    _publish_object_change(current["photo_id"], "updated", object_id, updated["version"], changes)
+    return _to_object_response(updated)
 
 
 @router.delete("/objects/{object_id}", status_code=204)
@@ -100,10 +256,18 @@ async def delete_object(object_id: str):
     client = get_supabase_client()
 
     # 画像パスを取得
-    obj = client.table("aredoko_objects").select("clipped_image_path").eq("id", object_id).single().execute()
-    if obj.data:
-        # Storageから画像を削除
-        delete_image(obj.data["clipped_image_path"])
+    cache = get_entity_cache()
+    obj = cache.get("object", object_id)
 
     # DBから削除
-    client.table("aredoko_objects").delete().eq("id", object_id).execute()
+    with track_supabase("aredoko_objects", "delete"):
+        client.table("aredoko_objects").delete().eq("id", object_id).execute()
+    cache.invalidate("object", object_id)
+
+    if obj is not None:
+        _publish_object_change(obj["photo_id"], "deleted", object_id)
+        photo = cache.get("photo", obj["photo_id"])
+        if photo is not None:
+            forget_objects(photo["warehouse_id"], object_id)
+        # 画像の参照を外す（他から参照されていなければStorageから削除）
+        await run_in_threadpool(release_image, obj["clipped_image_path"])
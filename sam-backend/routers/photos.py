@@ -2,11 +2,29 @@
 写真APIルーター
 """
 
+import shutil
+import tempfile
 import uuid
-from fastapi import APIRouter, HTTPException
-from database import get_supabase_client
+import orjson
+from fastapi import APIRouter, File, HTTPException, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from change_feed import publish_change
+from database import get_entity_cache, get_supabase_client
+from metrics import track_supabase
 from models import Photo, PhotoCreate, PhotoUpdate
-from utils import upload_image, delete_image, get_image_url
+from photo_ingest import ingest_photos, iter_upload_sources
+from similarity import forget_objects
+from utils import get_image_url, release_image, store_image
+from utils.optimistic_lock import apply_update, load_for_update
+from utils.http_cache import (
+    is_conditional,
+    is_not_modified,
+    not_modified_response,
+    set_cache_headers,
+    strong_etag,
+    weak_etag,
+)
 
 router = APIRouter(prefix="/api", tags=["photos"])
 
@@ -20,21 +38,39 @@ def _to_photo_response(data: dict) -> dict:
 
 
 @router.get("/warehouses/{warehouse_id}/photos", response_model=list[Photo])
-async def list_photos(warehouse_id: str):
-    """倉庫内の写真一覧を取得"""
+async def list_photos(warehouse_id: str, request: Request):
+    """倉庫内の写真一覧を取得（ETag付き）"""
     client = get_supabase_client()
-    response = client.table("aredoko_photos").select("*").eq("warehouse_id", warehouse_id).order("display_order").execute()
-    return [_to_photo_response(p) for p in response.data]
+
+    # 条件付きリクエストの場合は、バージョン情報だけでETagを計算し、変更がなければ本体と画像URLを取得しない
+    if is_conditional(request):
+        with track_supabase("aredoko_photos", "select"):
+            versions = client.table("aredoko_photos").select("id, version, updated_at").eq("warehouse_id", warehouse_id).order("display_order").execute()
+        etag = weak_etag(versions.data, with_urls=True)
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+    with track_supabase("aredoko_photos", "select"):
+        response = client.table("aredoko_photos").select("*").eq("warehouse_id", warehouse_id).order("display_order").execute()
+
+    # 一覧は件数が多いため、モデルの検証を通さずorjsonで直接シリアライズ
+    body = ORJSONResponse([_to_photo_response(p) for p in response.data])
+    set_cache_headers(body, weak_etag(response.data, with_urls=True))
+    return body
 
 
 @router.get("/photos/{photo_id}", response_model=Photo)
-async def get_photo(photo_id: str):
-    """写真を取得"""
-    client = get_supabase_client()
-    response = client.table("aredoko_photos").select("*").eq("id", photo_id).single().execute()
-    if not response.data:
+async def get_photo(photo_id: str, request: Request, http_response: Response):
+    """写真を取得（ETag付き）"""
+    photo = get_entity_cache().get("photo", photo_id)
+    if photo is None:
         raise HTTPException(status_code=404, detail="Photo not found")
-    return _to_photo_response(response.data)
+
+    etag = strong_etag(photo, with_urls=True)
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+    set_cache_headers(http_response, etag)
+    return _to_photo_response(photo)
 
 
 @router.post("/warehouses/{warehouse_id}/photos", response_model=Photo, status_code=201)
@@ -43,52 +79,82 @@ async def create_photo(warehouse_id: str, data: PhotoCreate):
     client = get_supabase_client()
 
     # display_orderを取得
-    existing = client.table("aredoko_photos").select("display_order").eq("warehouse_id", warehouse_id).order("display_order", desc=True).limit(1).execute()
+    with track_supabase("aredoko_photos", "select"):
+        existing = client.table("aredoko_photos").select("display_order").eq("warehouse_id", warehouse_id).order("display_order", desc=True).limit(1).execute()
     next_order = (existing.data[0]["display_order"] + 1) if existing.data else 0
 
-    # 画像をStorageにアップロード
+    # 画像をStorageに保存（同じ画像が既にあればアップロードしない）
     photo_id = str(uuid.uuid4())
-    image_path = f"photos/{photo_id}.jpg"
-    upload_image(image_path, data.image_data_url)
+    image_path = await run_in_threadpool(store_image, data.image_data_url)
 
     # DBに保存
-    response = client.table("aredoko_photos").insert({
-        "id": photo_id,
-        "warehouse_id": warehouse_id,
-        "name": data.name,
-        "image_path": image_path,
-        "width": data.width,
-        "height": data.height,
-        "display_order": next_order,
-    }).execute()
-    return _to_photo_response(response.data[0])
+    try:
+        with track_supabase("aredoko_photos", "insert"):
+            response = client.table("aredoko_photos").insert({
+                "id": photo_id,
+                "warehouse_id": warehouse_id,
+                "name": data.name,
+                "image_path": image_path,
+                "width": data.width,
+                "height": data.height,
+                "display_order": next_order,
+            }).execute()
+    except Exception:
+        await run_in_threadpool(release_image, image_path)
+        raise
+    get_entity_cache().put("photo", response.data[0])
+    photo = _to_photo_response(response.data[0])
+    publish_change(warehouse_id, "photo", "created", photo_id, photo["version"], photo)
+    return photo
+
+
+@router.post("/warehouses/{warehouse_id}/photos/bulk")
+async def bulk_create_photos(
+    warehouse_id: str,
+    files: list[UploadFile] = File(...),
+    prepare_embeddings: bool = False,
+):
+    """
+    写真を一括登録（multipart/form-data の files に画像ファイルまたはZIPを複数指定）
+
+    デコード・EXIFの向きの適用・解像度の制限・保存を並列に行い、DBにはまとめて挿入する。
+    進捗は1件ごとにNDJSON（1行1件）で返す。形式は photo_ingest.py を参照。
+
+    - prepare_embeddings: SAMの埋め込みを事前に計算する（バックグラウンド優先度、空きがある分だけ）
+    """
+    if get_entity_cache().get("warehouse", warehouse_id) is None:
+        raise HTTPException(status_code=404, detail="Warehouse not found")
+
+    # アップロードされたファイルはレスポンスの送信前に閉じられるため、一時ファイルに移しておく
+    spooled = []
+    for upload in files:
+        copy = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        await run_in_threadpool(shutil.copyfileobj, upload.file, copy)
+        spooled.append((upload.filename or "photo", copy))
+    sources = (source for filename, copy in spooled for source in iter_upload_sources(filename, copy))
+
+    async def progress():
+        try:
+            async for item in ingest_photos(warehouse_id, sources, _to_photo_response, prepare_embeddings):
+                yield orjson.dumps(item) + b"\n"
+        finally:
+            for _, copy in spooled:
+                copy.close()
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
 
 
 @router.put("/photos/{photo_id}", response_model=Photo)
 async def update_photo(photo_id: str, data: PhotoUpdate):
     """写真を更新（楽観的ロック付き）"""
-    client = get_supabase_client()
-
     # 現在のバージョンを確認
-    current = client.table("aredoko_photos").select("*").eq("id", photo_id).single().execute()
-    if not current.data:
-        raise HTTPException(status_code=404, detail="Photo not found")
-
-    if current.data["version"] != data.version:
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "VERSION_CONFLICT",
-                "message": "データが他で更新されました",
-                "server_data": current.data,
-            }
-        )
+    current = load_for_update("photo", photo_id, data.version, "Photo not found")
 
     # 更新
-    response = client.table("aredoko_photos").update({
-        "name": data.name,
-    }).eq("id", photo_id).execute()
-    return _to_photo_response(response.data[0])
+    changes = {"name": data.name}
+    updated = apply_update("photo", photo_id, data.version, changes, "Photo not found")
+    publish_change(current["warehouse_id"], "photo", "updated", photo_id, updated["version"], changes)
+    return _to_photo_response(updated)
 
 
 @router.delete("/photos/{photo_id}", status_code=204)
@@ -96,11 +162,23 @@ async def delete_photo(photo_id: str):
     """写真を削除"""
     client = get_supabase_client()
 
-    # 画像パスを取得
-    photo = client.table("aredoko_photos").select("image_path").eq("id", photo_id).single().execute()
-    if photo.data:
-        # Storageから画像を削除
-        delete_image(photo.data["image_path"])
+    # 画像パスを取得（写真と一緒に削除されるオブジェクトのクリップ画像も含む）
+    cache = get_entity_cache()
+    photo = cache.get("photo", photo_id)
+    with track_supabase("aredoko_objects", "select"):
+        objects = client.table("aredoko_objects").select("id, clipped_image_path").eq("photo_id", photo_id).execute()
 
     # DBから削除
-    client.table("aredoko_photos").delete().eq("id", photo_id).execute()
+    with track_supabase("aredoko_photos", "delete"):
+        client.table("aredoko_photos").delete().eq("id", photo_id).execute()
+    cache.invalidate("photo", photo_id)
+    cache.invalidate("object", *(o["id"] for o in objects.data))
+    if photo is not None:
+        publish_change(photo["warehouse_id"], "photo", "deleted", photo_id)
+        forget_objects(photo["warehouse_id"], *(o["id"] for o in objects.data))
+
+    # 画像の参照を外す（他から参照されていなければStorageから削除）
+    for obj in objects.data:
+        await run_in_threadpool(release_image, obj["clipped_image_path"])
+    if photo is not None:
+        await run_in_threadpool(release_image, photo["image_path"])
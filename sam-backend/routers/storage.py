@@ -0,0 +1,137 @@
+"""
+ローカルストレージ画像配信ルーター
+
+STORAGE_BACKEND=local のときに、署名付きURL（utils/storage_backends.py）で
+指定された画像をディスクから配信する。Rangeリクエストにも対応。
+"""
+
+import re
+import time
+from typing import Iterator, Optional
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from utils import blob_digest, get_storage_backend
+from utils.storage_backends import LocalStorageBackend
+
+router = APIRouter(prefix="/api/storage", tags=["storage"])
+
+# Rangeリクエストで読み込む単位
+_RANGE_CHUNK_SIZE = 64 * 1024
+
+# 画像のマジックナンバー -> Content-Type
+_MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+]
+
+
+def _sniff_content_type(header: bytes) -> str:
+    """
+    ファイル先頭のバイト列からContent-Typeを判定
+
+    保存パスの拡張子は実際の形式と一致しない場合がある（例: PNGのdata URLでも photos/xxx.jpg）
+    """
+    for magic, content_type in _MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return content_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def _parse_range(range_header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Rangeヘッダー（単一範囲のみ）を (start, end) に変換（endは含む）
+
+    Returns:
+        範囲、または None（Rangeとして解釈できない場合は全体を返す）
+
+    Raises:
+        HTTPException: 範囲がファイルサイズを超える場合（416）
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    if match.group(1) == "":
+        # bytes=-N: 末尾Nバイト
+        length = int(match.group(2))
+        start, end = max(0, size - length), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def _iter_file_range(path: str, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(_RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+@router.get("/{path:path}")
+async def get_stored_image(path: str, expires: int, signature: str, request: Request):
+    """署名付きURLで指定された画像を配信"""
+    backend = get_storage_backend()
+    if not isinstance(backend, LocalStorageBackend):
+        raise HTTPException(status_code=404, detail="Local storage is not enabled")
+
+    if not backend.verify(path, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+
+    try:
+        file_path = backend.resolve(path)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    with open(file_path, "rb") as f:
+        content_type = _sniff_content_type(f.read(12))
+    size = file_path.stat().st_size
+
+    # 署名付きURLの有効期限まではキャッシュ可能（内容はパスごとに不変）
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"private, max-age={max(0, expires - int(time.time()))}",
+    }
+    # コンテンツアドレス方式の画像は内容のハッシュをETagにし、再検証も不要にする
+    digest = blob_digest(path)
+    if digest is not None:
+        etag = f'"{digest}"'
+        headers["ETag"] = etag
+        headers["Cache-Control"] += ", immutable"
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    byte_range = _parse_range(range_header, size) if range_header else None
+    if byte_range is None:
+        return FileResponse(file_path, media_type=content_type, headers=headers)
+
+    start, end = byte_range
+    return StreamingResponse(
+        _iter_file_range(str(file_path), start, end),
+        status_code=206,
+        media_type=content_type,
+        headers={
+            **headers,
+            "Content-Range": f"bytes {start}-{end}/{size}",
+            "Content-Length": str(end - start + 1),
+        },
+    )
@@ -2,72 +2,152 @@
 倉庫APIルーター
 """
 
-from fastapi import APIRouter, HTTPException
-from database import get_supabase_client
+import asyncio
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from change_feed import format_sse, get_change_hub, publish_change
+from database import get_entity_cache, get_supabase_client
+from metrics import CHANGE_FEED_SUBSCRIBERS, track_supabase
 from models import Warehouse, WarehouseCreate, WarehouseUpdate
+from similarity import forget_warehouse
+from utils import release_image
+from utils.optimistic_lock import apply_update, load_for_update
+from utils.http_cache import (
+    is_conditional,
+    is_not_modified,
+    not_modified_response,
+    set_cache_headers,
+    strong_etag,
+    weak_etag,
+)
 
 router = APIRouter(prefix="/api/warehouses", tags=["warehouses"])
 
+# 変更フィードの接続維持用コメントを送る間隔（秒）
+CHANGE_FEED_KEEPALIVE_SECONDS = 15
+
 
 @router.get("", response_model=list[Warehouse])
-async def list_warehouses():
-    """倉庫一覧を取得"""
+async def list_warehouses(request: Request, http_response: Response):
+    """倉庫一覧を取得（ETag付き）"""
     client = get_supabase_client()
-    response = client.table("aredoko_warehouses").select("*").order("created_at").execute()
+
+    # 条件付きリクエストの場合は、バージョン情報だけでETagを計算し、変更がなければ本体を取得しない
+    if is_conditional(request):
+        with track_supabase("aredoko_warehouses", "select"):
+            versions = client.table("aredoko_warehouses").select("id, version, updated_at").order("created_at").execute()
+        etag = weak_etag(versions.data)
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+    with track_supabase("aredoko_warehouses", "select"):
+        response = client.table("aredoko_warehouses").select("*").order("created_at").execute()
+    set_cache_headers(http_response, weak_etag(response.data))
     return response.data
 
 
 @router.get("/{warehouse_id}", response_model=Warehouse)
-async def get_warehouse(warehouse_id: str):
-    """倉庫を取得"""
-    client = get_supabase_client()
-    response = client.table("aredoko_warehouses").select("*").eq("id", warehouse_id).single().execute()
-    if not response.data:
+async def get_warehouse(warehouse_id: str, request: Request, http_response: Response):
+    """倉庫を取得（ETag付き）"""
+    warehouse = get_entity_cache().get("warehouse", warehouse_id)
+    if warehouse is None:
         raise HTTPException(status_code=404, detail="Warehouse not found")
-    return response.data
+
+    etag = strong_etag(warehouse)
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+    set_cache_headers(http_response, etag)
+    return warehouse
 
 
 @router.post("", response_model=Warehouse, status_code=201)
 async def create_warehouse(data: WarehouseCreate):
     """倉庫を作成"""
     client = get_supabase_client()
-    response = client.table("aredoko_warehouses").insert({
-        "name": data.name,
-        "memo": data.memo,
-    }).execute()
+    with track_supabase("aredoko_warehouses", "insert"):
+        response = client.table("aredoko_warehouses").insert({
+            "name": data.name,
+            "memo": data.memo,
+        }).execute()
+    get_entity_cache().put("warehouse", response.data[0])
     return response.data[0]
 
 
 @router.put("/{warehouse_id}", response_model=Warehouse)
 async def update_warehouse(warehouse_id: str, data: WarehouseUpdate):
     """倉庫を更新（楽観的ロック付き）"""
-    client = get_supabase_client()
-
     # 現在のバージョンを確認
-    current = client.table("aredoko_warehouses").select("*").eq("id", warehouse_id).single().execute()
-    if not current.data:
-        raise HTTPException(status_code=404, detail="Warehouse not found")
-
-    if current.data["version"] != data.version:
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "VERSION_CONFLICT",
-                "message": "データが他で更新されました",
-                "server_data": current.data,
-            }
-        )
+    load_for_update("warehouse", warehouse_id, data.version, "Warehouse not found")
 
     # 更新
-    response = client.table("aredoko_warehouses").update({
-        "name": data.name,
-        "memo": data.memo,
-    }).eq("id", warehouse_id).execute()
-    return response.data[0]
+    changes = {"name": data.name, "memo": data.memo}
+    updated = apply_update("warehouse", warehouse_id, data.version, changes, "Warehouse not found")
+    publish_change(warehouse_id, "warehouse", "updated", warehouse_id, updated["version"], changes)
+    return updated
 
 
 @router.delete("/{warehouse_id}", status_code=204)
 async def delete_warehouse(warehouse_id: str):
     """倉庫を削除"""
     client = get_supabase_client()
-    client.table("aredoko_warehouses").delete().eq("id", warehouse_id).execute()
+
+    # 倉庫と一緒に削除される写真・オブジェクトの画像パスを取得
+    with track_supabase("aredoko_photos", "select"):
+        photos = client.table("aredoko_photos").select("id, image_path").eq("warehouse_id", warehouse_id).execute()
+    photo_ids = [p["id"] for p in photos.data]
+    objects_data = []
+    if photo_ids:
+        with track_supabase("aredoko_objects", "select"):
+            objects = client.table("aredoko_objects").select("id, clipped_image_path").in_("photo_id", photo_ids).execute()
+        objects_data = objects.data
+    object_ids = [o["id"] for o in objects_data]
+    image_paths = [o["clipped_image_path"] for o in objects_data] + [p["image_path"] for p in photos.data]
+
+    with track_supabase("aredoko_warehouses", "delete"):
+        client.table("aredoko_warehouses").delete().eq("id", warehouse_id).execute()
+
+    cache = get_entity_cache()
+    cache.invalidate("warehouse", warehouse_id)
+    publish_change(warehouse_id, "warehouse", "deleted", warehouse_id)
+    forget_warehouse(warehouse_id)
+    cache.invalidate("photo", *photo_ids)
+    cache.invalidate("object", *object_ids)
+
+    # 画像の参照を外す（他から参照されていなければStorageから削除）
+    for path in image_paths:
+        await run_in_threadpool(release_image, path)
+
+
+@router.get("/{warehouse_id}/changes")
+async def warehouse_changes(warehouse_id: str, request: Request):
+    """
+    倉庫内の変更をServer-Sent Eventsで配信
+
+    イベント名は op（created / updated / deleted / resync）。形式は change_feed.py を参照。
+    再接続時は Last-Event-ID ヘッダー（EventSourceが自動で付ける）の続きから再送する。
+    """
+    subscription = get_change_hub().subscribe(warehouse_id, request.headers.get("last-event-id"))
+
+    async def events():
+        CHANGE_FEED_SUBSCRIBERS.inc()
+        try:
+            # 接続直後にヘッダーを送り出す
+            yield b": connected\n\n"
+            while True:
+                try:
+                    event_id, event = await asyncio.wait_for(subscription.get(), CHANGE_FEED_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield format_sse(event_id, event)
+        finally:
+            subscription.close()
+            CHANGE_FEED_SUBSCRIBERS.dec()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
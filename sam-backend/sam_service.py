@@ -3,10 +3,17 @@ SAM (Segment Anything Model) Service
 モデルのロードとセグメンテーション処理を担当
 """
 
+import functools
 import os
+import threading
+import uuid
+from collections import OrderedDict
 from typing import Optional
 import numpy as np
 
+from memory_budget import Allocation, get_memory_budget
+from metrics import record_cache, track_stage
+
 # SAMのインポート（インストールされていない場合はダミーモード）
 try:
     import torch
@@ -17,6 +24,32 @@ except ImportError:
     print("Warning: SAM not available. Running in dummy mode.")
 
 
+class ImageMismatchError(ValueError):
+    """再調整に添えられた画像が、mask_id の作成に使った画像と異なる"""
+
+
+def _synchronized(method):
+    """
+    predictorの状態（セット済みの埋め込み）を扱うメソッドを排他実行する
+
+    推論したマスクのメモリ予算（_predict）は、最も外側の呼び出しが結果を返すまで返却しない
+    （マスクは輪郭の抽出や結果の組み立てが終わるまで使われる）
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            self._sync_depth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._sync_depth -= 1
+                if self._sync_depth == 0:
+                    for allocation in self._inference_allocations:
+                        allocation.release()
+                    self._inference_allocations.clear()
+    return wrapper
+
+
 class SAMService:
     """SAMモデルのラッパーサービス"""
 
@@ -27,6 +60,26 @@ class SAMService:
         "vit_b": "sam_vit_b_01ec64.pth",  # 小さい、高速
     }
 
+    # タイルモードの設定
+    TILE_SIZE = 1024  # SAMの入力解像度と同じ（タイルは縮小されずにエンコードされる）
+    TILE_STRIDE = 512  # 隣接タイルは半分ずつ重なる
+    MAX_STITCH_TILES = 9  # 1回のセグメンテーションで処理するタイル数の上限
+    # クリック点のタイルから上下左右に広げるタイル数の上限。タイルモードではこの範囲
+    # （最大 TILE_SIZE + 2 * TILE_WINDOW_RADIUS * TILE_STRIDE = 3072px 四方）だけをデコードすればよい。
+    # これより遠くまで続くオブジェクトのマスクは範囲の端で切れる
+    TILE_WINDOW_RADIUS = 2
+    EMBEDDING_CACHE_SIZE = 16  # キャッシュする埋め込み（画像全体・タイル）の数
+    LASSO_ROI_MARGIN = 32  # 投げ縄ROIの余白（px）
+    LASSO_ROI_ALIGN = 64  # 投げ縄ROIを揃えるグリッド（キャッシュ再利用のため）
+    MASK_STATE_CACHE_SIZE = 64  # 再調整用に保持するマスク（プロンプトと低解像度logits）の数
+    CONTOUR_MAX_SIZE = 1024  # 輪郭を抽出するマスク（オブジェクトの外接矩形）の最大辺。超える場合は縮小して抽出
+    # ポリゴンの詳細度 -> 簡略化の許容誤差（輪郭の長さに対する比）。medium が polygon の既定
+    POLYGON_LODS = {"coarse": 0.02, "medium": 0.005, "fine": 0.001}
+    MIN_PART_AREA_RATIO = 0.01  # 最大の部分（穴の場合は外周）に対する面積の比がこれ未満の部分・穴は捨てる
+    MAX_POLYGON_PARTS = 16  # 返す部分・部分ごとの穴の数の上限
+    FEATURE_SUPERSAMPLE = 4  # 特徴のマスクプーリングで、マスクを格子の何倍の解像度で塗るか
+    COLOR_HISTOGRAM_BINS = 4  # ダミーモードの特徴（色ヒストグラム）のチャンネルごとの分割数
+
     def __init__(self, model_type: str = "vit_b", checkpoint_path: Optional[str] = None):
         """
         SAMサービスを初期化
@@ -38,6 +91,25 @@ class SAMService:
         self.model_type = model_type
         self.predictor: Optional["SamPredictor"] = None
         self._current_image: Optional[np.ndarray] = None
+        self._current_image_allocation: Optional[Allocation] = None
+        # predictorにセット中の埋め込みのキャッシュキー（image_keyなしでセットした場合はNone）
+        self._current_key: Optional[tuple] = None
+        # 埋め込みのLRUキャッシュ: (image_key,) または (image_key, x0, y0, x1, y1) -> predictorの状態
+        self._embedding_cache: OrderedDict[tuple, dict] = OrderedDict()
+        # 固定された（LRUで追い出さない）埋め込みのキー -> 固定数
+        self._pinned: dict[tuple, int] = {}
+        # 再調整用のマスクの状態のLRUキャッシュ: mask_id -> プロンプトと低解像度logits
+        self._mask_states: OrderedDict[str, dict] = OrderedDict()
+        # 推論はスレッドプールから呼ばれるため、predictorの操作を直列化する
+        self._lock = threading.RLock()
+        # _synchronized の入れ子の深さと、呼び出し中に推論したマスクの予算（最も外側の呼び出しの終了時に返却）
+        self._sync_depth = 0
+        self._inference_allocations: list[Allocation] = []
+        # 埋め込み・画像のコピー・マスクの状態はプロセスのメモリ予算に登録し、不足時は古いものから追い出す
+        self._memory = get_memory_budget()
+        self._memory.register_evictor("embeddings", self._release_embeddings)
+        self._memory.register_evictor("current_image", self._release_current_image)
+        self._memory.register_evictor("mask_states", self._release_mask_states)
 
         if not SAM_AVAILABLE:
             print("SAM is not available. Using dummy mode.")
@@ -90,10 +162,94 @@ class SAMService:
         """モデルがロードされているか"""
         return self.predictor is not None
 
+    @_synchronized
+    def prepare_image(self, image: np.ndarray, image_key: str) -> None:
+        """
+        画像の埋め込みを計算してキャッシュ（エンコードのみ）
+
+        同じ画像に対する複数のプロンプトで、エンコードを1回にまとめるために使う。
+
+        Args:
+            image: RGB画像（H, W, 3）
+            image_key: 画像の識別子（埋め込みキャッシュのキー）
+        """
+        if not SAM_AVAILABLE or self.predictor is None:
+            return
+        self._set_cached_image((image_key,), image)
+
+    @_synchronized
+    def has_image(self, image_key: str) -> bool:
+        """
+        画像全体の埋め込みがセット済み・キャッシュ済みか
+
+        True の場合、画像全体のメソッド（prepare_image, segment など）は画像の大きさしか使わない
+        （推論ワーカーに画素を送らずに呼び出せる）。ダミーモードは常に画像の大きさしか使わない。
+        """
+        if not SAM_AVAILABLE or self.predictor is None:
+            return True
+        key = (image_key,)
+        return key == self._current_key or key in self._embedding_cache
+
+    @_synchronized
+    def object_feature(self, image: np.ndarray, image_key: str, polygon: np.ndarray) -> Optional[dict]:
+        """
+        オブジェクトの特徴ベクトル（類似検索用）を計算
+
+        画像全体の埋め込み（C×64×64）をマスクが覆う割合で重み付き平均する（マスクプーリング）。
+        埋め込みはセグメンテーションと同じキャッシュを使うため、登録直後なら再計算しない。
+        SAMなしの場合はマスク内の色ヒストグラムを使う。
+
+        Args:
+            image: RGB画像（H, W, 3）
+            image_key: 画像の識別子（埋め込みキャッシュのキー）
+            polygon: マスクの頂点（N, 2）、元画像のピクセル座標
+
+        Returns:
+            {"model": 特徴の種類, "vector": L2正規化したベクトル（float32）}
+            マスクが画像と重ならない場合は None
+        """
+        if not SAM_AVAILABLE or self.predictor is None:
+            return self._color_feature(image, polygon)
+
+        h, w = image.shape[:2]
+        with track_stage("object_feature"):
+            self._set_cached_image((image_key,), image)
+            features = self.predictor.features[0].float().cpu().numpy()
+            grid = features.shape[-1]
+            # 長辺を1024に縮小した入力を16px単位で埋め込むため、元画像の長辺が grid セルに対応する
+            weights = self._mask_weights(polygon, grid / max(h, w), (grid, grid))
+            if weights is None:
+                return None
+            vector = np.tensordot(features, weights, axes=([1, 2], [0, 1]))
+        return self._feature_result(f"sam_{self.model_type}", vector)
+
+    @_synchronized
+    def pin_image(self, image_key: str) -> None:
+        """
+        画像全体の埋め込みをキャッシュに固定する（WebSocketセッションの間など）
+
+        固定数で管理し、unpin_image で同じ回数だけ解除するまでLRU・メモリ予算の不足で追い出さない。
+        埋め込みの計算は prepare_image で行う。
+        """
+        key = (image_key,)
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    @_synchronized
+    def unpin_image(self, image_key: str) -> None:
+        """pin_image の固定を解除（埋め込みは次回の追い出し対象になる）"""
+        key = (image_key,)
+        count = self._pinned.get(key, 0) - 1
+        if count > 0:
+            self._pinned[key] = count
+        else:
+            self._pinned.pop(key, None)
+
+    @_synchronized
     def segment(
         self,
         image: np.ndarray,
         click_point: tuple[int, int],
+        image_key: Optional[str] = None,
     ) -> Optional[dict]:
         """
         クリック点からオブジェクト領域を検出
@@ -101,46 +257,35 @@ class SAMService:
         Args:
             image: RGB画像（H, W, 3）
             click_point: クリック座標 (x, y)
+            image_key: 画像の識別子（指定時は埋め込みをキャッシュから再利用）
 
         Returns:
             {
                 "polygon": [(x1, y1), (x2, y2), ...],
                 "bounding_box": (x, y, width, height),
+                "mask_id": "...",  # image_key指定時のみ（refine_mask で再調整できる）
             }
             または None（検出失敗時）
         """
         if not SAM_AVAILABLE or self.predictor is None:
             # ダミーモード: クリック点を中心とした矩形を返す
-            return self._dummy_segment(image, click_point)
+            result = self._dummy_segment(image, click_point)
+            return self._remember_mask(result, image, image_key, [click_point], [1], None, None)
 
         # 画像をセット（同じ画像なら再利用）
-        if self._current_image is None or not np.array_equal(self._current_image, image):
-            self.predictor.set_image(image)
-            self._current_image = image.copy()
+        self._set_image(image, image_key)
 
         # クリック点でセグメンテーション
         input_point = np.array([[click_point[0], click_point[1]]])
         input_label = np.array([1])  # 1 = foreground
 
-        masks, scores, _ = self.predictor.predict(
+        masks, scores, low_res_logits = self._predict(
             point_coords=input_point,
             point_labels=input_label,
             multimask_output=True,
         )
 
-        # スコア閾値を満たす中で最大面積のマスクを選択
-        # （部分的な高スコアより全体を優先）
-        MIN_SCORE_THRESHOLD = 0.5
-        valid_indices = [i for i, s in enumerate(scores) if s >= MIN_SCORE_THRESHOLD]
-
-        if not valid_indices:
-            # フォールバック: 閾値を満たすマスクがない場合は最高スコアを選択
-            best_idx = np.argmax(scores)
-        else:
-            # 閾値を満たすマスクの中で最大面積を選択
-            areas = [masks[i].sum() for i in valid_indices]
-            best_idx = valid_indices[np.argmax(areas)]
-
+        best_idx = self._select_best_mask(masks, scores)
         mask = masks[best_idx]
 
         # マスクが空の場合
@@ -148,12 +293,128 @@ class SAMService:
             return None
 
         # マスクからポリゴンとバウンディングボックスを抽出
-        return self._mask_to_result(mask)
+        result = self._mask_to_result(mask)
+        return self._remember_mask(
+            result, image, image_key, [click_point], [1], None, low_res_logits[best_idx]
+        )
+
+    @_synchronized
+    def segment_with_prompts(
+        self,
+        image: np.ndarray,
+        point_coords: list[tuple[int, int]],
+        point_labels: list[int],
+        box: Optional[tuple[int, int, int, int]] = None,
+        image_key: Optional[str] = None,
+    ) -> Optional[dict]:
+        """
+        複数の点（前景・背景）とボックスからオブジェクト領域を検出
+
+        Args:
+            image: RGB画像（H, W, 3）
+            point_coords: 点の座標 [(x, y), ...]
+            point_labels: 点のラベル（1 = 前景, 0 = 背景）
+            box: ボックス (x1, y1, x2, y2)
+            image_key: 画像の識別子（指定時は埋め込みをキャッシュから再利用）
+
+        Returns:
+            segment() と同じ形式、または None（検出失敗時）
+        """
+        if not SAM_AVAILABLE or self.predictor is None:
+            result = self._dummy_prompts(image.shape[:2], point_coords, point_labels, box)
+            return self._remember_mask(result, image, image_key, point_coords, point_labels, box, None)
+
+        self._set_image(image, image_key)
+
+        # 点1つだけの場合は曖昧さがあるので複数マスクから選ぶ（segment() と同じ）
+        multimask = box is None and len(point_coords) == 1
+        masks, scores, low_res_logits = self._predict(
+            point_coords=np.array(point_coords) if point_coords else None,
+            point_labels=np.array(point_labels) if point_coords else None,
+            box=np.array(box)[None, :] if box is not None else None,
+            multimask_output=multimask,
+        )
+
+        best_idx = self._select_best_mask(masks, scores)
+        mask = masks[best_idx]
+        if not mask.any():
+            return None
+        return self._remember_mask(
+            self._mask_to_result(mask), image, image_key, point_coords, point_labels, box,
+            low_res_logits[best_idx],
+        )
+
+    @_synchronized
+    def refine_mask(
+        self,
+        mask_id: str,
+        point_coords: list[tuple[int, int]],
+        point_labels: list[int],
+        image: Optional[np.ndarray] = None,
+        image_key: Optional[str] = None,
+    ) -> Optional[dict]:
+        """
+        以前の結果（mask_id）に点を追加して再調整する
+
+        前回までのプロンプトに点を追加し、前回の低解像度logitsを mask_input として
+        デコーダーを1回だけ実行する（画像のエンコードはキャッシュを使う）。
+
+        Args:
+            mask_id: segment() などが返した mask_id
+            point_coords: 追加する点の座標 [(x, y), ...]
+            point_labels: 追加する点のラベル（1 = 前景, 0 = 背景）
+            image: 画像の埋め込みがキャッシュから追い出されていた場合に使うRGB画像
+            image_key: image の識別子（画像ファイルのSHA-256）。image を指定する場合は必須
 
+        Returns:
+            segment() と同じ形式（mask_idは同じ）、または None（検出失敗時）
+
+        Raises:
+            KeyError: mask_id の状態がない、または埋め込みがなく image も指定されていない
+            ImageMismatchError: image が mask_id の画像と異なる
+                （別の画像の埋め込みを同じキーでキャッシュしないように、エンコードする前に拒否する）
+        """
+        state = self._mask_states.get(mask_id)
+        if state is None:
+            raise KeyError(mask_id)
+        if image is not None and image_key != state["image_key"]:
+            raise ImageMismatchError(mask_id)
+        self._mask_states.move_to_end(mask_id)
+
+        coords = state["point_coords"] + [tuple(p) for p in point_coords]
+        labels = state["point_labels"] + list(point_labels)
+
+        if not SAM_AVAILABLE or self.predictor is None:
+            result = self._dummy_prompts(state["image_size"], coords, labels, state["box"])
+            logits = None
+        else:
+            key = (state["image_key"],)
+            if key != self._current_key and key not in self._embedding_cache and image is None:
+                raise KeyError(mask_id)
+            self._set_cached_image(key, image)
+
+            box = state["box"]
+            masks, _, low_res_logits = self._predict(
+                point_coords=np.array(coords),
+                point_labels=np.array(labels),
+                box=np.array(box)[None, :] if box is not None else None,
+                mask_input=state["logits"],
+                multimask_output=False,
+            )
+            result = self._mask_to_result(masks[0]) if masks[0].any() else None
+            logits = low_res_logits[0:1]
+
+        if result is None:
+            return None
+        state.update(point_coords=coords, point_labels=labels, logits=logits)
+        return {**result, "mask_id": mask_id}
+
+    @_synchronized
     def segment_with_lasso(
         self,
         image: np.ndarray,
         lasso_polygon: list[tuple[int, int]],
+        image_key: Optional[str] = None,
     ) -> Optional[dict]:
         """
         投げ縄ポリゴン内のオブジェクトを検出
@@ -161,6 +422,7 @@ class SAMService:
         Args:
             image: RGB画像（H, W, 3）
             lasso_polygon: 投げ縄で描いたポリゴン [(x1, y1), (x2, y2), ...]
+            image_key: 画像の識別子（指定時は埋め込みをキャッシュから再利用）
 
         Returns:
             {
@@ -169,53 +431,340 @@ class SAMService:
             }
             または None（検出失敗時）
         """
-        import cv2
-
         if len(lasso_polygon) < 3:
             return None
 
         h, w = image.shape[:2]
-
-        # 投げ縄のバウンディングボックスを計算
-        xs = [p[0] for p in lasso_polygon]
-        ys = [p[1] for p in lasso_polygon]
-        box_x1 = max(0, min(xs))
-        box_y1 = max(0, min(ys))
-        box_x2 = min(w, max(xs))
-        box_y2 = min(h, max(ys))
-
-        # 投げ縄の中心点を計算
-        center_x = (box_x1 + box_x2) // 2
-        center_y = (box_y1 + box_y2) // 2
+        lasso_points = np.asarray(lasso_polygon, dtype=np.int32)
 
         if not SAM_AVAILABLE or self.predictor is None:
             # ダミーモード: 投げ縄そのものを返す
+            box_x1, box_y1, box_x2, box_y2 = self._lasso_box(lasso_points, h, w)
             return {
                 "polygon": lasso_polygon,
                 "bounding_box": (box_x1, box_y1, box_x2 - box_x1, box_y2 - box_y1),
             }
 
         # 画像をセット（同じ画像なら再利用）
-        if self._current_image is None or not np.array_equal(self._current_image, image):
-            self.predictor.set_image(image)
-            self._current_image = image.copy()
+        self._set_image(image, image_key)
 
-        # 投げ縄マスクを作成
-        lasso_mask = np.zeros((h, w), dtype=np.uint8)
-        lasso_points = np.array(lasso_polygon, dtype=np.int32)
-        cv2.fillPoly(lasso_mask, [lasso_points], 1)
+        return self._predict_lasso(lasso_points, h, w, image=image, image_key=image_key)
 
-        # mask_input用にリサイズ (256x256) - SAMの低解像度マスク形式
-        lasso_mask_resized = cv2.resize(lasso_mask, (256, 256), interpolation=cv2.INTER_NEAREST)
-        # logits形式に変換 (内部: 正の値、外部: 負の値)
-        mask_logits = (lasso_mask_resized.astype(np.float32) * 2 - 1) * 10
-        mask_input = mask_logits[None, :, :]  # (1, 256, 256)
+    @_synchronized
+    def segment_tiled(
+        self,
+        image: np.ndarray,
+        click_point: tuple[int, int],
+        image_key: str,
+        origin: tuple[int, int] = (0, 0),
+        size: Optional[tuple[int, int]] = None,
+    ) -> Optional[dict]:
+        """
+        タイルモードでクリック点からオブジェクト領域を検出
+
+        画像全体ではなく、クリック点を含むTILE_SIZE四方のタイルだけを
+        縮小せずにエンコードする。マスクがタイル境界に接している場合は
+        隣接タイルを追加でエンコードし、マスクを全体座標でつなぎ合わせる
+        （クリック点のタイルから TILE_WINDOW_RADIUS タイルまで）。
+
+        Args:
+            image: RGB画像（H, W, 3）。tile_window() の範囲だけを切り出した画像でもよい
+            click_point: クリック座標 (x, y)（元画像座標）
+            image_key: 画像の識別子（タイル埋め込みキャッシュのキー）
+            origin: image の左上の元画像座標（切り出した場合）
+            size: 元画像の (幅, 高さ)（省略時は image の大きさ）
+
+        Returns:
+            segment() と同じ形式（座標は元画像基準）、または None（検出失敗時）
+        """
+        ox, oy = origin
+        w, h = size if size is not None else (image.shape[1], image.shape[0])
+
+        if not SAM_AVAILABLE or self.predictor is None:
+            result = self._dummy_segment(image, (click_point[0] - ox, click_point[1] - oy))
+            return self._offset_result(result, ox, oy)
+
+        origins_x = self._tile_origins(w)
+        origins_y = self._tile_origins(h)
+        start = (
+            self._nearest_tile(origins_x, click_point[0], w),
+            self._nearest_tile(origins_y, click_point[1], h),
+        )
+        radius = self.TILE_WINDOW_RADIUS
+
+        # (タイル, プロンプト点(全体座標), 親タイル)
+        queue: list[tuple[tuple[int, int], np.ndarray, Optional[tuple[int, int]]]] = [
+            (start, np.array([[click_point[0], click_point[1]]]), None),
+        ]
+        # タイル -> (x0, y0, マスク)
+        tile_masks: dict[tuple[int, int], tuple[int, int, np.ndarray]] = {}
+
+        while queue and len(tile_masks) < self.MAX_STITCH_TILES:
+            tile, point, parent = queue.pop(0)
+            if tile in tile_masks:
+                continue
+
+            x0, y0 = origins_x[tile[0]], origins_y[tile[1]]
+            tile_image = image[y0 - oy:y0 - oy + self.TILE_SIZE, x0 - ox:x0 - ox + self.TILE_SIZE]
+            th, tw = tile_image.shape[:2]
+            self._set_cached_image((image_key, x0, y0, x0 + tw, y0 + th), tile_image)
+
+            masks, scores, _ = self._predict(
+                point_coords=point - np.array([x0, y0]),
+                point_labels=np.array([1]),
+                multimask_output=True,
+            )
+            mask = masks[self._select_best_mask(masks, scores)]
+
+            if not mask.any():
+                if parent is None:
+                    return None
+                continue
+
+            # 隣接タイルの結果は、重なり領域で親タイルのマスクと一致する場合のみ採用
+            if parent is not None and not self._tiles_agree(tile_masks[parent], (x0, y0, mask)):
+                continue
+
+            tile_masks[tile] = (x0, y0, mask)
+
+            # タイル境界（画像の端を除く）に接していれば隣接タイルへ広げる
+            neighbors = []
+            if mask[:, 0].any() and tile[0] > 0:
+                neighbors.append((tile[0] - 1, tile[1]))
+            if mask[:, -1].any() and tile[0] < len(origins_x) - 1:
+                neighbors.append((tile[0] + 1, tile[1]))
+            if mask[0, :].any() and tile[1] > 0:
+                neighbors.append((tile[0], tile[1] - 1))
+            if mask[-1, :].any() and tile[1] < len(origins_y) - 1:
+                neighbors.append((tile[0], tile[1] + 1))
+
+            for neighbor in neighbors:
+                if neighbor in tile_masks or max(abs(neighbor[0] - start[0]), abs(neighbor[1] - start[1])) > radius:
+                    continue
+                nx0, ny0 = origins_x[neighbor[0]], origins_y[neighbor[1]]
+                region = (
+                    max(x0, nx0),
+                    max(y0, ny0),
+                    min(x0 + tw, nx0 + self.TILE_SIZE),
+                    min(y0 + th, ny0 + self.TILE_SIZE),
+                )
+                seed = self._seed_point((x0, y0, mask), region)
+                if seed is not None:
+                    queue.append((neighbor, seed, tile))
+
+        return self._stitch_tiles(list(tile_masks.values()))
+
+    @_synchronized
+    def segment_with_lasso_tiled(
+        self,
+        image: np.ndarray,
+        lasso_polygon: list[tuple[int, int]],
+        image_key: str,
+        origin: tuple[int, int] = (0, 0),
+        size: Optional[tuple[int, int]] = None,
+    ) -> Optional[dict]:
+        """
+        タイルモードで投げ縄ポリゴン内のオブジェクトを検出
+
+        投げ縄の外接矩形に余白を加えた領域（ROI）だけを切り出してエンコードする。
+        ROIがTILE_SIZEより小さければ元の解像度のまま推論される。
+
+        Args:
+            image: RGB画像（H, W, 3）。lasso_roi() の範囲だけを切り出した画像でもよい
+            lasso_polygon: 投げ縄で描いたポリゴン [(x1, y1), (x2, y2), ...]（元画像座標）
+            image_key: 画像の識別子（ROI埋め込みキャッシュのキー）
+            origin: image の左上の元画像座標（切り出した場合）
+            size: 元画像の (幅, 高さ)（省略時は image の大きさ）
+
+        Returns:
+            segment_with_lasso() と同じ形式（座標は元画像基準）、または None（検出失敗時）
+        """
+        if len(lasso_polygon) < 3:
+            return None
+
+        ox, oy = origin
+        if not SAM_AVAILABLE or self.predictor is None:
+            result = self.segment_with_lasso(image, [(x - ox, y - oy) for x, y in lasso_polygon])
+            return self._offset_result(result, ox, oy)
+
+        w, h = size if size is not None else (image.shape[1], image.shape[0])
+        lasso_points = np.asarray(lasso_polygon, dtype=np.int32)
+        x0, y0, x1, y1 = self.lasso_roi(lasso_polygon, w, h)
+
+        roi = image[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+        self._set_cached_image((image_key, x0, y0, x1, y1), roi)
+
+        result = self._predict_lasso(lasso_points - np.array([x0, y0], dtype=np.int32), y1 - y0, x1 - x0)
+        return self._offset_result(result, x0, y0)
+
+    def memory_usage(self) -> dict:
+        """このプロセスのメモリ予算の使用量（推論ワーカーの使用量を親プロセスから取得するため）"""
+        return self._memory.usage()
+
+    def _set_image(self, image: np.ndarray, image_key: Optional[str]) -> None:
+        """画像全体をpredictorにセット（image_keyがあればキャッシュを使う）"""
+        if image_key is None:
+            self._ensure_image(image)
+        else:
+            self._set_cached_image((image_key,), image)
+
+    def _ensure_image(self, image: np.ndarray) -> None:
+        """画像をpredictorにセット（同じ画像なら再利用）"""
+        hit = self._current_image is not None and np.array_equal(self._current_image, image)
+        record_cache("image", hit)
+        if not hit:
+            with track_stage("set_image"):
+                self.predictor.set_image(image)
+            self._current_key = None
+            self._set_current_image(image.copy())
+
+    def _set_current_image(self, image: Optional[np.ndarray]) -> None:
+        """キーなしで再利用を判定するための画像のコピーを差し替え（メモリ予算に登録）"""
+        if self._current_image_allocation is not None:
+            self._current_image_allocation.release()
+        self._current_image = None
+        # 登録してから差し替える（予算の不足による追い出しの対象にしない）
+        self._current_image_allocation = self._memory.track("current_image", image.nbytes) if image is not None else None
+        self._current_image = image
+
+    def _predict(self, **kwargs):
+        """
+        predictor.predict の呼び出し（処理時間を計測、出力マスクをメモリ予算に登録）
+
+        予算は呼び出し元の公開メソッドが結果を返すまで保持する（_synchronized で返却）
+        """
+        h, w = self.predictor.original_size
+        count = 3 if kwargs.get("multimask_output", True) else 1
+        self._inference_allocations.append(self._memory.track("inference", count * h * w))
+        with track_stage("predict"):
+            return self.predictor.predict(**kwargs)
+
+    def _set_cached_image(self, key: tuple, image: np.ndarray) -> None:
+        """
+        画像全体・タイル・ROIをpredictorにセット（埋め込みはキー単位でLRUキャッシュ）
+
+        key が (image_key,) なら画像全体、(image_key, x0, y0, x1, y1) ならタイル/ROI
+        """
+        if self._current_key == key:
+            # 既にセット済み（prepare_image直後のセグメンテーションなど）
+            return
+
+        cached = self._embedding_cache.get(key)
+        record_cache("image" if len(key) == 1 else "tile", cached is not None)
+        if cached is not None:
+            self._embedding_cache.move_to_end(key)
+            self.predictor.features = cached["features"]
+            self.predictor.original_size = cached["original_size"]
+            self.predictor.input_size = cached["input_size"]
+            self.predictor.is_image_set = True
+        else:
+            with track_stage("set_image"):
+                self.predictor.set_image(image)
+            features = self.predictor.features
+            self._embedding_cache[key] = {
+                "features": features,
+                "original_size": self.predictor.original_size,
+                "input_size": self.predictor.input_size,
+            }
+
+        # predictorの埋め込みが入れ替わったので、キーなしの再利用判定を無効化
+        self._current_key = key
+        self._set_current_image(None)
+
+        if cached is None:
+            # 追い出しはセット済みのキーを除いて行う（メモリ予算による追い出しも同じ）
+            self._evict_embeddings()
+            self._embedding_cache[key]["allocation"] = self._memory.track(
+                "embeddings", features.element_size() * features.nelement()
+            )
+
+    def _evict_embeddings(self) -> None:
+        """キャッシュの上限を超えた分を古い順に追い出す（固定された埋め込みは残す）"""
+        excess = len(self._embedding_cache) - self.EMBEDDING_CACHE_SIZE
+        if excess <= 0:
+            return
+        victims = [key for key in self._embedding_cache if key not in self._pinned][:excess]
+        for key in victims:
+            self._drop_embedding(key)
+
+    def _drop_embedding(self, key: tuple) -> int:
+        """埋め込みをキャッシュから削除し、解放したバイト数を返す"""
+        entry = self._embedding_cache.pop(key)
+        allocation = entry.get("allocation")
+        if allocation is None:
+            return 0
+        nbytes = allocation.nbytes
+        allocation.release()
+        return nbytes
+
+    def _release_embeddings(self, nbytes: int) -> int:
+        """メモリ予算の不足時: セット中・固定中以外の埋め込みを古い順に追い出す"""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            freed = 0
+            for key in list(self._embedding_cache):
+                if freed >= nbytes:
+                    break
+                if key != self._current_key and key not in self._pinned:
+                    freed += self._drop_embedding(key)
+            return freed
+        finally:
+            self._lock.release()
+
+    def _release_current_image(self, nbytes: int) -> int:
+        """メモリ予算の不足時: キーなしの再利用判定用の画像のコピーを捨てる（次回は再エンコード）"""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            freed = self._current_image.nbytes if self._current_image is not None else 0
+            self._set_current_image(None)
+            return freed
+        finally:
+            self._lock.release()
+
+    def _release_mask_states(self, nbytes: int) -> int:
+        """メモリ予算の不足時: 再調整用のマスクの状態を古い順に追い出す"""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            freed = 0
+            while self._mask_states and freed < nbytes:
+                freed += self._drop_mask_state()
+            return freed
+        finally:
+            self._lock.release()
+
+    def _predict_lasso(
+        self,
+        lasso_points: np.ndarray,
+        h: int,
+        w: int,
+        image: Optional[np.ndarray] = None,
+        image_key: Optional[str] = None,
+    ) -> Optional[dict]:
+        """
+        セット済みの画像（h x w）に対して投げ縄で推論
+
+        image_key を指定した場合は再調整用の状態を保存する（画像全体の場合のみ）
+        """
+        box_x1, box_y1, box_x2, box_y2 = self._lasso_box(lasso_points, h, w)
+
+        # 投げ縄の中心点を計算
+        center_x = (box_x1 + box_x2) // 2
+        center_y = (box_y1 + box_y2) // 2
+
+        # 投げ縄マスクはバウンディングボックス内だけをラスタライズ
+        lasso_crop, origin = self._rasterize_lasso_crop(lasso_points, h, w)
+
+        # mask_input用の低解像度マスク (1, 256, 256) を直接生成
+        mask_input = self._lasso_mask_input(lasso_points, h, w)
 
         # ボックス + 中心点 + マスクヒントでセグメンテーション
         box = np.array([box_x1, box_y1, box_x2, box_y2])
         center_point = np.array([[center_x, center_y]])
 
-        masks, scores, _ = self.predictor.predict(
+        masks, scores, low_res_logits = self._predict(
             point_coords=center_point,
             point_labels=np.array([1]),
             box=box[None, :],
@@ -223,31 +772,329 @@ class SAMService:
             multimask_output=True,  # 3つのマスクを取得
         )
 
-        lasso_bool = lasso_mask.astype(bool)
-        lasso_area = lasso_bool.sum()
-
         # 投げ縄との重なり率が最大のマスクを選択
-        best_idx = 0
-        best_coverage = 0
-        for i, mask in enumerate(masks):
-            overlap = (mask & lasso_bool).sum()
-            coverage = overlap / lasso_area if lasso_area > 0 else 0
-            if coverage > best_coverage:
-                best_coverage = coverage
-                best_idx = i
-
+        best_idx = self._select_lasso_mask(masks, lasso_crop, origin)
         sam_mask = masks[best_idx]
 
         # マスクが空の場合
         if not sam_mask.any():
             # フォールバック: 投げ縄そのものを返す
             return {
-                "polygon": lasso_polygon,
+                "polygon": [(int(x), int(y)) for x, y in lasso_points],
                 "bounding_box": (box_x1, box_y1, box_x2 - box_x1, box_y2 - box_y1),
             }
 
         # SAMマスクをそのまま使用（投げ縄は「ヒント」として扱う）
-        return self._mask_to_result(sam_mask)
+        return self._remember_mask(
+            self._mask_to_result(sam_mask), image, image_key,
+            [(center_x, center_y)], [1], (box_x1, box_y1, box_x2, box_y2), low_res_logits[best_idx],
+        )
+
+    def _remember_mask(
+        self,
+        result: Optional[dict],
+        image: Optional[np.ndarray],
+        image_key: Optional[str],
+        point_coords: list[tuple[int, int]],
+        point_labels: list[int],
+        box: Optional[tuple[int, int, int, int]],
+        logits: Optional[np.ndarray],
+    ) -> Optional[dict]:
+        """
+        再調整用にプロンプトと低解像度logitsを保存し、結果に mask_id を付ける
+
+        image_key がない場合（埋め込みをキャッシュしない呼び出し）は保存しない
+        """
+        if result is None or image_key is None:
+            return result
+
+        # 先頭は画像ダイジェストと共通にする（推論ワーカーのルーティングで同じワーカーに届くように）
+        mask_id = image_key[:16] + uuid.uuid4().hex[:16]
+        state = {
+            "image_key": image_key,
+            "image_size": image.shape[:2],
+            "point_coords": [tuple(int(v) for v in p) for p in point_coords],
+            "point_labels": [int(label) for label in point_labels],
+            "box": box,
+            # (1, 256, 256): predictの mask_input にそのまま渡せる形
+            "logits": logits[None, :, :] if logits is not None else None,
+        }
+        if logits is not None:
+            # 登録してから追加する（予算の不足による追い出しの対象にしない）
+            # 再調整でlogitsを差し替えても大きさは変わらない
+            state["allocation"] = self._memory.track("mask_states", logits.nbytes)
+        self._mask_states[mask_id] = state
+        while len(self._mask_states) > self.MASK_STATE_CACHE_SIZE:
+            self._drop_mask_state()
+        return {**result, "mask_id": mask_id}
+
+    def _drop_mask_state(self) -> int:
+        """最も古いマスクの状態を削除し、解放したバイト数を返す"""
+        _, state = self._mask_states.popitem(last=False)
+        allocation = state.get("allocation")
+        if allocation is None:
+            return 0
+        nbytes = allocation.nbytes
+        allocation.release()
+        return nbytes
+
+    @staticmethod
+    def _lasso_box(lasso_points: np.ndarray, h: int, w: int) -> tuple[int, int, int, int]:
+        """投げ縄のバウンディングボックス (x1, y1, x2, y2) を画像内にクリップして返す"""
+        return (
+            max(0, int(lasso_points[:, 0].min())),
+            max(0, int(lasso_points[:, 1].min())),
+            min(w, int(lasso_points[:, 0].max())),
+            min(h, int(lasso_points[:, 1].max())),
+        )
+
+    @staticmethod
+    def _select_best_mask(masks: np.ndarray, scores: np.ndarray) -> int:
+        """
+        スコア閾値を満たす中で最大面積のマスクのインデックスを返す
+        （部分的な高スコアより全体を優先）
+        """
+        MIN_SCORE_THRESHOLD = 0.5
+        valid_indices = [i for i, s in enumerate(scores) if s >= MIN_SCORE_THRESHOLD]
+
+        if not valid_indices:
+            # フォールバック: 閾値を満たすマスクがない場合は最高スコアを選択
+            return int(np.argmax(scores))
+
+        # 閾値を満たすマスクの中で最大面積を選択
+        areas = [masks[i].sum() for i in valid_indices]
+        return valid_indices[int(np.argmax(areas))]
+
+    @staticmethod
+    def _rasterize_lasso_crop(
+        lasso_points: np.ndarray,
+        h: int,
+        w: int,
+    ) -> tuple[np.ndarray, tuple[int, int]]:
+        """
+        投げ縄をバウンディングボックスの範囲だけラスタライズ
+
+        全画面サイズのマスクを確保せず、投げ縄の外接矩形（画像内にクリップ）
+        だけのbool配列を返す。
+
+        Returns:
+            (crop, (x0, y0)): cropは投げ縄内部がTrueの配列、(x0, y0)は画像上の左上座標
+        """
+        import cv2
+
+        x0 = max(0, int(lasso_points[:, 0].min()))
+        y0 = max(0, int(lasso_points[:, 1].min()))
+        x1 = min(w, int(lasso_points[:, 0].max()) + 1)
+        y1 = min(h, int(lasso_points[:, 1].max()) + 1)
+
+        crop = np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=np.uint8)
+        if crop.size:
+            cv2.fillPoly(crop, [lasso_points - np.array([x0, y0], dtype=np.int32)], 1)
+        return crop.view(bool), (x0, y0)
+
+    @staticmethod
+    def _lasso_mask_input(lasso_points: np.ndarray, h: int, w: int) -> np.ndarray:
+        """
+        投げ縄からSAMのmask_input (1, 256, 256) を生成
+
+        SAMの低解像度マスクは長辺を256にリサイズしてパディングした座標系なので、
+        ポリゴン頂点を同じ倍率でスケーリングして256x256上に直接描画する。
+        """
+        import cv2
+
+        scale = 256 / max(h, w)
+        scaled = np.round(lasso_points * scale).astype(np.int32)
+
+        low_res = np.zeros((256, 256), dtype=np.uint8)
+        cv2.fillPoly(low_res, [scaled], 1)
+
+        # logits形式に変換 (内部: 正の値、外部: 負の値)
+        mask_logits = (low_res.astype(np.float32) * 2 - 1) * 10
+        return mask_logits[None, :, :]
+
+    @staticmethod
+    def _select_lasso_mask(
+        masks: np.ndarray,
+        lasso_crop: np.ndarray,
+        origin: tuple[int, int],
+    ) -> int:
+        """
+        投げ縄との重なり率が最大のマスクのインデックスを返す
+
+        投げ縄の外接矩形の外では重なりは常に0なので、全マスクを外接矩形で
+        切り出して1回のリダクションでまとめて計算する（投げ縄面積は共通のため
+        重なり画素数の最大 = 重なり率の最大）。
+        """
+        lasso_area = np.count_nonzero(lasso_crop)
+        if lasso_area == 0:
+            return 0
+
+        x0, y0 = origin
+        ch, cw = lasso_crop.shape
+        window = masks[:, y0:y0 + ch, x0:x0 + cw]
+        overlaps = np.count_nonzero(window & lasso_crop, axis=(1, 2))
+        return int(np.argmax(overlaps))
+
+    @classmethod
+    def tile_window(cls, width: int, height: int, click_point: tuple[int, int]) -> tuple[int, int, int, int]:
+        """
+        segment_tiled() がクリック点から推論しうる範囲 (x0, y0, x1, y1)
+
+        大きな画像はこの範囲だけを切り出して渡せばよい（全体をRGB配列にしない）
+        """
+        origins_x = cls._tile_origins(width)
+        origins_y = cls._tile_origins(height)
+        i = cls._nearest_tile(origins_x, click_point[0], width)
+        j = cls._nearest_tile(origins_y, click_point[1], height)
+        r = cls.TILE_WINDOW_RADIUS
+        return (
+            origins_x[max(0, i - r)],
+            origins_y[max(0, j - r)],
+            min(width, origins_x[min(len(origins_x) - 1, i + r)] + cls.TILE_SIZE),
+            min(height, origins_y[min(len(origins_y) - 1, j + r)] + cls.TILE_SIZE),
+        )
+
+    @classmethod
+    def lasso_roi(cls, lasso_polygon: list[tuple[int, int]], width: int, height: int) -> tuple[int, int, int, int]:
+        """
+        segment_with_lasso_tiled() がエンコードする範囲 (x0, y0, x1, y1)
+
+        投げ縄の外接矩形に余白を加え、近い投げ縄同士で埋め込みを再利用できるようグリッドに揃える
+        """
+        xs = [x for x, _ in lasso_polygon]
+        ys = [y for _, y in lasso_polygon]
+        align = cls.LASSO_ROI_ALIGN
+        margin = cls.LASSO_ROI_MARGIN
+        return (
+            max(0, (min(xs) - margin) // align * align),
+            max(0, (min(ys) - margin) // align * align),
+            min(width, -(-(max(xs) + margin) // align) * align),
+            min(height, -(-(max(ys) + margin) // align) * align),
+        )
+
+    @classmethod
+    def _tile_origins(cls, length: int) -> list[int]:
+        """1軸方向のタイル開始座標の一覧（最後のタイルは画像の端に揃える）"""
+        if length <= cls.TILE_SIZE:
+            return [0]
+        origins = list(range(0, length - cls.TILE_SIZE, cls.TILE_STRIDE))
+        origins.append(length - cls.TILE_SIZE)
+        return origins
+
+    @classmethod
+    def _nearest_tile(cls, origins: list[int], coord: int, length: int) -> int:
+        """座標が最も中央寄りになるタイルのインデックス"""
+        half = min(cls.TILE_SIZE, length) / 2
+        return min(range(len(origins)), key=lambda i: abs(coord - (origins[i] + half)))
+
+    @staticmethod
+    def _seed_point(
+        tile_mask: tuple[int, int, np.ndarray],
+        region: tuple[int, int, int, int],
+    ) -> Optional[np.ndarray]:
+        """
+        タイルマスクのうちregion（全体座標 x0, y0, x1, y1）内にある画素から、
+        隣接タイルに渡すプロンプト点を1つ選ぶ（重心に最も近いマスク画素）
+        """
+        x0, y0, mask = tile_mask
+        rx0, ry0, rx1, ry1 = region
+        sub = mask[ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0]
+        ys, xs = np.nonzero(sub)
+        if len(xs) == 0:
+            return None
+        i = np.argmin((xs - xs.mean()) ** 2 + (ys - ys.mean()) ** 2)
+        return np.array([[xs[i] + rx0, ys[i] + ry0]])
+
+    @staticmethod
+    def _tiles_agree(
+        a: tuple[int, int, np.ndarray],
+        b: tuple[int, int, np.ndarray],
+        min_agreement: float = 0.5,
+    ) -> bool:
+        """2つのタイルマスクが重なり領域で同じオブジェクトを指しているか"""
+        ax0, ay0, am = a
+        bx0, by0, bm = b
+        x0, y0 = max(ax0, bx0), max(ay0, by0)
+        x1 = min(ax0 + am.shape[1], bx0 + bm.shape[1])
+        y1 = min(ay0 + am.shape[0], by0 + bm.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return False
+
+        a_sub = am[y0 - ay0:y1 - ay0, x0 - ax0:x1 - ax0]
+        b_sub = bm[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0]
+        a_area = np.count_nonzero(a_sub)
+        if a_area == 0:
+            return False
+        return np.count_nonzero(a_sub & b_sub) / a_area >= min_agreement
+
+    def _stitch_tiles(self, tile_masks: list[tuple[int, int, np.ndarray]]) -> Optional[dict]:
+        """タイルマスクを処理したタイルの外接領域上で合成し、全体座標の結果を返す"""
+        if not tile_masks:
+            return None
+
+        gx0 = min(x0 for x0, _, _ in tile_masks)
+        gy0 = min(y0 for _, y0, _ in tile_masks)
+        gx1 = max(x0 + m.shape[1] for x0, _, m in tile_masks)
+        gy1 = max(y0 + m.shape[0] for _, y0, m in tile_masks)
+
+        canvas = np.zeros((gy1 - gy0, gx1 - gx0), dtype=bool)
+        for x0, y0, mask in tile_masks:
+            canvas[y0 - gy0:y0 - gy0 + mask.shape[0], x0 - gx0:x0 - gx0 + mask.shape[1]] |= mask
+
+        return self._offset_result(self._mask_to_result(canvas), gx0, gy0)
+
+    @staticmethod
+    def scale_result(result: Optional[dict], factor: int) -> Optional[dict]:
+        """縮小した画像で得た結果の座標を元画像基準に拡大（mask_id は引き継がない）"""
+        if result is None:
+            return None
+        x, y, w, h = result["bounding_box"]
+        scaled = {
+            "polygon": [(px * factor, py * factor) for px, py in result["polygon"]],
+            "bounding_box": (x * factor, y * factor, w * factor, h * factor),
+        }
+        if "contours" in result:
+            scaled["contours"] = [
+                (exterior * factor, [hole * factor for hole in holes]) for exterior, holes in result["contours"]
+            ]
+        return scaled
+
+    @staticmethod
+    def _offset_result(result: Optional[dict], dx: int, dy: int) -> Optional[dict]:
+        """部分領域で得た結果の座標を元画像基準に平行移動"""
+        if result is None:
+            return None
+        x, y, w, h = result["bounding_box"]
+        offset = {
+            "polygon": [(px + dx, py + dy) for px, py in result["polygon"]],
+            "bounding_box": (x + dx, y + dy, w, h),
+        }
+        if "contours" in result:
+            shift = np.array([dx, dy], dtype=np.float32)
+            offset["contours"] = [
+                (exterior + shift, [hole + shift for hole in holes]) for exterior, holes in result["contours"]
+            ]
+        return offset
+
+    def _dummy_prompts(
+        self,
+        image_size: tuple[int, int],
+        point_coords: list[tuple[int, int]],
+        point_labels: list[int],
+        box: Optional[tuple[int, int, int, int]],
+    ) -> Optional[dict]:
+        """ダミーのセグメンテーション（複数の点・ボックス）: ボックス、または最後の前景点の周りの矩形"""
+        if box is not None:
+            x1, y1, x2, y2 = box
+            return {
+                "polygon": [(x1, y1), (x2, y1), (x2, y2), (x1, y2)],
+                "bounding_box": (x1, y1, x2 - x1, y2 - y1),
+            }
+        positives = [p for p, label in zip(point_coords, point_labels) if label == 1]
+        if not positives:
+            return None
+        # _dummy_segment は画像のサイズしか見ないので、メモリを確保しないビューを渡す
+        return self._dummy_segment(np.broadcast_to(np.uint8(0), (*image_size, 3)), positives[-1])
 
     def _dummy_segment(
         self,
@@ -277,35 +1124,186 @@ class SAMService:
             "bounding_box": (x1, y1, x2 - x1, y2 - y1),
         }
 
-    def _mask_to_result(self, mask: np.ndarray) -> dict:
-        """マスクからポリゴンとバウンディングボックスを抽出"""
+    def _color_feature(self, image: np.ndarray, polygon: np.ndarray) -> Optional[dict]:
+        """マスク内の色ヒストグラム（SAMなしの場合の特徴）"""
+        h, w = image.shape[:2]
+        # 長辺128px程度に間引いて数える
+        step = max(1, max(h, w) // 128)
+        sampled = image[::step, ::step]
+        weights = self._mask_weights(polygon, 1 / step, sampled.shape[:2])
+        if weights is None:
+            return None
+        bins = self.COLOR_HISTOGRAM_BINS
+        quantized = sampled.astype(np.int32) * bins // 256
+        index = (quantized[..., 0] * bins + quantized[..., 1]) * bins + quantized[..., 2]
+        histogram = np.bincount(index.ravel(), weights=weights.ravel(), minlength=bins ** 3)
+        # 平方根を取って大きなビンの影響を抑える（Hellinger距離）
+        return self._feature_result("color_hist", np.sqrt(histogram))
+
+    @classmethod
+    def _mask_weights(cls, polygon: np.ndarray, scale: float, shape: tuple[int, int]) -> Optional[np.ndarray]:
+        """
+        マスクが格子の各セルを覆う割合（合計が1になるように正規化）
+
+        Args:
+            polygon: マスクの頂点（N, 2）、元画像のピクセル座標
+            scale: 元画像の座標 -> 格子の座標の倍率
+            shape: 格子の大きさ (高さ, 幅)
+        """
         import cv2
 
-        # マスクをuint8に変換
-        mask_uint8 = (mask * 255).astype(np.uint8)
+        rows, cols = shape
+        s = cls.FEATURE_SUPERSAMPLE
+        canvas = np.zeros((rows * s, cols * s), dtype=np.uint8)
+        cv2.fillPoly(canvas, [np.round(polygon * scale * s).astype(np.int32)], 1)
+        weights = canvas.reshape(rows, s, cols, s).mean(axis=(1, 3), dtype=np.float32)
+        total = weights.sum()
+        if total == 0:
+            # セルより小さいマスク: 重心のセルだけを使う
+            x, y = (int(v) for v in polygon.mean(axis=0) * scale)
+            if not (0 <= x < cols and 0 <= y < rows):
+                return None
+            weights[y, x] = total = 1
+        return weights / total
 
-        # 輪郭を検出
-        contours, _ = cv2.findContours(
-            mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
+    @staticmethod
+    def _feature_result(model: str, vector: np.ndarray) -> Optional[dict]:
+        """特徴ベクトルをL2正規化して返す（ゼロベクトルの場合は None）"""
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return {"model": model, "vector": (vector / norm).astype(np.float32)}
+
+    def _mask_to_result(self, mask: np.ndarray) -> Optional[dict]:
+        """マスクからポリゴンとバウンディングボックスを抽出"""
+        with track_stage("mask_to_result"):
+            return self._extract_contours(mask)
+
+    @classmethod
+    def _extract_contours(cls, mask: np.ndarray) -> Optional[dict]:
+        """
+        マスクの輪郭を抽出
+
+        オブジェクトの外接矩形だけを切り出し、最大辺が CONTOUR_MAX_SIZE を超える場合は整数分の1に縮小してから
+        輪郭を検出する（座標は元の解像度に戻す）。許容誤差は輪郭の長さに比例するため、
+        縮小による誤差はどの詳細度の許容誤差よりも小さい。
+
+        Returns:
+            {
+                "polygon": 最大の部分の外周（詳細度 medium）,
+                "bounding_box": 最大の部分の (x, y, width, height),
+                "contours": 簡略化前の輪郭 [(外周, [穴, ...]), ...]（面積の大きい順、元画像の座標のfloat32配列）,
+            }
+            マスクが空の場合は None
+        """
+        import cv2
 
-        if not contours:
+        mask = mask.view(np.uint8) if mask.dtype == bool else (mask > 0).view(np.uint8)
+        rows = np.flatnonzero(mask.max(axis=1))
+        if rows.size == 0:
             return None
+        y0, y1 = int(rows[0]), int(rows[-1]) + 1
+        cols = np.flatnonzero(mask[y0:y1].max(axis=0))
+        x0, x1 = int(cols[0]), int(cols[-1]) + 1
 
-        # 最大の輪郭を取得
-        largest_contour = max(contours, key=cv2.contourArea)
+        # 縮小率は整数分の1にする（OpenCVの INTER_AREA が高速な経路を使う）
+        factor = -(-max(y1 - y0, x1 - x0) // cls.CONTOUR_MAX_SIZE)
+        height = -(-(y1 - y0) // factor) * factor
+        width = -(-(x1 - x0) // factor) * factor
+        crop = mask[y0:y0 + height, x0:x0 + width]
+        # 画像の端に接する輪郭も閉じるように余白を付ける（切り出しが縮小率で割り切れない分も埋める）
+        crop = cv2.copyMakeBorder(
+            crop, factor, factor + height - crop.shape[0], factor, factor + width - crop.shape[1],
+            cv2.BORDER_CONSTANT, value=0,
+        )
+        if factor > 1:
+            crop = cv2.resize(crop, (crop.shape[1] // factor, crop.shape[0] // factor), interpolation=cv2.INTER_AREA)
 
-        # 輪郭を簡略化
-        epsilon = 0.005 * cv2.arcLength(largest_contour, True)
-        approx = cv2.approxPolyDP(largest_contour, epsilon, True)
+        # 外周と穴の2階層で検出
+        found, hierarchy = cv2.findContours(crop, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        if not found:
+            return None
+        hierarchy = hierarchy[0]
+        areas = [cv2.contourArea(c) for c in found]
 
-        # ポリゴン座標
-        polygon = [(int(p[0][0]), int(p[0][1])) for p in approx]
+        def to_image(contour: np.ndarray) -> np.ndarray:
+            # 余白の1px分を戻し、縮小した画素の中心を元の解像度の座標に戻す
+            points = contour.reshape(-1, 2).astype(np.float32) - 1
+            if factor > 1:
+                points = (points + 0.5) * factor - 0.5
+            return points + np.array([x0, y0], dtype=np.float32)
 
-        # バウンディングボックス
-        x, y, w, h = cv2.boundingRect(largest_contour)
+        outers = sorted((i for i in range(len(found)) if hierarchy[i][3] < 0), key=lambda i: -areas[i])
+        largest_area = areas[outers[0]]
+        contours = []
+        for i in outers[:cls.MAX_POLYGON_PARTS]:
+            if contours and areas[i] < largest_area * cls.MIN_PART_AREA_RATIO:
+                break
+            holes = sorted(
+                (j for j in range(len(found)) if hierarchy[j][3] == i and areas[j] >= areas[i] * cls.MIN_PART_AREA_RATIO),
+                key=lambda j: -areas[j],
+            )[:cls.MAX_POLYGON_PARTS]
+            contours.append((to_image(found[i]), [to_image(found[j]) for j in holes]))
 
+        exterior = np.round(contours[0][0]).astype(np.int32)
+        x, y = exterior.min(axis=0)
+        x1, y1 = exterior.max(axis=0)
         return {
-            "polygon": polygon,
-            "bounding_box": (x, y, w, h),
+            "polygon": cls._simplify(contours[0][0], "medium"),
+            "bounding_box": (int(x), int(y), int(x1 - x) + 1, int(y1 - y) + 1),
+            "contours": contours,
         }
+
+    @classmethod
+    def _simplify(cls, contour: np.ndarray, lod: str) -> list[tuple[int, int]]:
+        """輪郭を詳細度に応じて簡略化（許容誤差は輪郭の長さに比例）"""
+        import cv2
+
+        epsilon = cls.POLYGON_LODS[lod] * cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, epsilon, True).reshape(-1, 2)
+        return [(int(round(px)), int(round(py))) for px, py in approx]
+
+    @classmethod
+    def polygon_at(cls, result: dict, lod: str) -> list[tuple[int, int]]:
+        """結果の最大の部分の外周を指定した詳細度で返す（輪郭がない結果は polygon のまま）"""
+        if lod == "medium" or "contours" not in result:
+            return result["polygon"]
+        return cls._simplify(result["contours"][0][0], lod)
+
+    @classmethod
+    def polygon_shapes(
+        cls,
+        result: dict,
+        lods: list[str],
+        holes: bool = False,
+        multipart: bool = False,
+    ) -> dict[str, list[dict]]:
+        """
+        結果の輪郭を詳細度ごとに簡略化
+
+        Args:
+            result: _mask_to_result などが返した結果
+            lods: 詳細度（"coarse" / "medium" / "fine"）
+            holes: 穴を含める
+            multipart: 最大の部分以外も含める
+
+        Returns:
+            {詳細度: [{"exterior": [(x, y), ...], "holes": [[(x, y), ...], ...]}, ...]}
+            （最初の要素が最大の部分。簡略化で3頂点未満になった部分・穴は除く）
+        """
+        contours = result.get("contours")
+        shapes = {}
+        for lod in lods:
+            if contours is None:
+                # 輪郭がない結果（ダミーモード・投げ縄のフォールバックなど）は polygon をそのまま使う
+                shapes[lod] = [{"exterior": result["polygon"], "holes": []}]
+                continue
+            parts = []
+            for index, (exterior, part_holes) in enumerate(contours if multipart else contours[:1]):
+                simplified = cls._simplify(exterior, lod)
+                if index > 0 and len(simplified) < 3:
+                    continue
+                rings = [cls._simplify(h, lod) for h in part_holes] if holes else []
+                parts.append({"exterior": simplified, "holes": [r for r in rings if len(r) >= 3]})
+            shapes[lod] = parts
+        return shapes
@@ -0,0 +1,124 @@
+"""
+WebSocket対話セグメンテーションセッション（/ws/segment）のメッセージ形式
+
+HTTPの /api/segment はクリックのたびに画像の転送・デコード・埋め込みの確認を繰り返す。
+セッションでは最初に画像を1回だけ送り、埋め込みをセッションの間キャッシュに固定して、
+以降は小さなプロンプトのメッセージだけをやり取りする。
+
+クライアント -> サーバー:
+    1通目（どちらか）:
+        テキスト {"type": "open", "image_base64": "..."} または {"type": "open", "photo_id": "..."}
+        バイナリ 画像ファイルのバイト列そのもの
+    以降（テキスト）:
+        {"type": "segment", "id": 1, "points": [[x, y, 1], [x, y, 0]], "box": [x1, y1, x2, y2]}
+            points の3番目は 1 = 前景, 0 = 背景（points と box はどちらか一方でも可）
+        {"type": "lasso", "id": 2, "points": [[x, y], ...]}
+        {"type": "refine", "id": 3, "mask_id": "...", "points": [[x, y, 0]]}
+            以前の結果（mask_id）に点を追加して再調整する
+
+サーバー -> クライアント:
+    {"type": "ready", "image_key": "...", "width": W, "height": H}
+    {"type": "result", "id": 1, "mask_id": "...", "polygon": [x1, y1, x2, y2, ...], "bbox": [x, y, w, h]}
+    {"type": "error", "id": 1, "code": "...", "error": "..."}
+
+    ?lod=coarse / fine で接続した場合、polygon はその詳細度になる（既定は medium）
+
+    ?format=binary で接続した場合、result はバイナリフレーム（リトルエンディアン）:
+        uint32 id, byte[16] mask_id, int32 x, int32 y, int32 w, int32 h, uint32 n, int32 座標 x 2n
+        （mask_id は16進文字列の mask_id をバイト列にしたもの）
+"""
+
+import struct
+from typing import Optional
+
+import numpy as np
+
+# バイナリ形式の結果ヘッダー: id, mask_id, bbox(x, y, w, h), 頂点数
+_RESULT_HEADER = struct.Struct("<I16siiiiI")
+
+
+class PromptError(ValueError):
+    """プロンプトのメッセージが不正"""
+
+    def __init__(self, error: str, code: str = "INVALID_MESSAGE"):
+        super().__init__(error)
+        self.error = error
+        self.code = code
+
+
+def parse_prompt(message: dict, width: int, height: int) -> tuple[str, tuple, dict]:
+    """
+    プロンプトのメッセージを検証して推論の引数に変換
+
+    Returns:
+        (モード "prompts" / "lasso" / "refine", 合流用のプロンプトキー, 推論の引数)
+
+    Raises:
+        PromptError: メッセージが不正
+    """
+    kind = message.get("type")
+    raw_points = message.get("points") or []
+    try:
+        points = [tuple(int(v) for v in p) for p in raw_points]
+        box = tuple(int(v) for v in message["box"]) if message.get("box") is not None else None
+    except (TypeError, ValueError):
+        raise PromptError("座標の形式が不正です")
+
+    for p in points:
+        if len(p) < 2 or not (0 <= p[0] < width and 0 <= p[1] < height):
+            raise PromptError("座標が画像範囲外です", "INVALID_COORDINATES")
+
+    if kind == "lasso":
+        if len(points) < 3:
+            raise PromptError("投げ縄には3点以上必要です", "INVALID_POLYGON")
+        lasso = [(p[0], p[1]) for p in points]
+        return "lasso", ("lasso", tuple(lasso)), {"lasso_polygon": lasso}
+
+    if kind not in ("segment", "refine"):
+        raise PromptError(f"不明なメッセージです: {kind}")
+
+    if any(len(p) != 3 or p[2] not in (0, 1) for p in points):
+        raise PromptError("点は [x, y, ラベル(0または1)] で指定してください")
+
+    if kind == "refine":
+        mask_id = message.get("mask_id")
+        if not isinstance(mask_id, str) or not points:
+            raise PromptError("mask_id と追加する点が必要です")
+        args = {
+            "mask_id": mask_id,
+            "point_coords": [(p[0], p[1]) for p in points],
+            "point_labels": [p[2] for p in points],
+        }
+        return "refine", ("refine", mask_id, tuple(points)), args
+
+    if box is not None:
+        if len(box) != 4 or box[0] >= box[2] or box[1] >= box[3]:
+            raise PromptError("ボックスは [x1, y1, x2, y2] で指定してください")
+        box = (max(0, box[0]), max(0, box[1]), min(width, box[2]), min(height, box[3]))
+    if not points and box is None:
+        raise PromptError("点またはボックスが必要です")
+
+    args = {
+        "point_coords": [(p[0], p[1]) for p in points],
+        "point_labels": [p[2] for p in points],
+        "box": box,
+    }
+    return "prompts", ("prompts", tuple(points), box), args
+
+
+def encode_result(message_id: int, result: dict, binary: bool) -> "bytes | dict":
+    """推論結果をコンパクトなフレームに変換（頂点はフラットな整数列）"""
+    x, y, w, h = (int(v) for v in result["bounding_box"])
+    flat = np.asarray(result["polygon"], dtype=np.int32).reshape(-1)
+    mask_id = result.get("mask_id")
+    if binary:
+        header = _RESULT_HEADER.pack(
+            message_id, bytes.fromhex(mask_id) if mask_id else bytes(16), x, y, w, h, len(flat) // 2
+        )
+        return header + flat.astype("<i4").tobytes()
+    return {"type": "result", "id": message_id, "mask_id": mask_id, "polygon": flat.tolist(), "bbox": [x, y, w, h]}
+
+
+def error_frame(message_id: Optional[int], code: str, error: str, **extra) -> dict:
+    """エラーのフレーム"""
+    return {"type": "error", "id": message_id, "code": code, "error": error, **extra}
@@ -0,0 +1,343 @@
+"""
+登録済みオブジェクトの類似検索
+
+オブジェクトの登録時に、写真とマスクから特徴ベクトル（SAMの埋め込みのマスクプーリング）を
+バックグラウンドで計算し、aredoko_object_features に保存する。
+GET /api/objects/{object_id}/similar は、同じ倉庫のオブジェクトを特徴ベクトルのコサイン類似度で並べる。
+検索はプロセス内の索引だけで行い、モデルは呼ばない。
+
+- 索引は倉庫・特徴の種類（モデル）ごと。ベクトルはfloat16で保持する
+- SIMILARITY_IVF_THRESHOLD 件までは全件を比較する（ブルートフォース）
+- それ以上は球面k-meansで分割し、クエリに近い SIMILARITY_IVF_PROBES 個の分割だけを比較する（IVF）
+- 索引は最初の検索時にDBから読み込み、SIMILARITY_INDEX_TTL 秒ごとに読み直す
+  （このプロセスでの登録・削除はすぐに反映する）
+"""
+
+import asyncio
+import base64
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+
+from config import (
+    SIMILARITY_INDEX_TTL,
+    SIMILARITY_IVF_PROBES,
+    SIMILARITY_IVF_THRESHOLD,
+)
+from database import get_supabase_client
+from metrics import track_stage, track_supabase
+from singleflight import SingleFlight
+from utils import read_image
+
+# 全件比較でfloat32に変換しながら計算する行数（変換用の一時配列を小さく保つ）
+_CHUNK_ROWS = 4096
+# DBから読み込む1回あたりの行数（PostgRESTの上限より小さく）
+_PAGE_SIZE = 1000
+# 分割の学習に使う最大件数と反復回数
+_KMEANS_SAMPLE = 20000
+_KMEANS_ITERATIONS = 10
+
+# 特徴ベクトルの計算（main.py が登録する）
+# (object_id, 写真のバイト列, mask_type, mask_data) -> {"model", "vector"} または None
+_feature_extractor: Optional[Callable[[str, bytes, str, dict], Awaitable[Optional[dict]]]] = None
+
+
+def register_feature_extractor(
+    extractor: Callable[[str, bytes, str, dict], Awaitable[Optional[dict]]],
+) -> None:
+    """特徴ベクトルを計算する関数を登録"""
+    global _feature_extractor
+    _feature_extractor = extractor
+
+
+def encode_vector(vector: np.ndarray) -> str:
+    """特徴ベクトルをDBに保存する形式（float16のBase64）に変換"""
+    return base64.b64encode(vector.astype(np.float16).tobytes()).decode("ascii")
+
+
+def decode_vector(value: str) -> np.ndarray:
+    """encode_vector の逆変換"""
+    return np.frombuffer(base64.b64decode(value), dtype=np.float16)
+
+
+class SimilarityIndex:
+    """1つの倉庫・特徴の種類のベクトル索引（L2正規化済みのベクトルを内積で比較）"""
+
+    def __init__(self, dim: int, ivf_threshold: int = 8192, probes: int = 8):
+        """
+        Args:
+            dim: ベクトルの次元
+            ivf_threshold: IVFモードに切り替える件数
+            probes: IVFモードで比較する分割の数
+        """
+        self.dim = dim
+        self.ivf_threshold = ivf_threshold
+        self.probes = probes
+        self._vectors = np.empty((0, dim), dtype=np.float16)
+        self._ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        # IVF: 分割の中心（nlist, dim）と各行の分割番号。件数が倍になったら学習し直す
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._trained_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, object_id: str) -> bool:
+        return object_id in self._rows
+
+    def add(self, object_id: str, vector: np.ndarray) -> None:
+        """ベクトルを追加（同じIDがあれば置き換える）"""
+        with self._lock:
+            row = self._rows.get(object_id)
+            if row is None:
+                row = len(self._ids)
+                if row == len(self._vectors):
+                    self._grow(max(64, row * 2))
+                self._ids.append(object_id)
+                self._rows[object_id] = row
+            self._vectors[row] = vector
+            if self._centroids is not None:
+                self._assignments[row] = int(np.argmax(self._centroids @ vector.astype(np.float32)))
+
+    def remove(self, object_id: str) -> None:
+        """ベクトルを削除（最後の行を空いた行に移す）"""
+        with self._lock:
+            row = self._rows.pop(object_id, None)
+            if row is None:
+                return
+            last = len(self._ids) - 1
+            if row != last:
+                moved = self._ids[last]
+                self._ids[row] = moved
+                self._rows[moved] = row
+                self._vectors[row] = self._vectors[last]
+                self._assignments[row] = self._assignments[last]
+            self._ids.pop()
+
+    def vector(self, object_id: str) -> Optional[np.ndarray]:
+        """保持しているベクトル（float32）"""
+        with self._lock:
+            row = self._rows.get(object_id)
+            return None if row is None else self._vectors[row].astype(np.float32)
+
+    def search(self, query: np.ndarray, limit: int, exclude: Optional[str] = None) -> list[tuple[str, float]]:
+        """
+        クエリに近い順に (オブジェクトID, コサイン類似度) を返す
+
+        Args:
+            query: L2正規化したクエリのベクトル
+            limit: 最大件数
+            exclude: 結果から除くID（クエリのオブジェクト自身）
+        """
+        with self._lock:
+            size = len(self._ids)
+            if size == 0:
+                return []
+            query = query.astype(np.float32)
+            if size >= self.ivf_threshold:
+                if self._centroids is None or size >= self._trained_size * 2:
+                    self._train(size)
+                candidates = self._probe(query, size)
+            else:
+                candidates = None
+            scores = self._scores(query, candidates, size)
+            rows = np.arange(size) if candidates is None else candidates
+
+            # 除外する行の分だけ多めに取り出す
+            count = min(limit + 1, len(scores))
+            top = np.argpartition(-scores, count - 1)[:count] if count < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            results = [(self._ids[rows[i]], float(scores[i])) for i in top]
+        return [(object_id, score) for object_id, score in results if object_id != exclude][:limit]
+
+    def _grow(self, capacity: int) -> None:
+        vectors = np.empty((capacity, self.dim), dtype=np.float16)
+        vectors[:len(self._ids)] = self._vectors[:len(self._ids)]
+        self._vectors = vectors
+        assignments = np.zeros(capacity, dtype=np.int32)
+        assignments[:len(self._ids)] = self._assignments[:len(self._ids)]
+        self._assignments = assignments
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray], size: int) -> np.ndarray:
+        """内積（float16のまま行列積を取ると遅いため、一定の行数ずつfloat32に変換して計算）"""
+        vectors = self._vectors[:size] if rows is None else self._vectors[rows]
+        return np.concatenate([
+            vectors[start:start + _CHUNK_ROWS].astype(np.float32) @ query
+            for start in range(0, len(vectors), _CHUNK_ROWS)
+        ])
+
+    def _train(self, size: int) -> None:
+        """全件を球面k-meansで約√n個に分割"""
+        with track_stage("similarity_train"):
+            vectors = self._vectors[:size].astype(np.float32)
+            nlist = max(self.probes, int(np.sqrt(size)))
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(size, min(size, _KMEANS_SAMPLE), replace=False)]
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+            for _ in range(_KMEANS_ITERATIONS):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, sample)
+                norms = np.linalg.norm(sums, axis=1, keepdims=True)
+                # 空の分割は前回の中心のまま
+                centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+            self._centroids = centroids
+            self._assignments[:size] = np.concatenate([
+                np.argmax(vectors[start:start + _CHUNK_ROWS] @ centroids.T, axis=1)
+                for start in range(0, size, _CHUNK_ROWS)
+            ])
+            self._trained_size = size
+
+    def _probe(self, query: np.ndarray, size: int) -> np.ndarray:
+        """クエリに近い分割に属する行"""
+        probes = min(self.probes, len(self._centroids))
+        nearest = np.argpartition(-(self._centroids @ query), probes - 1)[:probes]
+        return np.flatnonzero(np.isin(self._assignments[:size], nearest))
+
+
+class _WarehouseIndexes:
+    """1つの倉庫の索引（特徴の種類ごと）"""
+
+    def __init__(self):
+        self.loaded_at = time.monotonic()
+        self.by_model: dict[str, SimilarityIndex] = {}
+
+    def add(self, model: str, object_id: str, vector: np.ndarray) -> None:
+        index = self.by_model.get(model)
+        if index is None:
+            index = self.by_model[model] = SimilarityIndex(
+                len(vector), SIMILARITY_IVF_THRESHOLD, SIMILARITY_IVF_PROBES
+            )
+        index.add(object_id, vector)
+
+    def find(self, object_id: str) -> Optional[SimilarityIndex]:
+        """オブジェクトのベクトルを持っている索引"""
+        for index in self.by_model.values():
+            if object_id in index:
+                return index
+        return None
+
+
+_indexes: dict[str, _WarehouseIndexes] = {}
+_load_flight = SingleFlight("similarity_index")
+# 計算中の特徴ベクトル: オブジェクトID -> タスク
+_pending: dict[str, asyncio.Task] = {}
+
+
+def _load_indexes(warehouse_id: str) -> _WarehouseIndexes:
+    """倉庫の特徴ベクトルをDBから読み込んで索引を作る"""
+    client = get_supabase_client()
+    indexes = _WarehouseIndexes()
+    start = 0
+    while True:
+        with track_supabase("aredoko_object_features", "select"):
+            response = (
+                client.table("aredoko_object_features")
+                .select("object_id, model, vector")
+                .eq("warehouse_id", warehouse_id)
+                .order("object_id")
+                .range(start, start + _PAGE_SIZE - 1)
+                .execute()
+            )
+        for row in response.data:
+            indexes.add(row["model"], row["object_id"], decode_vector(row["vector"]))
+        if len(response.data) < _PAGE_SIZE:
+            return indexes
+        start += _PAGE_SIZE
+
+
+async def get_indexes(warehouse_id: str) -> _WarehouseIndexes:
+    """倉庫の索引を取得（未読み込み・期限切れならDBから読み込む）"""
+    indexes = _indexes.get(warehouse_id)
+    if indexes is not None and time.monotonic() - indexes.loaded_at < SIMILARITY_INDEX_TTL:
+        return indexes
+
+    async def load() -> _WarehouseIndexes:
+        loaded = await run_in_threadpool(_load_indexes, warehouse_id)
+        _indexes[warehouse_id] = loaded
+        return loaded
+
+    return await _load_flight.do(warehouse_id, load)
+
+
+async def find_similar(
+    warehouse_id: str, object_id: str, limit: int
+) -> Optional[list[tuple[str, float]]]:
+    """
+    同じ倉庫で object_id に似ているオブジェクト
+
+    Returns:
+        類似度の高い順の (オブジェクトID, コサイン類似度)。
+        object_id の特徴ベクトルがまだない場合は None
+    """
+    indexes = await get_indexes(warehouse_id)
+    index = indexes.find(object_id)
+    if index is None:
+        return None
+    query = index.vector(object_id)
+    with track_stage("similarity_search"):
+        return await run_in_threadpool(index.search, query, limit, object_id)
+
+
+def _store_feature(warehouse_id: str, object_id: str, feature: dict) -> None:
+    client = get_supabase_client()
+    with track_supabase("aredoko_object_features", "upsert"):
+        client.table("aredoko_object_features").upsert({
+            "object_id": object_id,
+            "warehouse_id": warehouse_id,
+            "model": feature["model"],
+            "vector": encode_vector(feature["vector"]),
+        }).execute()
+
+
+async def _compute_feature(warehouse_id: str, image_path: str, obj: dict) -> None:
+    object_id = obj["id"]
+    try:
+        photo_bytes = await run_in_threadpool(read_image, image_path)
+        feature = await _feature_extractor(object_id, photo_bytes, obj["mask_type"], obj["mask_data"])
+        if feature is None:
+            return
+        await run_in_threadpool(_store_feature, warehouse_id, object_id, feature)
+        indexes = _indexes.get(warehouse_id)
+        if indexes is not None:
+            indexes.add(feature["model"], object_id, feature["vector"].astype(np.float16))
+    except Exception as e:
+        # 次の検索で計算し直す
+        print(f"Failed to compute features for object {object_id}: {e}")
+
+
+def schedule_object_feature(warehouse_id: str, photo: dict, obj: dict) -> None:
+    """
+    オブジェクトの特徴ベクトルの計算をバックグラウンドで開始（計算中なら何もしない）
+
+    Args:
+        warehouse_id: 倉庫ID
+        photo: オブジェクトの写真の行
+        obj: オブジェクトの行
+    """
+    if _feature_extractor is None or obj["id"] in _pending:
+        return
+    task = asyncio.ensure_future(_compute_feature(warehouse_id, photo["image_path"], obj))
+    _pending[obj["id"]] = task
+    task.add_done_callback(lambda _: _pending.pop(obj["id"], None))
+
+
+def forget_objects(warehouse_id: str, *object_ids: str) -> None:
+    """削除したオブジェクトを索引から外す（DBの行は外部キーで一緒に削除される）"""
+    indexes = _indexes.get(warehouse_id)
+    if indexes is None:
+        return
+    for index in indexes.by_model.values():
+        for object_id in object_ids:
+            index.remove(object_id)
+
+
+def forget_warehouse(warehouse_id: str) -> None:
+    """削除した倉庫の索引を破棄"""
+    _indexes.pop(warehouse_id, None)
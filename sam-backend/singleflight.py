@@ -0,0 +1,57 @@
+"""
+リクエストの合流（single-flight）
+
+同じキーの処理が実行中であれば新たに実行せず、実行中の処理の結果を共有する。
+ダブルクリックやフロントエンドの再送で、同じ画像・同じプロンプトの推論が
+同時に届いた場合にモデルを二重に動かさないために使う。
+
+- encode: 画像のダイジェスト単位（set_imageによる埋め込み計算）
+- decode: ダイジェスト + プロンプト単位（セグメンテーション結果）
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from metrics import SINGLEFLIGHT_TOTAL
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つにまとめる"""
+
+    def __init__(self, kind: str):
+        """
+        Args:
+            kind: メトリクスのラベル（encode, decode など）
+        """
+        self.kind = kind
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        key の処理が実行中ならその結果を待ち、なければ fn() を実行する
+
+        処理は独立したタスクとして実行するため、最初の呼び出し元が切断されても
+        合流した他の呼び出し元には結果が届く。例外も全員に伝わる。
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+            SINGLEFLIGHT_TOTAL.labels(kind=self.kind, role="leader").inc()
+        else:
+            SINGLEFLIGHT_TOTAL.labels(kind=self.kind, role="follower").inc()
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 待っている呼び出し元がいなくても「例外が取得されなかった」警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    def inflight(self) -> int:
+        """実行中のキーの数"""
+        return len(self._inflight)
@@ -0,0 +1,27 @@
+"""
+pytest共通設定
+
+sam-backend/ 直下のモジュール（main.py, sam_service.py など）をパッケージなしで
+インポートできるようにする。SAMのチェックポイントがない環境ではダミーモードで動く。
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """インメモリのSupabaseとローカルストレージでAPIを起動（ダミーモード）。(main, TestClient) を返す"""
+    monkeypatch.setenv("STORAGE_BACKEND", "local")
+    monkeypatch.setenv("LOCAL_STORAGE_DIR", tempfile.mkdtemp())
+    from benchmarks import fake_supabase
+    fake_supabase.install()
+
+    import main
+    from fastapi.testclient import TestClient
+    return main, TestClient(main.app)
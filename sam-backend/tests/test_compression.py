@@ -0,0 +1,84 @@
+"""レスポンス圧縮ミドルウェア（utils/compression.py）のテスト"""
+
+import asyncio
+import threading
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from utils.compression import CompressionMiddleware
+
+LARGE_BODY = "x" * (256 * 1024)
+
+
+class _BlockingCompression(CompressionMiddleware):
+    """大きな本文の圧縮を、テストが release をセットするまで止める"""
+
+    def __init__(self, app, **kwargs):
+        super().__init__(app, **kwargs)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.released = None
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if len(body) >= self.threadpool_size:
+            self.started.set()
+            # イベントループ上で圧縮していれば、テストが release をセットできずにタイムアウトする
+            self.released = self.release.wait(timeout=2)
+        return super().compress(body, encoding)
+
+
+def _app(**kwargs) -> _BlockingCompression:
+    async def large(request):
+        return PlainTextResponse(LARGE_BODY)
+
+    async def small(request):
+        return PlainTextResponse("pong" * 512)
+
+    app = Starlette(routes=[Route("/large", large), Route("/small", small)])
+    return _BlockingCompression(app, **kwargs)
+
+
+def test_large_response_is_compressed_off_the_event_loop():
+    """大きなレスポンスを圧縮している間も、他のリクエストに応答する"""
+    middleware = _app()
+
+    async def main():
+        transport = httpx.ASGITransport(app=middleware)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            headers = {"Accept-Encoding": "gzip"}
+            large = asyncio.ensure_future(client.get("/large", headers=headers))
+            while not middleware.started.is_set():
+                await asyncio.sleep(0.001)
+
+            small = await client.get("/small", headers=headers)
+            middleware.release.set()
+            return small, await large
+
+    small, large = asyncio.run(main())
+    assert middleware.released is True
+    assert small.status_code == 200
+    assert small.headers["content-encoding"] == "gzip"
+    assert large.headers["content-encoding"] == "gzip"
+    assert large.text == LARGE_BODY
+
+
+def test_small_and_uncompressed_responses():
+    """小さいレスポンスは圧縮せず、Accept-Encoding なしでも Vary を付ける"""
+    middleware = _app(minimum_size=4096)
+
+    async def main():
+        transport = httpx.ASGITransport(app=middleware)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            small = await client.get("/small", headers={"Accept-Encoding": "gzip"})
+            identity = await client.get("/large", headers={"Accept-Encoding": "identity"})
+            return small, identity
+
+    small, identity = asyncio.run(main())
+    assert "content-encoding" not in small.headers
+    assert small.headers["vary"] == "Accept-Encoding"
+    assert "content-encoding" not in identity.headers
+    assert identity.headers["vary"] == "Accept-Encoding"
+    assert len(identity.content) == len(LARGE_BODY)
@@ -0,0 +1,114 @@
+"""マスクの輪郭抽出（穴・複数の部分）と詳細度ごとの簡略化のテスト"""
+
+import numpy as np
+
+from sam_service import SAMService
+
+
+def _bounds(points) -> tuple[float, float, float, float]:
+    points = np.asarray(points, dtype=np.float32)
+    (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    return float(x0), float(y0), float(x1), float(y1)
+
+
+def _ring_mask(size: int = 200) -> np.ndarray:
+    """(40, 40)-(159, 159) の正方形に (80, 80)-(119, 119) の穴"""
+    mask = np.zeros((size, size), dtype=bool)
+    mask[40:160, 40:160] = True
+    mask[80:120, 80:120] = False
+    return mask
+
+
+def test_empty_mask_returns_none():
+    assert SAMService._extract_contours(np.zeros((32, 32), dtype=bool)) is None
+
+
+def test_hole_is_extracted_with_image_coordinates():
+    """穴は外周の子として、元画像の座標で返す"""
+    result = SAMService._extract_contours(_ring_mask())
+
+    assert result["bounding_box"] == (40, 40, 120, 120)
+    assert len(result["contours"]) == 1
+    exterior, holes = result["contours"][0]
+    assert _bounds(exterior) == (40, 40, 159, 159)
+    assert len(holes) == 1
+    x0, y0, x1, y1 = _bounds(holes[0])
+    # 穴の輪郭は穴に接する前景の画素をたどる
+    assert 79 <= x0 <= 80 and 79 <= y0 <= 80 and 119 <= x1 <= 120 and 119 <= y1 <= 120
+
+
+def test_small_holes_are_dropped():
+    """外周に対する面積が MIN_PART_AREA_RATIO 未満の穴は捨てる"""
+    mask = np.zeros((200, 200), dtype=bool)
+    mask[40:160, 40:160] = True
+    mask[60:63, 60:63] = False  # 面積が外周の1%未満
+    mask[100:130, 100:130] = False
+
+    exterior, holes = SAMService._extract_contours(mask)["contours"][0]
+
+    assert len(holes) == 1
+    assert _bounds(holes[0])[0] >= 99
+
+
+def test_parts_are_ordered_by_area_and_specks_dropped():
+    """複数の部分は面積の大きい順。最大の部分に対して小さすぎる部分は捨てる"""
+    mask = np.zeros((200, 200), dtype=bool)
+    mask[150:180, 150:180] = True  # 小さい部分
+    mask[10:110, 10:110] = True  # 最大の部分
+    mask[190:193, 10:13] = True  # 最大の部分の1%未満
+
+    result = SAMService._extract_contours(mask)
+
+    assert result["bounding_box"] == (10, 10, 100, 100)
+    assert [_bounds(exterior) for exterior, _ in result["contours"]] == [
+        (10, 10, 109, 109),
+        (150, 150, 179, 179),
+    ]
+
+
+def test_downscaled_extraction_keeps_coordinates():
+    """CONTOUR_MAX_SIZE を超えるマスクは縮小して抽出し、座標を元の解像度に戻す"""
+    mask = np.zeros((2200, 2200), dtype=bool)
+    mask[100:2100, 100:2100] = True
+    mask[900:1300, 900:1300] = False
+
+    result = SAMService._extract_contours(mask)
+
+    exterior, holes = result["contours"][0]
+    factor = -(-2000 // SAMService.CONTOUR_MAX_SIZE)
+    for actual, expected in zip(_bounds(exterior), (100, 100, 2099, 2099)):
+        assert abs(actual - expected) <= factor
+    assert len(holes) == 1
+    for actual, expected in zip(_bounds(holes[0]), (900, 900, 1299, 1299)):
+        assert abs(actual - expected) <= factor + 1
+
+
+def test_polygon_shapes_respects_holes_and_multipart():
+    """holes・multipart を指定しない場合は最大の部分の外周だけを返す"""
+    mask = _ring_mask()
+    mask[170:195, 170:195] = True
+    result = SAMService._extract_contours(mask)
+
+    default = SAMService.polygon_shapes(result, ["medium"])
+    assert len(default["medium"]) == 1
+    assert default["medium"][0]["holes"] == []
+    assert default["medium"][0]["exterior"] == result["polygon"]
+
+    shapes = SAMService.polygon_shapes(result, ["coarse", "fine"], holes=True, multipart=True)
+    for lod in ("coarse", "fine"):
+        parts = shapes[lod]
+        assert len(parts) == 2
+        assert len(parts[0]["holes"]) == 1
+        assert parts[1]["holes"] == []
+        assert all(len(ring) >= 3 for part in parts for ring in [part["exterior"], *part["holes"]])
+    # fine は coarse 以上の頂点数
+    assert len(shapes["fine"][0]["exterior"]) >= len(shapes["coarse"][0]["exterior"])
+
+
+def test_polygon_shapes_without_contours_uses_polygon():
+    """輪郭がない結果（ダミーモードなど）は polygon をそのまま返す"""
+    result = {"polygon": [(0, 0), (10, 0), (10, 10)], "bounding_box": (0, 0, 11, 11)}
+
+    shapes = SAMService.polygon_shapes(result, ["coarse", "fine"], holes=True, multipart=True)
+
+    assert shapes == {lod: [{"exterior": result["polygon"], "holes": []}] for lod in ("coarse", "fine")}
@@ -0,0 +1,74 @@
+"""推論ワーカープロセスのプール（inference_pool.py）のテスト"""
+
+import numpy as np
+import pytest
+
+from inference_pool import InferencePool
+from sam_service import SAMService
+
+
+class _RecordingService(SAMService):
+    """受け取った画像に画素があったか（画素なしのビューでないか）を返すSAMService"""
+
+    def __init__(self):
+        super().__init__()
+        self.prepared = set()
+
+    def has_image(self, image_key: str) -> bool:
+        return image_key in self.prepared
+
+    def prepare_image(self, image: np.ndarray, image_key: str) -> bool:
+        self.prepared.add(image_key)
+        return _has_pixels(image)
+
+    def segment(self, image: np.ndarray, click_point: tuple[int, int], image_key=None) -> dict:
+        return {"pixels": _has_pixels(image), "shape": image.shape, "corner": int(image[0, 0, 0])}
+
+
+def _has_pixels(image: np.ndarray) -> bool:
+    return all(stride != 0 for stride in image.strides)
+
+
+@pytest.fixture
+def worker():
+    pool = InferencePool(1, threads=1)
+    if pool.context.get_start_method() != "fork":
+        pytest.skip("requires fork")
+    worker = pool._workers[0]
+    worker.start(_RecordingService())
+    yield worker
+    worker.stop()
+
+
+def test_pixels_are_sent_only_when_the_worker_has_no_embedding(worker):
+    image = np.full((48, 64, 3), 7, dtype=np.uint8)
+
+    # 埋め込みがないので画素を送り直す
+    assert worker.call("prepare_image", image, "key") is True
+    # 埋め込みがあれば画像の大きさだけを送る
+    assert worker.call("prepare_image", image, "key") is False
+    result = worker.call("segment", image=image, click_point=(1, 1), image_key="key")
+    assert result == {"pixels": False, "shape": (48, 64, 3), "corner": 0}
+
+
+def test_pixels_are_sent_for_other_images_and_unkeyed_calls(worker):
+    image = np.full((48, 64, 3), 7, dtype=np.uint8)
+    worker.call("prepare_image", image, "key")
+
+    assert worker.call("segment", image, (1, 1), "other")["pixels"] is True
+    result = worker.call("segment", image=image, click_point=(1, 1))
+    assert result == {"pixels": True, "shape": (48, 64, 3), "corner": 7}
+
+
+def test_pool_uses_configured_model_type():
+    pool = InferencePool(2, model_type="vit_l", threads=1)
+    pool.start()
+    try:
+        service = pool.route("abc")
+        assert service.model_type == "vit_l"
+        image = np.zeros((100, 200, 3), dtype=np.uint8)
+        service.prepare_image(image, "abc")
+        result = service.segment(image=image, click_point=(100, 50), image_key="abc")
+        assert result["bounding_box"] == (95, 45, 10, 10)
+    finally:
+        pool.stop()
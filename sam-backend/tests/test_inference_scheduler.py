@@ -0,0 +1,155 @@
+"""推論スケジューラ（inference_scheduler.py）と、APIの429/503の変換のテスト"""
+
+import asyncio
+import base64
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from inference_scheduler import (
+    BACKGROUND,
+    INTERACTIVE,
+    DeadlineExceededError,
+    InferenceScheduler,
+    QueueFullError,
+)
+
+
+async def _start_blocker(scheduler: InferenceScheduler) -> tuple[asyncio.Future, threading.Event]:
+    """ワーカーを塞ぐ推論を投入し、実行が始まるまで待つ（Event をセットすると終わる）"""
+    release = threading.Event()
+    blocker = asyncio.ensure_future(scheduler.submit(release.wait))
+    while scheduler.stats()["running"] == 0:
+        await asyncio.sleep(0.001)
+    return blocker, release
+
+
+def test_interactive_runs_before_background():
+    """先に並んだバックグラウンド処理より、対話的な操作を先に実行する"""
+    order = []
+
+    async def main():
+        scheduler = InferenceScheduler(max_queue=8)
+        blocker, release = await _start_blocker(scheduler)
+        jobs = [
+            asyncio.ensure_future(scheduler.submit(lambda: order.append("background-1"), BACKGROUND)),
+            asyncio.ensure_future(scheduler.submit(lambda: order.append("background-2"), BACKGROUND)),
+            asyncio.ensure_future(scheduler.submit(lambda: order.append("interactive"), INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *jobs)
+
+    asyncio.run(main())
+    assert order == ["interactive", "background-1", "background-2"]
+
+
+def test_queue_full_raises_with_retry_after():
+    """キューが満杯なら待たせずに QueueFullError（Retry-After の見積もり付き）"""
+    async def main():
+        scheduler = InferenceScheduler(max_queue=1)
+        blocker, release = await _start_blocker(scheduler)
+        queued = asyncio.ensure_future(scheduler.submit(lambda: "queued"))
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(QueueFullError) as excinfo:
+                await scheduler.submit(lambda: "rejected")
+        finally:
+            release.set()
+        assert await queued == "queued"
+        await blocker
+        return excinfo.value.retry_after
+
+    retry_after = asyncio.run(main())
+    assert 1 <= retry_after <= 60
+
+
+def test_background_is_limited_to_its_share():
+    """バックグラウンド処理はキューの一部しか使えず、対話的な操作の枠が残る"""
+    async def main():
+        scheduler = InferenceScheduler(max_queue=4, background_share=0.5)
+        blocker, release = await _start_blocker(scheduler)
+        accepted = [asyncio.ensure_future(scheduler.submit(lambda: None, BACKGROUND)) for _ in range(2)]
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(QueueFullError):
+                await scheduler.submit(lambda: None, BACKGROUND)
+            interactive = asyncio.ensure_future(scheduler.submit(lambda: "interactive", INTERACTIVE))
+            await asyncio.sleep(0)
+        finally:
+            release.set()
+        await asyncio.gather(blocker, *accepted)
+        return await interactive
+
+    assert asyncio.run(main()) == "interactive"
+
+
+def test_deadline_exceeded_while_queued_is_dropped():
+    """キューで期限を過ぎた推論は実行せずに DeadlineExceededError"""
+    ran = []
+
+    async def main():
+        scheduler = InferenceScheduler(max_queue=8)
+        blocker, release = await _start_blocker(scheduler)
+        expired = asyncio.ensure_future(
+            scheduler.submit(lambda: ran.append("expired"), deadline=time.monotonic() + 0.01)
+        )
+        alive = asyncio.ensure_future(scheduler.submit(lambda: ran.append("alive")))
+        await asyncio.sleep(0.05)
+        release.set()
+        await blocker
+        with pytest.raises(DeadlineExceededError):
+            await expired
+        await alive
+
+    asyncio.run(main())
+    assert ran == ["alive"]
+
+
+def test_cancelled_caller_is_skipped():
+    """呼び出し元がキャンセルした推論は実行しない"""
+    ran = []
+
+    async def main():
+        scheduler = InferenceScheduler(max_queue=8)
+        blocker, release = await _start_blocker(scheduler)
+        cancelled = asyncio.ensure_future(scheduler.submit(lambda: ran.append("cancelled")))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        release.set()
+        await blocker
+        await scheduler.submit(lambda: ran.append("next"))
+
+    asyncio.run(main())
+    assert ran == ["next"]
+
+
+def _segment_request() -> dict:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (120, 80, 40)).save(buffer, format="PNG")
+    return {"image_base64": base64.b64encode(buffer.getvalue()).decode(), "click_x": 32, "click_y": 32}
+
+
+def test_segment_returns_429_with_retry_after_when_queue_is_full(api, monkeypatch):
+    main, client = api
+    monkeypatch.setattr(main, "inference_scheduler", InferenceScheduler(max_queue=0))
+
+    response = client.post("/api/segment", json=_segment_request())
+
+    assert response.status_code == 429
+    assert response.json()["detail"]["code"] == "QUEUE_FULL"
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_segment_returns_503_when_deadline_passes(api, monkeypatch):
+    main, client = api
+    monkeypatch.setattr(main, "INFERENCE_DEADLINE_SECONDS", -1)
+
+    response = client.post("/api/segment", json=_segment_request())
+
+    assert response.status_code == 503
+    assert response.json()["detail"]["code"] == "DEADLINE_EXCEEDED"
+    assert "Retry-After" in response.headers
@@ -0,0 +1,119 @@
+"""写真の一括登録（photo_ingest.py）のテスト"""
+
+import asyncio
+import io
+import threading
+from typing import Optional
+
+import pytest
+from PIL import Image
+
+import photo_ingest
+from benchmarks import fake_supabase
+from photo_ingest import IngestSource, ingest_photos
+from utils import storage
+from utils.storage_backends import LocalStorageBackend
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    """インメモリのSupabaseとローカルストレージ"""
+    client = fake_supabase.install()
+    local = LocalStorageBackend(str(tmp_path), "http://test", b"secret")
+    local.ensure_ready()
+    monkeypatch.setattr(storage, "_backend", local)
+    return client, tmp_path
+
+
+def _png(color: tuple[int, int, int]) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _sources(count: int, gate: Optional[threading.Event] = None) -> list[IngestSource]:
+    """
+    先頭は壊れた画像（失敗の進捗がすぐに返る）、残りは色の異なる画像
+
+    gate を指定した場合、後半の画像は gate がセットされるまで読み込みを止める（処理中のまま中断するため）
+    """
+    def read(i: int) -> bytes:
+        if gate is not None and i >= count // 2:
+            gate.wait(timeout=5)
+        return _png((i * 10 % 256, 100, 200))
+
+    sources = [IngestSource("broken.png", lambda: b"not an image")]
+    for i in range(count):
+        sources.append(IngestSource(f"photo{i}.png", lambda i=i: read(i)))
+    return sources
+
+
+def _stored_files(root) -> list:
+    return [path for path in root.rglob("*") if path.is_file()]
+
+
+def test_ingest_inserts_all_photos(backend):
+    client, root = backend
+
+    async def main():
+        return [item async for item in ingest_photos("warehouse", _sources(5), lambda row: row)]
+
+    progress = asyncio.run(main())
+
+    assert progress[-1] == {"status": "done", "created": 5, "failed": 1}
+    assert len(client.db.tables["aredoko_photos"]) == 5
+    assert all(blob["ref_count"] == 1 for blob in client.db.tables["aredoko_blobs"].values())
+    assert len(_stored_files(root)) == 5
+
+
+def test_abandoned_ingest_releases_stored_images(backend, monkeypatch):
+    """途中で中断された場合、保存済みで未挿入の画像と処理中の画像の参照を外す"""
+    client, root = backend
+    # 挿入前に中断されるよう、バッチを大きくしておく
+    monkeypatch.setattr(photo_ingest, "INGEST_BATCH_SIZE", 100)
+
+    gate = threading.Event()
+
+    async def main():
+        stream = ingest_photos("warehouse", _sources(12, gate), lambda row: row)
+        first = await stream.__anext__()
+        # 前半の画像が batch に溜まるまで待ってから、後半の画像の処理中に中断する
+        await asyncio.sleep(0.2)
+        await stream.aclose()
+        gate.set()
+        await asyncio.gather(*photo_ingest._cleanup_tasks)
+        return first
+
+    first = asyncio.run(main())
+
+    assert first["status"] == "failed"
+    assert client.db.tables.get("aredoko_photos", {}) == {}
+    assert client.db.tables.get("aredoko_blobs", {}) == {}
+    assert _stored_files(root) == []
+
+
+def test_cancelled_ingest_releases_stored_images(backend, monkeypatch):
+    """進捗を待っている間にキャンセルされた場合も参照を外す"""
+    client, root = backend
+    monkeypatch.setattr(photo_ingest, "INGEST_BATCH_SIZE", 100)
+
+    gate = threading.Event()
+
+    async def main():
+        async def consume():
+            async for _ in ingest_photos("warehouse", _sources(12, gate), lambda row: row):
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        gate.set()
+        await asyncio.gather(*photo_ingest._cleanup_tasks)
+
+    asyncio.run(main())
+
+    assert client.db.tables.get("aredoko_photos", {}) == {}
+    assert client.db.tables.get("aredoko_blobs", {}) == {}
+    assert _stored_files(root) == []
@@ -0,0 +1,102 @@
+"""クリップ画像の作り直し（POST /api/photos/{photo_id}/objects/reclip）のテスト"""
+
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from database import get_supabase_client
+from routers import objects as objects_router
+from utils.storage import blob_digest
+
+
+@pytest.fixture
+def photo_object(api):
+    """倉庫・写真・オブジェクト（クリップ画像はサーバーが生成）を作成"""
+    _, client = api
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), (120, 80, 40)).save(buffer, format="PNG")
+    data_url = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+    warehouse = client.post("/api/warehouses", json={"name": "倉庫"}).json()
+    photo = client.post(f"/api/warehouses/{warehouse['id']}/photos", json={
+        "name": "写真", "width": 64, "height": 48, "image_data_url": data_url,
+    }).json()
+    obj = client.post(f"/api/photos/{photo['id']}/objects", json={
+        "name": "箱",
+        "mask_type": "rect",
+        "mask_data": {"x": 10, "y": 10, "width": 30, "height": 20},
+        "click_point": {"x": 20, "y": 20},
+    }).json()
+    return photo, obj
+
+
+def _row(object_id: str) -> dict:
+    return get_supabase_client().db.tables["aredoko_objects"][object_id]
+
+
+def _blobs() -> dict:
+    return get_supabase_client().db.tables.get("aredoko_blobs", {})
+
+
+def _ref_counts() -> dict:
+    return {digest: blob["ref_count"] for digest, blob in _blobs().items()}
+
+
+def _store_different_clip(monkeypatch, before_return=None):
+    """マスクを変えたクリップ画像を保存する（保存後、返す前に before_return を呼ぶ）"""
+    store_clip = objects_router._store_clip
+
+    def store(photo_bytes, mask_type, mask_data):
+        path = store_clip(photo_bytes, mask_type, {**mask_data, "width": mask_data["width"] - 10})
+        if before_return is not None:
+            before_return()
+        return path
+
+    monkeypatch.setattr(objects_router, "_store_clip", store)
+
+
+def test_reclip_updates_changed_clips(api, photo_object, monkeypatch):
+    _, client = api
+    photo, obj = photo_object
+    old_path = _row(obj["id"])["clipped_image_path"]
+    _store_different_clip(monkeypatch)
+
+    response = client.post(f"/api/photos/{photo['id']}/objects/reclip")
+
+    assert response.status_code == 200
+    [reclipped] = response.json()
+    assert reclipped["version"] == obj["version"] + 1
+    row = _row(obj["id"])
+    assert row["clipped_image_path"] != old_path
+    # 古いクリップ画像の参照は外れる
+    assert blob_digest(old_path) not in _blobs()
+    assert _blobs()[blob_digest(row["clipped_image_path"])]["ref_count"] == 1
+
+
+def test_reclip_does_not_overwrite_concurrent_update(api, photo_object, monkeypatch):
+    """クリップ画像の生成中に他で更新されたオブジェクトは上書きせず、新しいクリップ画像の参照を戻す"""
+    _, client = api
+    photo, obj = photo_object
+    old_path = _row(obj["id"])["clipped_image_path"]
+    ref_counts = _ref_counts()
+
+    def concurrent_patch():
+        response = client.put(f"/api/objects/{obj['id']}", json={
+            "name": "別の名前", "memo": "", "version": obj["version"],
+        })
+        assert response.status_code == 200
+
+    _store_different_clip(monkeypatch, concurrent_patch)
+
+    response = client.post(f"/api/photos/{photo['id']}/objects/reclip")
+
+    assert response.status_code == 200
+    [current] = response.json()
+    assert current["name"] == "別の名前"
+    assert current["version"] == obj["version"] + 1
+    row = _row(obj["id"])
+    assert row["name"] == "別の名前"
+    assert row["clipped_image_path"] == old_path
+    assert _ref_counts() == ref_counts
@@ -0,0 +1,56 @@
+"""セグメンテーションAPIのテスト（ダミーモード）"""
+
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def decode_calls(api, monkeypatch):
+    """decode_image_in_budget の呼び出しごとに、イベントループ上で実行されたかを記録する"""
+    main, _ = api
+    calls = []
+    decode = main.decode_image_in_budget
+
+    def recording(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            calls.append("event_loop")
+        except RuntimeError:
+            calls.append("thread")
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(main, "decode_image_in_budget", recording)
+    return calls
+
+
+def _image_base64() -> str:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), (120, 80, 40)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_segment_endpoints_decode_in_the_threadpool(api, decode_calls):
+    """画像のデコード（最大16384x16384）でイベントループを止めない"""
+    _, client = api
+    image = _image_base64()
+
+    assert client.post("/api/segment-prepare", json={"image_base64": image}).status_code == 200
+    segment = client.post("/api/segment", json={"image_base64": image, "click_x": 32, "click_y": 24})
+    assert segment.status_code == 200
+    lasso = client.post("/api/segment-lasso", json={
+        "image_base64": image,
+        "lasso_polygon": [{"x": 10, "y": 10}, {"x": 50, "y": 10}, {"x": 30, "y": 40}],
+    })
+    assert lasso.status_code == 200
+    refine = client.post("/api/segment/refine", json={
+        "mask_id": segment.json()["mask_id"],
+        "points": [{"x": 20, "y": 20, "label": 1}],
+        "image_base64": image,
+    })
+    assert refine.status_code == 200
+
+    assert decode_calls == ["thread"] * 4
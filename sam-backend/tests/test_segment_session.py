@@ -0,0 +1,96 @@
+"""WebSocketセグメンテーションセッション（/ws/segment）の埋め込みの固定と解除のテスト"""
+
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from memory_budget import get_memory_budget
+
+
+class _PinRecordingService:
+    """pin_image / unpin_image の呼び出しを記録し、それ以外は元のサービスに委ねる"""
+
+    def __init__(self, service, fail_pin: bool = False):
+        self._service = service
+        self._fail_pin = fail_pin
+        self.calls = []
+
+    def pin_image(self, image_key: str) -> None:
+        self.calls.append(("pin", image_key))
+        if self._fail_pin:
+            raise RuntimeError("pin failed")
+        self._service.pin_image(image_key)
+
+    def unpin_image(self, image_key: str) -> None:
+        self.calls.append(("unpin", image_key))
+        self._service.unpin_image(image_key)
+
+    def __getattr__(self, name):
+        return getattr(self._service, name)
+
+
+def _open_message() -> dict:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), (120, 80, 40)).save(buffer, format="PNG")
+    return {"type": "open", "image_base64": base64.b64encode(buffer.getvalue()).decode()}
+
+
+def _sessions(main) -> float:
+    return main.SEGMENT_SESSIONS._value.get()
+
+
+def test_session_unpins_on_disconnect(api, monkeypatch):
+    main, client = api
+    service = _PinRecordingService(main.get_sam_service())
+    monkeypatch.setattr(main, "get_inference_service", lambda key=None: service)
+    sessions = _sessions(main)
+
+    with client.websocket_connect("/ws/segment") as websocket:
+        websocket.send_json(_open_message())
+        ready = websocket.receive_json()
+        assert ready["type"] == "ready"
+        websocket.send_json({"type": "segment", "id": 1, "points": [[32, 24, 1]]})
+        result = websocket.receive_json()
+        assert result["type"] == "result"
+
+    image_key = ready["image_key"]
+    assert service.calls == [("pin", image_key), ("unpin", image_key)]
+    assert _sessions(main) == sessions
+    assert get_memory_budget().usage()["categories"].get("session_image", 0) == 0
+
+
+def test_failed_pin_is_not_unpinned(api, monkeypatch):
+    """pin_image が失敗した場合は固定を解除せず（固定数を狂わせない）、予約は返却する"""
+    main, client = api
+    service = _PinRecordingService(main.get_sam_service(), fail_pin=True)
+    monkeypatch.setattr(main, "get_inference_service", lambda key=None: service)
+    sessions = _sessions(main)
+
+    with pytest.raises(RuntimeError, match="pin failed"):
+        with client.websocket_connect("/ws/segment") as websocket:
+            websocket.send_json(_open_message())
+            websocket.receive_json()
+
+    assert [call for call, _ in service.calls] == ["pin"]
+    assert _sessions(main) == sessions
+    assert get_memory_budget().usage()["categories"].get("session_image", 0) == 0
+
+
+def test_failed_service_lookup_does_not_unpin(api, monkeypatch):
+    """推論サービスを取得できない場合も、未定義のサービスの固定を解除しようとしない"""
+    main, client = api
+
+    def unavailable(key=None):
+        raise RuntimeError("no inference service")
+
+    monkeypatch.setattr(main, "get_inference_service", unavailable)
+    sessions = _sessions(main)
+
+    with pytest.raises(RuntimeError, match="no inference service"):
+        with client.websocket_connect("/ws/segment") as websocket:
+            websocket.send_json(_open_message())
+            websocket.receive_json()
+
+    assert _sessions(main) == sessions
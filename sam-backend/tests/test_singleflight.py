@@ -0,0 +1,137 @@
+"""推論の合流（singleflight.py）のテスト"""
+
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    """同じキーの同時呼び出しは1回だけ実行し、結果を全員が受け取る"""
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "mask"
+
+    async def main():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+        return results, flight.inflight()
+
+    results, inflight = asyncio.run(main())
+    assert results == ["mask"] * 5
+    assert len(calls) == 1
+    assert inflight == 0
+
+
+def test_different_keys_run_separately():
+    """キーが違えばそれぞれ実行する"""
+    calls = []
+
+    async def work(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key
+
+    async def main():
+        flight = SingleFlight("test")
+        return await asyncio.gather(flight.do("a", lambda: work("a")), flight.do("b", lambda: work("b")))
+
+    assert asyncio.run(main()) == ["a", "b"]
+    assert sorted(calls) == ["a", "b"]
+
+
+def test_key_is_released_after_completion():
+    """完了したキーは次の呼び出しで再び実行する（結果をキャッシュしない）"""
+    calls = []
+
+    async def work():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        flight = SingleFlight("test")
+        first = await flight.do("key", work)
+        second = await flight.do("key", work)
+        return first, second
+
+    assert asyncio.run(main()) == (1, 2)
+
+
+def test_exception_reaches_all_callers():
+    """失敗した場合は合流した全員に例外が伝わり、キーは解放される"""
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("inference failed")
+
+    async def main():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(3)), return_exceptions=True)
+        return results, flight.inflight()
+
+    results, inflight = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(isinstance(r, ValueError) for r in results)
+    assert inflight == 0
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    """最初の呼び出し元がキャンセルされても、処理は続き、合流した呼び出し元は結果を受け取る"""
+    calls = []
+    release = None
+
+    async def work():
+        calls.append(1)
+        await release.wait()
+        return "mask"
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        flight = SingleFlight("test")
+        leader = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert flight.inflight() == 1
+
+        release.set()
+        return await follower, flight.inflight()
+
+    result, inflight = asyncio.run(main())
+    assert result == "mask"
+    assert len(calls) == 1
+    assert inflight == 0
+
+
+def test_work_finishes_after_all_callers_cancel():
+    """全員がキャンセルしても処理は最後まで実行され、キーは解放される（例外の警告も出さない）"""
+    finished = []
+
+    async def work():
+        await asyncio.sleep(0.01)
+        finished.append(1)
+        raise ValueError("nobody is waiting")
+
+    async def main():
+        flight = SingleFlight("test")
+        callers = [asyncio.ensure_future(flight.do("key", work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        return flight.inflight()
+
+    assert asyncio.run(main()) == 0
+    assert finished == [1]
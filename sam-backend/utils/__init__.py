@@ -1,3 +1,25 @@
-from .storage import upload_image, delete_image, get_image_url, ensure_bucket_exists
+from .storage import (
+    upload_image,
+    delete_image,
+    store_image,
+    store_image_bytes,
+    release_image,
+    blob_digest,
+    get_image_url,
+    read_image,
+    ensure_bucket_exists,
+    get_storage_backend,
+)
 
-__all__ = ["upload_image", "delete_image", "get_image_url", "ensure_bucket_exists"]
+__all__ = [
+    "upload_image",
+    "delete_image",
+    "store_image",
+    "store_image_bytes",
+    "release_image",
+    "blob_digest",
+    "get_image_url",
+    "read_image",
+    "ensure_bucket_exists",
+    "get_storage_backend",
+]
@@ -0,0 +1,124 @@
+"""
+オブジェクトのクリップ画像をサーバー側で生成するユーティリティ
+
+保存済みの写真とマスク（mask_data）から、フロントエンドの clipImage / clipImageWithPolygon
+（src/utils/imageUtils.ts）と同じ切り出しを行う。
+
+- rect: バウンディングボックスを切り出す
+- polygon: バウンディングボックスを切り出し、ポリゴンの外側を透明にする
+- 最大辺が CLIP_MAX_SIZE を超える場合は縮小し、WebP（またはPNG）でエンコードする
+"""
+
+import io
+import math
+from typing import Any
+
+from PIL import Image, ImageDraw, ImageOps
+
+from config import CLIP_IMAGE_FORMAT, CLIP_MAX_SIZE, CLIP_WEBP_QUALITY
+from metrics import track_stage
+
+from .images import LARGE_IMAGE_PIXELS, open_image
+
+# 形式 -> (拡張子, Content-Type)
+_FORMATS = {
+    "webp": ("webp", "image/webp"),
+    "png": ("png", "image/png"),
+}
+
+
+def mask_polygon(mask_type: str, mask_data: dict[str, Any]) -> list[tuple[float, float]]:
+    """
+    マスクの輪郭の頂点（rect は4頂点）
+
+    Raises:
+        ValueError: マスクの形式が不正
+    """
+    try:
+        if mask_type == "polygon":
+            points = [(float(p["x"]), float(p["y"])) for p in mask_data["points"]]
+            if len(points) < 3:
+                raise ValueError("Polygon must have at least 3 points")
+            return points
+        if mask_type == "rect":
+            x, y = float(mask_data["x"]), float(mask_data["y"])
+            x1, y1 = x + float(mask_data["width"]), y + float(mask_data["height"])
+            return [(x, y), (x1, y), (x1, y1), (x, y1)]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid mask_data: {e}")
+    raise ValueError(f"Unknown mask type: {mask_type}")
+
+
+def _mask_region(mask_type: str, mask_data: dict[str, Any], width: int, height: int):
+    """
+    マスクのバウンディングボックス（画像内に収める）とポリゴンの頂点
+
+    Returns:
+        ((x0, y0, x1, y1), 頂点のリスト または None)
+
+    Raises:
+        ValueError: マスクの形式が不正、または画像と重ならない
+    """
+    points = mask_polygon(mask_type, mask_data)
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    box = (math.floor(min(xs)), math.floor(min(ys)), math.ceil(max(xs)), math.ceil(max(ys)))
+
+    x0, y0 = max(0, box[0]), max(0, box[1])
+    x1, y1 = min(width, box[2]), min(height, box[3])
+    if x0 >= x1 or y0 >= y1:
+        raise ValueError("Mask is outside of the image")
+    return (x0, y0, x1, y1), (points if mask_type == "polygon" else None)
+
+
+def render_clip(
+    image_bytes: bytes,
+    mask_type: str,
+    mask_data: dict[str, Any],
+    image_format: str = CLIP_IMAGE_FORMAT,
+    max_size: int = CLIP_MAX_SIZE,
+) -> tuple[bytes, str, str]:
+    """
+    写真とマスクからクリップ画像を生成
+
+    Args:
+        image_bytes: 写真のバイト列
+        mask_type: 'polygon' または 'rect'
+        mask_data: マスク情報（polygon: {"points": [{x, y}, ...]}, rect: {x, y, width, height}）
+        image_format: "webp" または "png"
+        max_size: 最大辺の長さ（超える場合は縮小）
+
+    Returns:
+        (エンコード済みのバイト列, 拡張子, Content-Type)
+
+    Raises:
+        ValueError: マスクの形式が不正、または画像と重ならない
+    """
+    extension, content_type = _FORMATS[image_format]
+
+    with track_stage("clip_render"):
+        # 保存済みの写真はタイルモードの画像（最大16384x16384）もありうる
+        image = open_image(image_bytes, LARGE_IMAGE_PIXELS)
+        # ブラウザと同じくEXIFの向きを適用した座標系で切り出す
+        image = ImageOps.exif_transpose(image)
+        box, points = _mask_region(mask_type, mask_data, image.width, image.height)
+
+        clip = image.crop(box)
+        if points is None:
+            clip = clip.convert("RGB")
+        else:
+            clip = clip.convert("RGBA")
+            alpha = Image.new("L", clip.size, 0)
+            ImageDraw.Draw(alpha).polygon([(x - box[0], y - box[1]) for x, y in points], fill=255)
+            clip.putalpha(alpha)
+
+        if max(clip.size) > max_size:
+            clip.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    with track_stage("clip_encode"):
+        buffer = io.BytesIO()
+        if image_format == "webp":
+            clip.save(buffer, format="WEBP", quality=CLIP_WEBP_QUALITY)
+        else:
+            clip.save(buffer, format="PNG")
+    return buffer.getvalue(), extension, content_type
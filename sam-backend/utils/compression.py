@@ -0,0 +1,137 @@
+"""
+レスポンス圧縮ミドルウェア
+
+JSON/テキストのレスポンスを、クライアントの Accept-Encoding に応じて
+brotli（利用可能な場合）または gzip で圧縮する。
+
+- 一定サイズ未満のレスポンスは圧縮しない（圧縮のコストに見合わないため）
+- ストリーミングレスポンス（画像配信のRangeレスポンスなど）は圧縮しない
+- 画像など既に圧縮済みの形式は対象外
+- 圧縮したレスポンスの強いETagは弱いETagに変換する
+- 圧縮対象の形式のレスポンスには、圧縮しなかった場合（Accept-Encodingなし・小さい）も
+  Vary: Accept-Encoding を付ける（共有キャッシュが非圧縮の表現を圧縮対応のクライアントに返さないように）
+- 大きなレスポンス（一覧取得の数MBのJSONなど）はスレッドプールで圧縮する
+  （gzipで数百ms、その間イベントループが止まり、他のリクエスト・SSE・WebSocketが待たされるため）
+"""
+
+import gzip
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# brotliのインポート（インストールされていない場合はgzipのみ）
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# 圧縮対象のContent-Type
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Accept-Encoding から使用する圧縮方式を選ぶ（q=0 は除外）"""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+
+    if BROTLI_AVAILABLE and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    """JSON/テキストのレスポンスをbrotli/gzipで圧縮するASGIミドルウェア"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        threadpool_size: int = 64 * 1024,
+    ):
+        """
+        Args:
+            minimum_size: これ未満のレスポンスは圧縮しない
+            threadpool_size: これ以上のレスポンスはスレッドプールで圧縮する（小さいものはスレッド切り替えの方が高くつく）
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.threadpool_size = threadpool_size
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        """本文を圧縮（encoding は "br" または "gzip"）"""
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = _choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        start_message: Optional[Message] = None
+        passthrough = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start_message, passthrough
+
+            if message["type"] == "http.response.start":
+                # 本文を見るまで送信を保留
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = MutableHeaders(raw=start_message["headers"])
+            body = message.get("body", b"")
+            content_type = headers.get("content-type", "")
+
+            if (
+                message.get("more_body", False)
+                or "content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                # 対象外: そのまま流す
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            # 圧縮しうるレスポンスは、今回圧縮しなくてもAccept-Encodingで表現が変わる
+            headers.add_vary_header("Accept-Encoding")
+            if encoding is None or len(body) < self.minimum_size:
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            if len(body) >= self.threadpool_size:
+                compressed = await run_in_threadpool(self.compress, body, encoding)
+            else:
+                compressed = self.compress(body, encoding)
+
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            # 圧縮後の表現は元のバイト列と異なるので、強いETagは弱いETagにする
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,95 @@
+"""
+HTTPキャッシュ（ETag / 条件付きGET）ユーティリティ
+
+- get_* : 行のid・versionから強いETagを生成
+- list_*: 一覧の (id, version) 列と最大updated_atから弱いETagを生成
+- If-None-Match が一致すれば 304 Not Modified を返す
+  （一覧は If-None-Match がある場合だけ (id, version) を先に取得して比較し、一致しなければ本体を取得する）
+
+画像URL（署名付きURL）を含むレスポンスは、キャッシュされたURLが期限切れにならないよう
+有効期限の半分ごとにETagを変える（with_urls=True）。
+"""
+
+import hashlib
+import time
+from typing import Iterable, Optional
+
+from fastapi import Request, Response
+
+from .storage import SIGNED_URL_EXPIRY_SECONDS
+
+# 共有データなので毎回再検証させる（304で本文の転送を省く）
+CACHE_CONTROL = "private, no-cache"
+
+
+def _url_epoch() -> int:
+    """署名付きURLの更新周期ごとに変わる値"""
+    return int(time.time()) // (SIGNED_URL_EXPIRY_SECONDS // 2)
+
+
+def _digest(parts: Iterable[object]) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()[:32]
+
+
+def strong_etag(row: dict, with_urls: bool = False) -> str:
+    """1行分のレスポンスの強いETag"""
+    parts = [row["id"], row["version"]]
+    if with_urls:
+        parts.append(_url_epoch())
+    return f'"{_digest(parts)}"'
+
+
+def weak_etag(rows: list[dict], with_urls: bool = False) -> str:
+    """
+    一覧レスポンスの弱いETag
+
+    rows は表示順に並んだ id, version, updated_at を含む行
+    （追加・削除・並び替え・更新のいずれでも値が変わる）
+    """
+    parts: list[object] = [len(rows), max((r["updated_at"] for r in rows), default="")]
+    for row in rows:
+        parts.extend((row["id"], row["version"]))
+    if with_urls:
+        parts.append(_url_epoch())
+    return f'W/"{_digest(parts)}"'
+
+
+def _opaque(etag: str) -> str:
+    """弱い比較用にW/プレフィックスを除去"""
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def is_conditional(request: Request) -> bool:
+    """
+    If-None-Match が付いているか
+
+    付いていなければ304は返せないので、一覧のETagを計算するためだけの事前のクエリは省く
+    """
+    return bool(request.headers.get("if-none-match"))
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """If-None-Match がETagと一致するか（RFC 9110の弱い比較）"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    target = _opaque(etag)
+    return any(_opaque(candidate.strip()) == target for candidate in header.split(","))
+
+
+def not_modified_response(etag: str) -> Response:
+    """304 Not Modified レスポンス"""
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+
+def set_cache_headers(response: Response, etag: Optional[str]) -> None:
+    """ETagとCache-Controlをレスポンスに設定"""
+    if etag is not None:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
@@ -0,0 +1,42 @@
+"""
+画像ファイルを開く（展開後の画素数の上限付き）
+
+PILの展開爆弾の検査（Image.MAX_IMAGE_PIXELS を超えると警告、2倍を超えると
+DecompressionBombError）はプロセス全体の設定で、Image.open() のたびに参照される。
+タイルモードの画像（最大16384x16384）を開く間だけ上限を引き上げ、他の画像
+（一括登録のアップロードなど）は既定の上限で検査するため、画像はすべてここで開く。
+"""
+
+import io
+import threading
+from typing import Optional
+
+from PIL import Image
+
+# PILの既定の上限（約8900万画素）
+DEFAULT_MAX_PIXELS = Image.MAX_IMAGE_PIXELS
+# タイルモードで扱える最大の画像（16384x16384）
+LARGE_IMAGE_PIXELS = 16384 * 16384
+
+# 上限を変更してから Image.open() が検査を終えるまでの間、他のスレッドが開かないようにする
+_open_lock = threading.Lock()
+
+
+def open_image(data: bytes, max_pixels: Optional[int] = None) -> Image.Image:
+    """
+    画像を開く（ヘッダーのみ読み込み、デコードは load() まで遅延）
+
+    Args:
+        data: 画像ファイルのバイト列
+        max_pixels: 展開後の画素数の上限（省略時はPILの既定。PILと同じく、2倍を超えると DecompressionBombError）
+
+    Raises:
+        PIL.UnidentifiedImageError: 画像として読み込めない
+        PIL.Image.DecompressionBombError: 画素数が上限を超える
+    """
+    with _open_lock:
+        Image.MAX_IMAGE_PIXELS = max_pixels or DEFAULT_MAX_PIXELS
+        try:
+            return Image.open(io.BytesIO(data))
+        finally:
+            Image.MAX_IMAGE_PIXELS = DEFAULT_MAX_PIXELS
@@ -0,0 +1,71 @@
+"""
+楽観的ロック付きの更新ユーティリティ
+
+現在の行はエンティティキャッシュから読み込む。キャッシュは他のワーカーの更新より古い場合があるため、
+versionが一致しないときはDBから読み直してから 409 VERSION_CONFLICT を判定する。
+UPDATE 文にも version を条件に付け、確認から更新までの間に他で更新された場合も 409 を返す。
+"""
+
+from fastapi import HTTPException
+
+from database import get_entity_cache, get_supabase_client
+from database.entity_cache import ENTITY_TABLES
+from metrics import track_supabase
+
+
+def _version_conflict(current: dict) -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={
+            "code": "VERSION_CONFLICT",
+            "message": "データが他で更新されました",
+            "server_data": current,
+        }
+    )
+
+
+def load_for_update(entity: str, entity_id: str, version: int, not_found: str) -> dict:
+    """
+    更新前の現在の行を取得し、versionを確認
+
+    Args:
+        entity: "warehouse" / "photo" / "object"
+        entity_id: id
+        version: クライアントが持っているversion
+        not_found: 行が存在しない場合の404のメッセージ
+
+    Raises:
+        HTTPException: 行が存在しない（404）、versionが一致しない（409）
+    """
+    cache = get_entity_cache()
+    current = cache.get(entity, entity_id)
+    if current is not None and current["version"] != version:
+        current = cache.get(entity, entity_id, fresh=True)
+    if current is None:
+        raise HTTPException(status_code=404, detail=not_found)
+    if current["version"] != version:
+        raise _version_conflict(current)
+    return current
+
+
+def apply_update(entity: str, entity_id: str, version: int, values: dict, not_found: str) -> dict:
+    """
+    versionが一致する場合だけ行を更新し、更新後の行をキャッシュに保存
+
+    Raises:
+        HTTPException: 確認後に他で更新・削除された（409 / 404）
+    """
+    table = ENTITY_TABLES[entity]
+    client = get_supabase_client()
+    with track_supabase(table, "update"):
+        response = client.table(table).update(values).eq("id", entity_id).eq("version", version).execute()
+
+    cache = get_entity_cache()
+    if not response.data:
+        current = cache.get(entity, entity_id, fresh=True)
+        if current is None:
+            raise HTTPException(status_code=404, detail=not_found)
+        raise _version_conflict(current)
+
+    cache.put(entity, response.data[0])
+    return response.data[0]
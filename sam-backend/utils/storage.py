@@ -1,18 +1,44 @@
 """
-Supabase Storage操作ユーティリティ
+画像ストレージ操作ユーティリティ
+
+保存先は config.STORAGE_BACKEND で切り替える:
+- "supabase": Supabase Storage（デフォルト）
+- "local": ローカルディスク（オンプレミス向け、/api/storage から配信）
 
 セキュリティ設計:
-- バケットは常にPrivate設定（認証なしではアクセス不可）
+- 画像は認証なしでは取得できない（Supabaseはprivateバケット、ローカルは静的配信しない）
 - 画像URLは署名付きURL（Signed URL）を使用
 - 署名付きURLは一定時間のみ有効（デフォルト1時間）
 - 本番・開発環境どちらも同じセキュリティレベル
 
+コンテンツアドレス方式（store_image / release_image）:
+- 画像は内容のSHA-256をキーにした不変のパス（blobs/ab/abcd....jpg）に1回だけ保存する
+- 同じ画像の再登録はアップロードせず、DB（aredoko_blobs）の参照数だけを増やす
+- 新しい画像の行はアップロードが終わるまで pending。同じ画像を同時に保存した他の呼び出しは
+  完了を待ってからパスを返す（アップロードに失敗した場合は待っていた呼び出しが引き継ぐ）
+- 参照数が0になった行はStorageから削除し終わるまで deleting。その間に再登録した呼び出しは
+  削除を待ってからアップロードする（削除が新しいアップロードを消さないように）
+- 参照数が0になったときだけStorageから削除する
+
 詳細は docs/storage-security.md を参照
 """
 
 import base64
+import hashlib
 import re
+import secrets
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+from config import (
+    LOCAL_STORAGE_DIR,
+    STORAGE_BACKEND,
+    STORAGE_PUBLIC_BASE_URL,
+    STORAGE_SIGNING_SECRET,
+)
 from database import get_supabase_client
+from metrics import BLOB_UPLOADS_TOTAL, track_supabase
+from .storage_backends import LocalStorageBackend, StorageBackend, SupabaseStorageBackend
 
 BUCKET_NAME = "aredoko-images"
 
@@ -20,42 +46,72 @@ BUCKET_NAME = "aredoko-images"
 # 1時間 = 3600秒（長時間の作業にも対応）
 SIGNED_URL_EXPIRY_SECONDS = 3600
 
-# バケット作成済みフラグ
-_bucket_ensured = False
+# base64を逐次デコードする単位（4の倍数）
+_BASE64_CHUNK_CHARS = 4 * 64 * 1024
+
+# コンテンツアドレス方式のパス: blobs/{先頭2文字}/{SHA-256}.{拡張子}
+_BLOB_PATH_PATTERN = re.compile(r"blobs/[0-9a-f]{2}/([0-9a-f]{64})\.\w+")
+
+# 同じ画像を他の呼び出しがアップロード中の場合に、完了を確認する間隔と待つ上限（秒）
+_BLOB_PENDING_POLL_SECONDS = 0.2
+_BLOB_PENDING_TIMEOUT_SECONDS = 60
+# アップロードの担当がこの時間内に完了しなければ、待っている呼び出しが引き継ぐ（秒）
+_BLOB_UPLOAD_LEASE_SECONDS = 30
+
+_backend: Optional[StorageBackend] = None
+
+
+def get_storage_backend() -> StorageBackend:
+    """設定に応じたストレージバックエンドを取得（シングルトン）"""
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == "local":
+            secret = STORAGE_SIGNING_SECRET.encode()
+            if not secret:
+                # 未設定の場合は起動ごとにランダム（再起動で既存URLは無効になる）
+                print("Warning: STORAGE_SIGNING_SECRET is not set. Using a random key.")
+                secret = secrets.token_bytes(32)
+            _backend = LocalStorageBackend(LOCAL_STORAGE_DIR, STORAGE_PUBLIC_BASE_URL, secret)
+        elif STORAGE_BACKEND == "supabase":
+            _backend = SupabaseStorageBackend(BUCKET_NAME)
+        else:
+            raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+    return _backend
 
 
 def ensure_bucket_exists() -> None:
     """
-    バケットが存在しない場合は作成する
+    保存先が存在しない場合は作成する
 
-    セキュリティ: バケットは常にPrivate設定
+    セキュリティ: Supabaseのバケットは常にPrivate設定
     - 認証なしでの直接アクセスを防止
     - 画像へのアクセスは署名付きURLを使用
     """
-    global _bucket_ensured
-    if _bucket_ensured:
-        return
+    get_storage_backend().ensure_ready()
 
-    client = get_supabase_client()
-    try:
-        # バケット一覧を取得
-        buckets = client.storage.list_buckets()
-        bucket_names = [b.name for b in buckets]
-
-        if BUCKET_NAME not in bucket_names:
-            # バケットを作成（private=デフォルト）
-            client.storage.create_bucket(BUCKET_NAME, options={"public": False})
-            print(f"Created private bucket: {BUCKET_NAME}")
-        else:
-            # 既存バケットがpublicの場合はprivateに更新（セキュリティ強化）
-            bucket = next((b for b in buckets if b.name == BUCKET_NAME), None)
-            if bucket and bucket.public:
-                client.storage.update_bucket(BUCKET_NAME, options={"public": False})
-                print(f"Updated bucket to private: {BUCKET_NAME}")
 
-        _bucket_ensured = True
-    except Exception as e:
-        print(f"Error ensuring bucket: {e}")
+def _iter_base64_chunks(base64_data: str) -> Iterator[bytes]:
+    """base64文字列を一定サイズずつデコード（デコード結果全体をメモリに持たない）"""
+    for start in range(0, len(base64_data), _BASE64_CHUNK_CHARS):
+        yield base64.b64decode(base64_data[start:start + _BASE64_CHUNK_CHARS])
+
+
+def _parse_data_url(data_url: str) -> tuple[str, str, str]:
+    """
+    data:image/jpeg;base64,... 形式をパース（巨大な本体部分はコピーしない）
+
+    Returns:
+        (拡張子, Content-Type, base64の本体)
+    """
+    header, _, base64_data = data_url.partition(",")
+    match = re.fullmatch(r"data:image/(\w+);base64", header)
+    if not match or not base64_data:
+        raise ValueError("Invalid data URL format")
+
+    image_type = match.group(1)
+    if image_type in ("jpg", "jpeg"):
+        return "jpg", "image/jpeg", base64_data
+    return image_type, f"image/{image_type}", base64_data
 
 
 def upload_image(path: str, data_url: str) -> str:
@@ -72,33 +128,151 @@ def upload_image(path: str, data_url: str) -> str:
     # バケットが存在することを確認
     ensure_bucket_exists()
 
-    # data:image/jpeg;base64,... 形式をパース
-    match = re.match(r"data:image/(\w+);base64,(.+)", data_url)
-    if not match:
-        raise ValueError("Invalid data URL format")
+    _, content_type, base64_data = _parse_data_url(data_url)
+    get_storage_backend().upload(path, _iter_base64_chunks(base64_data), content_type)
+
+    return path
+
+
+def blob_digest(path: str) -> Optional[str]:
+    """
+    コンテンツアドレス方式のパスから画像のSHA-256を取り出す
+
+    SAMの埋め込みキャッシュのキー（画像バイト列のSHA-256）と同じ値になる。
+
+    Returns:
+        SHA-256の16進文字列（従来のランダムなパスの場合は None）
+    """
+    match = _BLOB_PATH_PATTERN.fullmatch(path)
+    return match.group(1) if match else None
+
+
+def store_image(data_url: str) -> str:
+    """
+    base64データURLをコンテンツアドレス方式で保存
+
+    同じ内容の画像が既に保存されていればアップロードせず、参照数だけを増やす。
+    不要になったら release_image() で参照を外すこと。
+    同じ画像を他の呼び出しがアップロード中の場合は完了を待つ（asyncのハンドラーからは
+    run_in_threadpool で呼ぶ）。
+
+    Args:
+        data_url: base64エンコードされたデータURL
+
+    Returns:
+        Storage内のパス（内容が同じなら常に同じパス）
+
+    Raises:
+        TimeoutError: 他の呼び出しによるアップロードが終わらない
+    """
+    extension, content_type, base64_data = _parse_data_url(data_url)
+    return _store_chunks(lambda: _iter_base64_chunks(base64_data), extension, content_type)
 
-    image_type = match.group(1)
-    base64_data = match.group(2)
 
-    # base64をバイナリに変換
-    image_bytes = base64.b64decode(base64_data)
+def store_image_bytes(data: bytes, extension: str, content_type: str) -> str:
+    """
+    バイト列をコンテンツアドレス方式で保存（サーバー側で生成した画像向け）
 
-    # Content-Typeを設定
-    content_type = f"image/{image_type}"
-    if image_type == "jpg":
-        content_type = "image/jpeg"
+    Args:
+        data: 画像のバイト列
+        extension: 拡張子（例: "webp"）
+        content_type: Content-Type（例: "image/webp"）
 
-    # アップロード
+    Returns:
+        Storage内のパス
+    """
+    return _store_chunks(lambda: iter((data,)), extension, content_type)
+
+
+def _store_chunks(make_chunks: Callable[[], Iterable[bytes]], extension: str, content_type: str) -> str:
+    """make_chunks() のバイト列をコンテンツアドレス方式で保存（store_image の本体）"""
+    # 1回目: ハッシュとサイズを計算（デコード結果全体はメモリに持たない）
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in make_chunks():
+        sha256.update(chunk)
+        size += len(chunk)
+    digest = sha256.hexdigest()
+    path = f"blobs/{digest[:2]}/{digest}.{extension}"
+
+    # 参照を増やす。"upload": アップロードを担当する, "ready": 保存済み, "pending": 他の呼び出しがアップロード中
     client = get_supabase_client()
-    client.storage.from_(BUCKET_NAME).upload(
-        path,
-        image_bytes,
-        {"content-type": content_type}
-    )
+    with track_supabase("aredoko_blobs", "rpc"):
+        state = client.rpc("aredoko_acquire_blob", {
+            "p_hash": digest,
+            "p_path": path,
+            "p_content_type": content_type,
+            "p_size": size,
+            "p_lease_seconds": _BLOB_UPLOAD_LEASE_SECONDS,
+        }).execute().data
+
+    # アップロード中の画像は、完了する（または担当を引き継ぐ）まで待つ
+    deadline = time.monotonic() + _BLOB_PENDING_TIMEOUT_SECONDS
+    while state == "pending":
+        if time.monotonic() >= deadline:
+            release_image(path)
+            raise TimeoutError(f"Timed out waiting for another upload of {path}")
+        time.sleep(_BLOB_PENDING_POLL_SECONDS)
+        with track_supabase("aredoko_blobs", "rpc"):
+            state = client.rpc("aredoko_claim_blob", {
+                "p_hash": digest,
+                "p_lease_seconds": _BLOB_UPLOAD_LEASE_SECONDS,
+            }).execute().data
+
+    if state == "ready":
+        BLOB_UPLOADS_TOTAL.labels(result="deduplicated").inc()
+        return path
 
+    # 2回目: アップロードを担当する場合だけアップロード（完了を記録するまで他の呼び出しはパスを返さない）
+    ensure_bucket_exists()
+    try:
+        get_storage_backend().upload(path, make_chunks(), content_type)
+    except BaseException:
+        _finish_blob(digest, stored=False)
+        release_image(path)
+        raise
+    _finish_blob(digest, stored=True)
+    BLOB_UPLOADS_TOTAL.labels(result="stored").inc()
     return path
 
 
+def _finish_blob(digest: str, stored: bool) -> None:
+    """アップロードの完了を記録（失敗した場合は、待っている呼び出しがすぐに引き継げるよう担当を外す）"""
+    client = get_supabase_client()
+    with track_supabase("aredoko_blobs", "rpc"):
+        client.rpc("aredoko_finish_blob", {"p_hash": digest, "p_stored": stored}).execute()
+
+
+def release_image(path: str) -> None:
+    """
+    store_image() で保存した画像の参照を外す
+
+    参照数が0になった場合だけStorageから削除する。削除が終わるまで行は残し（deleting）、
+    削除を始めたときの世代が変わっていない場合だけ行を消す。
+    従来のランダムなパス（photos/xxx.jpg など）はそのまま削除する。
+
+    Args:
+        path: Storage内のパス
+    """
+    digest = blob_digest(path)
+    if digest is None:
+        delete_image(path)
+        return
+
+    client = get_supabase_client()
+    with track_supabase("aredoko_blobs", "rpc"):
+        generation = client.rpc("aredoko_release_blob", {"p_hash": digest}).execute().data
+    if generation is None:
+        return
+
+    try:
+        delete_image(path)
+    finally:
+        # 削除中に再登録されていれば、待っている呼び出しがアップロードし直す
+        with track_supabase("aredoko_blobs", "rpc"):
+            client.rpc("aredoko_purge_blob", {"p_hash": digest, "p_generation": generation}).execute()
+
+
 def delete_image(path: str) -> None:
     """
     Storageから画像を削除
@@ -106,8 +280,7 @@ def delete_image(path: str) -> None:
     Args:
         path: Storage内のパス
     """
-    client = get_supabase_client()
-    client.storage.from_(BUCKET_NAME).remove([path])
+    get_storage_backend().delete(path)
 
 
 def get_image_url(path: str) -> str:
@@ -125,9 +298,19 @@ def get_image_url(path: str) -> str:
     Returns:
         署名付きURL（有効期限付き）
     """
-    client = get_supabase_client()
-    result = client.storage.from_(BUCKET_NAME).create_signed_url(
-        path,
-        SIGNED_URL_EXPIRY_SECONDS
-    )
-    return result["signedURL"]
+    return get_storage_backend().get_url(path, SIGNED_URL_EXPIRY_SECONDS)
+
+
+def read_image(path: str) -> bytes:
+    """
+    Storageの画像をサーバー内で読み込む
+
+    ローカルストレージではディスクから直接読み込むため、ネットワークを経由しない
+
+    Args:
+        path: Storage内のパス
+
+    Returns:
+        画像のバイト列
+    """
+    return get_storage_backend().read(path)
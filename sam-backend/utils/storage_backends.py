@@ -0,0 +1,194 @@
+"""
+画像ストレージのバックエンド
+
+- SupabaseStorageBackend: Supabase Storage（Privateバケット + 署名付きURL）
+- LocalStorageBackend: ローカルディスク（バックエンド自身がHMAC署名付きURLで配信）
+
+どちらを使うかは config.STORAGE_BACKEND で切り替える（utils/storage.py 参照）。
+"""
+
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import quote
+
+from database import get_supabase_client
+from metrics import track_storage
+
+
+class StorageBackend(ABC):
+    """画像ストレージの共通インターフェース"""
+
+    def ensure_ready(self) -> None:
+        """保存先の準備（バケット作成など）"""
+
+    @abstractmethod
+    def upload(self, path: str, chunks: Iterable[bytes], content_type: str) -> None:
+        """バイト列のチャンクを path に保存"""
+
+    @abstractmethod
+    def delete(self, path: str) -> None:
+        """path の画像を削除"""
+
+    @abstractmethod
+    def get_url(self, path: str, expires_in: int) -> str:
+        """有効期限付きの画像URLを取得"""
+
+    @abstractmethod
+    def read(self, path: str) -> bytes:
+        """path の画像を読み込む（サーバー内での利用向け）"""
+
+
+class SupabaseStorageBackend(StorageBackend):
+    """
+    Supabase Storage
+
+    セキュリティ設計:
+    - バケットは常にPrivate設定（認証なしではアクセス不可）
+    - 画像URLは署名付きURL（Signed URL）を使用
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self._bucket_ensured = False
+
+    def ensure_ready(self) -> None:
+        """
+        バケットが存在しない場合は作成する
+
+        セキュリティ: バケットは常にPrivate設定
+        - 認証なしでの直接アクセスを防止
+        - 画像へのアクセスは署名付きURLを使用
+        """
+        if self._bucket_ensured:
+            return
+
+        client = get_supabase_client()
+        try:
+            # バケット一覧を取得
+            with track_storage("list_buckets"):
+                buckets = client.storage.list_buckets()
+            bucket_names = [b.name for b in buckets]
+
+            if self.bucket_name not in bucket_names:
+                # バケットを作成（private=デフォルト）
+                with track_storage("create_bucket"):
+                    client.storage.create_bucket(self.bucket_name, options={"public": False})
+                print(f"Created private bucket: {self.bucket_name}")
+            else:
+                # 既存バケットがpublicの場合はprivateに更新（セキュリティ強化）
+                bucket = next((b for b in buckets if b.name == self.bucket_name), None)
+                if bucket and bucket.public:
+                    with track_storage("update_bucket"):
+                        client.storage.update_bucket(self.bucket_name, options={"public": False})
+                    print(f"Updated bucket to private: {self.bucket_name}")
+
+            self._bucket_ensured = True
+        except Exception as e:
+            print(f"Error ensuring bucket: {e}")
+
+    def upload(self, path: str, chunks: Iterable[bytes], content_type: str) -> None:
+        # Supabase Storage APIはバイト列全体を必要とする
+        image_bytes = b"".join(chunks)
+        client = get_supabase_client()
+        with track_storage("upload"):
+            # 上書きを許可（コンテンツアドレス方式のパスは同じ内容での再アップロードになる）
+            client.storage.from_(self.bucket_name).upload(
+                path,
+                image_bytes,
+                {"content-type": content_type, "upsert": "true"}
+            )
+
+    def delete(self, path: str) -> None:
+        client = get_supabase_client()
+        with track_storage("remove"):
+            client.storage.from_(self.bucket_name).remove([path])
+
+    def get_url(self, path: str, expires_in: int) -> str:
+        client = get_supabase_client()
+        with track_storage("create_signed_url"):
+            result = client.storage.from_(self.bucket_name).create_signed_url(
+                path,
+                expires_in
+            )
+        return result["signedURL"]
+
+    def read(self, path: str) -> bytes:
+        client = get_supabase_client()
+        with track_storage("download"):
+            return client.storage.from_(self.bucket_name).download(path)
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    ローカルディスク
+
+    セキュリティ設計:
+    - 保存ディレクトリは静的配信せず、/api/storage/{path} ルート経由でのみ配信
+    - URLにはパスと有効期限に対するHMAC-SHA256署名を付与し、ルート側で検証
+    - 有効期限は一定間隔に切り上げて、同じ画像のURLが一定時間変わらないようにする
+      （ブラウザキャッシュを効かせるため）
+    """
+
+    # 有効期限を切り上げる間隔（秒）
+    EXPIRY_ROUNDING_SECONDS = 300
+
+    def __init__(self, root: str, base_url: str, signing_secret: bytes):
+        self.root = Path(root).resolve()
+        self.base_url = base_url.rstrip("/")
+        self._secret = signing_secret
+
+    def ensure_ready(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def resolve(self, path: str) -> Path:
+        """Storage内のパスをディスク上のパスに変換（ルート外へのアクセスは拒否）"""
+        resolved = (self.root / path).resolve()
+        if resolved == self.root or self.root not in resolved.parents:
+            raise ValueError(f"Invalid storage path: {path}")
+        return resolved
+
+    def upload(self, path: str, chunks: Iterable[bytes], content_type: str) -> None:
+        # 一時ファイルに逐次書き込んでからリネーム（書き込み途中のファイルを配信しない）
+        target = self.resolve(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with track_storage("upload"):
+            fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=".upload-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                os.replace(tmp_path, target)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def delete(self, path: str) -> None:
+        with track_storage("remove"):
+            self.resolve(path).unlink(missing_ok=True)
+
+    def get_url(self, path: str, expires_in: int) -> str:
+        rounding = self.EXPIRY_ROUNDING_SECONDS
+        expires = -(-(int(time.time()) + expires_in) // rounding) * rounding
+        signature = self.sign(path, expires)
+        return f"{self.base_url}/api/storage/{quote(path)}?expires={expires}&signature={signature}"
+
+    def read(self, path: str) -> bytes:
+        with track_storage("download"):
+            return self.resolve(path).read_bytes()
+
+    def sign(self, path: str, expires: int) -> str:
+        """パスと有効期限に対するHMAC-SHA256署名"""
+        message = f"{path}\n{expires}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def verify(self, path: str, expires: int, signature: str) -> bool:
+        """署名と有効期限を検証"""
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self.sign(path, expires), signature)
@@ -2,6 +2,7 @@ import { useEffect } from 'react'
 import './App.css'
 import { useStorageStore } from './stores/storageStore'
 import { useAuthStore } from './stores/authStore'
+import { subscribeChanges } from './api/changes'
 import { MainView } from './pages/MainView'
 import { RegistrationView } from './pages/RegistrationView'
 import { LoginPage } from './pages/LoginPage'
@@ -14,6 +15,8 @@ function App() {
   const loading = useStorageStore((state) => state.loading)
   const error = useStorageStore((state) => state.error)
   const loadWarehouses = useStorageStore((state) => state.loadWarehouses)
+  const currentWarehouseId = useStorageStore((state) => state.currentWarehouseId)
+  const applyChange = useStorageStore((state) => state.applyChange)
 
   // 認証の初期化
   useEffect(() => {
@@ -26,6 +29,12 @@ function App() {
     loadWarehouses()
   }, [authLoading, user, loadWarehouses])
 
+  // 表示中の倉庫の変更を購読（他のユーザーの編集を反映）
+  useEffect(() => {
+    if (!user || !currentWarehouseId) return
+    return subscribeChanges(currentWarehouseId, (event) => applyChange(currentWarehouseId, event))
+  }, [user, currentWarehouseId, applyChange])
+
   // 認証中
   if (authLoading) {
     return (
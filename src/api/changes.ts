@@ -0,0 +1,34 @@
+/**
+ * 変更フィードAPI（Server-Sent Events）
+ */
+
+import { API_URL } from './client'
+
+export interface ChangeEvent {
+  entity: 'warehouse' | 'photo' | 'object' | null
+  op: 'created' | 'updated' | 'deleted' | 'resync'
+  id?: string
+  photo_id?: string
+  version?: number
+  // created: レスポンスと同じ全項目, updated: 変更した項目のみ
+  changes?: Record<string, unknown>
+}
+
+const CHANGE_OPS = ['created', 'updated', 'deleted', 'resync'] as const
+
+/**
+ * 倉庫内の変更を購読（切断時はEventSourceが自動で再接続し、続きから受信する）
+ *
+ * @returns 購読を終了する関数
+ */
+export function subscribeChanges(
+  warehouseId: string,
+  onChange: (event: ChangeEvent) => void
+): () => void {
+  const source = new EventSource(`${API_URL}/api/warehouses/${warehouseId}/changes`)
+  const handler = (e: MessageEvent<string>) => onChange(JSON.parse(e.data) as ChangeEvent)
+  for (const op of CHANGE_OPS) {
+    source.addEventListener(op, handler)
+  }
+  return () => source.close()
+}
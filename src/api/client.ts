@@ -4,7 +4,7 @@
 
 import { supabase } from '../lib/supabase'
 
-const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8001'
+export const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8001'
 
 interface FetchOptions extends RequestInit {
   body?: BodyInit | null
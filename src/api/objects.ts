@@ -23,7 +23,7 @@ export interface ObjectResponse {
 export interface ObjectCreateRequest {
   name: string
   memo: string
-  clipped_image_data_url: string
+  clipped_image_data_url?: string // 省略時はサーバーが写真とマスクから生成
   mask_type: 'polygon' | 'rect'
   mask_data: Record<string, unknown>
   click_point: Position
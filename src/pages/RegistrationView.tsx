@@ -151,7 +151,6 @@ export function RegistrationView() {
       currentPhotoId,
       name,
       memo,
-      selectionState.previewImageDataUrl,
       selectionState.mask,
       selectionState.clickPoint
     )
@@ -8,6 +8,7 @@ import * as warehousesApi from '../api/warehouses'
 import * as photosApi from '../api/photos'
 import * as objectsApi from '../api/objects'
 import { ApiError } from '../api/client'
+import type { ChangeEvent } from '../api/changes'
 
 interface StorageState {
   // Data
@@ -35,6 +36,7 @@ interface StorageActions {
   loadWarehouses: () => Promise<void>
   loadPhotos: (warehouseId: string) => Promise<void>
   loadObjects: (photoId: string) => Promise<void>
+  applyChange: (warehouseId: string, event: ChangeEvent) => void
 
   // Warehouse CRUD
   addWarehouse: (name: string, memo?: string) => Promise<string | null>
@@ -52,7 +54,6 @@ interface StorageActions {
     photoId: string,
     name: string,
     memo: string,
-    clippedImageDataUrl: string,
     mask: ObjectMask,
     clickPoint: Position
   ) => Promise<string | null>
@@ -198,6 +199,88 @@ export const useStorageStore = create<StorageState & StorageActions>((set, get)
     }
   },
 
+  // 他のユーザーの変更を反映（自分の変更は作成済み・version が同じなので無視される）
+  applyChange: (warehouseId, event) => {
+    if (event.op === 'resync') {
+      // 取りこぼしがあったため一覧を取り直す
+      void get().loadPhotos(warehouseId)
+      return
+    }
+
+    const changes = event.changes ?? {}
+    const isNewer = (version: number) => event.version === undefined || event.version > version
+
+    set((state) => {
+      if (event.entity === 'warehouse') {
+        if (event.op === 'deleted') {
+          return {
+            warehouses: state.warehouses.filter((w) => w.id !== event.id),
+            currentWarehouseId: state.currentWarehouseId === event.id ? null : state.currentWarehouseId,
+          }
+        }
+        return {
+          warehouses: state.warehouses.map((w) =>
+            w.id === event.id && isNewer(w.version)
+              ? { ...w, ...(changes as Partial<Pick<Warehouse, 'name' | 'memo'>>), version: event.version ?? w.version }
+              : w
+          ),
+        }
+      }
+
+      return {
+        warehouses: state.warehouses.map((w) => {
+          if (w.id !== warehouseId) return w
+
+          if (event.entity === 'photo') {
+            if (event.op === 'created') {
+              if (w.photos.some((p) => p.id === event.id)) return w
+              return { ...w, photos: [...w.photos, toPhoto(changes as unknown as photosApi.PhotoResponse)] }
+            }
+            if (event.op === 'deleted') {
+              return { ...w, photos: w.photos.filter((p) => p.id !== event.id) }
+            }
+            return {
+              ...w,
+              photos: w.photos.map((p) =>
+                p.id === event.id && isNewer(p.version)
+                  ? { ...p, ...(changes as Partial<Pick<Photo, 'name'>>), version: event.version ?? p.version }
+                  : p
+              ),
+            }
+          }
+
+          return {
+            ...w,
+            photos: w.photos.map((p) => {
+              if (p.id !== event.photo_id) return p
+              if (event.op === 'created') {
+                if (p.objects.some((o) => o.id === event.id)) return p
+                return { ...p, objects: [...p.objects, toStorageObject(changes as unknown as objectsApi.ObjectResponse)] }
+              }
+              if (event.op === 'deleted') {
+                return { ...p, objects: p.objects.filter((o) => o.id !== event.id) }
+              }
+              const { clipped_image_url: clippedImageUrl, ...fields } = changes
+              return {
+                ...p,
+                objects: p.objects.map((o) =>
+                  o.id === event.id && isNewer(o.version)
+                    ? {
+                        ...o,
+                        ...(fields as Partial<Pick<StorageObject, 'name' | 'memo'>>),
+                        ...(typeof clippedImageUrl === 'string' ? { clippedImageDataUrl: clippedImageUrl } : {}),
+                        version: event.version ?? o.version,
+                      }
+                    : o
+                ),
+              }
+            }),
+          }
+        }),
+      }
+    })
+  },
+
   // Warehouse CRUD
   addWarehouse: async (name, memo = '') => {
     set({ loading: true, error: null })
@@ -361,7 +444,7 @@ export const useStorageStore = create<StorageState & StorageActions>((set, get)
   },
 
   // Object CRUD
-  addObject: async (warehouseId, photoId, name, memo, clippedImageDataUrl, mask, clickPoint) => {
+  addObject: async (warehouseId, photoId, name, memo, mask, clickPoint) => {
     set({ loading: true, error: null })
     try {
       // マスクをバックエンド形式に変換
@@ -370,10 +453,10 @@ export const useStorageStore = create<StorageState & StorageActions>((set, get)
         ? { points: mask.points }
         : { x: mask.x, y: mask.y, width: mask.width, height: mask.height }
 
+      // クリップ画像はサーバーが保存済みの写真とマスクから生成する
       const res = await objectsApi.createObject(photoId, {
         name,
         memo,
-        clipped_image_data_url: clippedImageDataUrl,
         mask_type: maskType,
         mask_data: maskData,
         click_point: clickPoint,
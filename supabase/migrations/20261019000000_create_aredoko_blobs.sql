@@ -0,0 +1,142 @@
+-- コンテンツアドレス方式の画像ストレージ（重複排除）
+-- 画像は内容のSHA-256をキーにして1回だけ保存し、参照している写真・オブジェクトの数を数える
+-- 参照数が0になったときだけStorageから削除する
+-- 新しい画像の行はアップロードが終わるまで pending（その間に同じ画像を登録した呼び出しは完了を待つ）
+-- 参照数が0になった行はStorageから削除し終わるまで deleting（その間に再登録した呼び出しも削除を待つ）
+
+-- ========================================
+-- 1. テーブル作成
+-- ========================================
+
+CREATE TABLE aredoko_blobs (
+  hash CHAR(64) PRIMARY KEY,
+  path VARCHAR(1024) NOT NULL UNIQUE,
+  content_type VARCHAR(100) NOT NULL,
+  size BIGINT NOT NULL,
+  ref_count INTEGER NOT NULL DEFAULT 1 CHECK (ref_count >= 0),
+  -- pending: アップロード中, ready: 保存済み, deleting: Storageから削除中
+  status VARCHAR(16) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'ready', 'deleting')),
+  -- アップロード・削除の担当が開始した時刻（NULL: 担当なし。期限切れの担当は待っている呼び出しが引き継ぐ）
+  upload_started_at TIMESTAMPTZ,
+  -- 削除を始めるたび・削除中の行を引き継ぐたびに増やす（古い削除の担当が行を消さないように）
+  generation BIGINT NOT NULL DEFAULT 0,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- ========================================
+-- 2. RLSポリシー（認証済みユーザーのみアクセス可能）
+-- ========================================
+
+ALTER TABLE aredoko_blobs ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Authenticated users can view blobs"
+  ON aredoko_blobs FOR SELECT
+  USING (auth.role() = 'authenticated');
+CREATE POLICY "Authenticated users can insert blobs"
+  ON aredoko_blobs FOR INSERT
+  WITH CHECK (auth.role() = 'authenticated');
+CREATE POLICY "Authenticated users can update blobs"
+  ON aredoko_blobs FOR UPDATE
+  USING (auth.role() = 'authenticated');
+CREATE POLICY "Authenticated users can delete blobs"
+  ON aredoko_blobs FOR DELETE
+  USING (auth.role() = 'authenticated');
+
+-- ========================================
+-- 3. 参照数の増減（同時実行でも数がずれないようにDB側で1文で更新）
+-- ========================================
+
+-- アップロードの担当を引き受ける。担当なし・期限切れ（p_lease_seconds）なら 'upload'、
+-- それ以外は 'ready' / 'pending'（削除中も 'pending'）、登録がなければ NULL を返す
+CREATE OR REPLACE FUNCTION aredoko_claim_blob(p_hash TEXT, p_lease_seconds INTEGER)
+RETURNS TEXT AS $$
+DECLARE
+  current_status TEXT;
+BEGIN
+  -- 削除の担当が期限切れの場合も引き継ぐ（世代を進めて、古い担当が行を消さないようにする）
+  UPDATE aredoko_blobs
+  SET status = 'pending',
+      upload_started_at = NOW(),
+      generation = generation + CASE WHEN status = 'deleting' THEN 1 ELSE 0 END
+  WHERE hash = p_hash AND (
+    (status = 'pending' AND upload_started_at IS NULL)
+    OR (status IN ('pending', 'deleting') AND upload_started_at < NOW() - make_interval(secs => p_lease_seconds))
+  );
+  IF FOUND THEN
+    RETURN 'upload';
+  END IF;
+
+  SELECT CASE WHEN status = 'deleting' THEN 'pending' ELSE status END
+  INTO current_status FROM aredoko_blobs WHERE hash = p_hash;
+  RETURN current_status;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 参照を1つ増やす。新しく登録した場合は 'upload'（呼び出し側でアップロードして aredoko_finish_blob を呼ぶ）、
+-- 保存済みなら 'ready'、他の呼び出しがアップロード・削除中なら 'pending'（aredoko_claim_blob で完了を待つ）
+CREATE OR REPLACE FUNCTION aredoko_acquire_blob(
+  p_hash TEXT,
+  p_path TEXT,
+  p_content_type TEXT,
+  p_size BIGINT,
+  p_lease_seconds INTEGER
+)
+RETURNS TEXT AS $$
+DECLARE
+  result TEXT;
+BEGIN
+  INSERT INTO aredoko_blobs (hash, path, content_type, size, ref_count, status, upload_started_at)
+  VALUES (p_hash, p_path, p_content_type, p_size, 1, 'pending', NOW())
+  ON CONFLICT (hash) DO UPDATE SET ref_count = aredoko_blobs.ref_count + 1
+  RETURNING CASE WHEN xmax = 0 THEN 'upload' ELSE status END INTO result;
+
+  IF result IN ('pending', 'deleting') THEN
+    -- 担当が失敗・期限切れならこの呼び出しが引き継ぐ
+    RETURN aredoko_claim_blob(p_hash, p_lease_seconds);
+  END IF;
+  RETURN result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- アップロードの結果を記録する。成功なら 'ready'、失敗なら担当を外す（待っている呼び出しが引き継ぐ）
+CREATE OR REPLACE FUNCTION aredoko_finish_blob(p_hash TEXT, p_stored BOOLEAN)
+RETURNS VOID AS $$
+BEGIN
+  IF p_stored THEN
+    UPDATE aredoko_blobs SET status = 'ready', upload_started_at = NULL WHERE hash = p_hash;
+  ELSE
+    UPDATE aredoko_blobs SET upload_started_at = NULL WHERE hash = p_hash AND status = 'pending';
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 参照を1つ減らす。0になった場合は行を deleting にして世代を返す
+-- （呼び出し側でStorageから削除して aredoko_purge_blob を呼ぶ）。参照が残る・登録がなければ NULL
+CREATE OR REPLACE FUNCTION aredoko_release_blob(p_hash TEXT)
+RETURNS BIGINT AS $$
+DECLARE
+  deleting_generation BIGINT;
+BEGIN
+  UPDATE aredoko_blobs
+  SET ref_count = ref_count - 1,
+      status = CASE WHEN ref_count <= 1 THEN 'deleting' ELSE status END,
+      upload_started_at = CASE WHEN ref_count <= 1 THEN NOW() ELSE upload_started_at END,
+      generation = CASE WHEN ref_count <= 1 THEN generation + 1 ELSE generation END
+  WHERE hash = p_hash
+  RETURNING CASE WHEN ref_count <= 0 THEN generation END INTO deleting_generation;
+  RETURN deleting_generation;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Storageからの削除が終わった行を消す（p_generation の削除のまま参照がない場合のみ）。
+-- 削除中に再登録されていれば pending に戻し、待っている呼び出しがアップロードを引き受けられるようにする
+CREATE OR REPLACE FUNCTION aredoko_purge_blob(p_hash TEXT, p_generation BIGINT)
+RETURNS VOID AS $$
+BEGIN
+  DELETE FROM aredoko_blobs
+  WHERE hash = p_hash AND generation = p_generation AND status = 'deleting' AND ref_count <= 0;
+  IF NOT FOUND THEN
+    UPDATE aredoko_blobs SET status = 'pending', upload_started_at = NULL
+    WHERE hash = p_hash AND generation = p_generation AND status = 'deleting';
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
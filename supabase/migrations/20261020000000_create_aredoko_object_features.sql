@@ -0,0 +1,42 @@
+-- オブジェクトの特徴ベクトル（類似検索用）
+-- オブジェクトの登録後にサーバーが計算して保存する。オブジェクト本体の行とは分けて保存し、
+-- 一覧の取得でベクトルを返さない・計算結果の保存でオブジェクトのversionを上げないようにする
+
+-- ========================================
+-- 1. テーブル作成
+-- ========================================
+
+CREATE TABLE aredoko_object_features (
+  object_id UUID PRIMARY KEY REFERENCES aredoko_objects(id) ON DELETE CASCADE,
+  -- 倉庫ごとに索引を読み込むため、写真を経由せずに絞り込めるように持つ
+  warehouse_id UUID NOT NULL REFERENCES aredoko_warehouses(id) ON DELETE CASCADE,
+  -- 特徴の種類（sam_vit_b など）。種類が違うベクトルは比較しない
+  model VARCHAR(50) NOT NULL,
+  -- L2正規化したfloat16のベクトル（Base64）
+  vector TEXT NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- ========================================
+-- 2. インデックス
+-- ========================================
+
+CREATE INDEX idx_aredoko_object_features_warehouse ON aredoko_object_features(warehouse_id, object_id);
+
+-- ========================================
+-- 3. RLSポリシー（認証済みユーザーのみアクセス可能）
+-- ========================================
+
+ALTER TABLE aredoko_object_features ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Authenticated users can view object features"
+  ON aredoko_object_features FOR SELECT
+  USING (auth.role() = 'authenticated');
+CREATE POLICY "Authenticated users can insert object features"
+  ON aredoko_object_features FOR INSERT
+  WITH CHECK (auth.role() = 'authenticated');
+CREATE POLICY "Authenticated users can update object features"
+  ON aredoko_object_features FOR UPDATE
+  USING (auth.role() = 'authenticated');
+CREATE POLICY "Authenticated users can delete object features"
+  ON aredoko_object_features FOR DELETE
+  USING (auth.role() = 'authenticated');